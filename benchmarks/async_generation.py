@@ -0,0 +1,109 @@
+"""Compares many generations driven by one blocking worker with one asyncio event loop.
+
+A local fake llama-server with parallel slots streams every /completion response
+at a fixed token rate. N generations are run one after another with LlamaCpp,
+as a single sync worker does, and concurrently with AsyncLlamaCpp sharing one
+httpx client in a single thread.
+
+Usage (from the repository root):
+    python -m benchmarks.async_generation --sessions 1 8 32 --tokens 100 --rate 200
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from benchmarks.common import print_table
+from pygentify import http_client
+from pygentify.llm_backends import LlamaCpp, AsyncLlamaCpp, GenerationSpec
+
+
+class FakeParallelLlamaServer(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    num_tokens = 100
+    rate = 200
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        for i in range(self.num_tokens):
+            time.sleep(1 / self.rate)
+            self.send_event({"content": f" token{i}", "stop": False})
+        self.send_event({"content": "", "stop": True, "stopping_word": ""})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_event(self, entry):
+        event = f"data: {json.dumps(entry)}\n\n".encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServer(ThreadingHTTPServer):
+    # all sessions connect at once, the default backlog of 5 would drop connections
+    request_queue_size = 128
+
+
+def sequential(url, sessions):
+    for _ in range(sessions):
+        llm = LlamaCpp(url, GenerationSpec({}))
+        for _ in llm("prompt"):
+            pass
+
+
+def concurrent(url, sessions):
+    async def generate(client):
+        llm = AsyncLlamaCpp(url, GenerationSpec({}), client=client)
+        async for _ in llm("prompt"):
+            pass
+
+    async def run_all():
+        async with http_client.create_async_client() as client:
+            await asyncio.gather(*[generate(client) for _ in range(sessions)])
+
+    asyncio.run(run_all())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=200, help="tokens per second of every slot")
+    args = parser.parse_args()
+
+    FakeParallelLlamaServer.num_tokens = args.tokens
+    FakeParallelLlamaServer.rate = args.rate
+    server = FakeServer(("127.0.0.1", 0), FakeParallelLlamaServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # imports httpx and sets up TLS defaults outside of the measurements
+    concurrent(url, 1)
+
+    rows = []
+    for sessions in args.sessions:
+        results = []
+        for run in (sequential, concurrent):
+            t0 = time.perf_counter()
+            run(url, sessions)
+            results.append(time.perf_counter() - t0)
+
+        total_tokens = sessions * args.tokens
+        rows.append((sessions, f"{results[0]:.2f}", f"{total_tokens / results[0]:.0f}",
+                     f"{results[1]:.2f}", f"{total_tokens / results[1]:.0f}"))
+
+    print(f"{args.tokens} tokens per generation at {args.rate:.0f} tokens/s")
+    print_table(("sessions", "sequential s", "sequential tok/s", "async s", "async tok/s"), rows)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
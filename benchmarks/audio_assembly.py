@@ -0,0 +1,117 @@
+"""Compares building Message.audio from speech samples with the previous join_wavs approach.
+
+join_wavs read the frames of all samples into a list, wrote a temporary WAV,
+read it back and deleted it, after which the message saved the bytes again
+through ContentFile. MessageAudioBuilder appends every sample to the final
+file once. Peak Python memory is measured with tracemalloc.
+
+Usage (from the repository root):
+    SECRET_KEY_PATH=... python -m benchmarks.audio_assembly --samples 50 --seconds 5
+"""
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import uuid
+import wave
+
+from benchmarks.common import setup_django, print_table
+
+
+def join_wavs(samples, result_path):
+    data = []
+    params = None
+
+    for sample in samples:
+        w = wave.open(sample.audio.path, 'rb')
+        params = w.getparams()
+        data.append(w.readframes(w.getnframes()))
+        w.close()
+
+    with wave.open(result_path, 'wb') as output:
+        output.setparams(params)
+        for row in data:
+            output.writeframes(row)
+
+    with open(result_path, 'rb') as f:
+        res = f.read()
+
+    os.remove(result_path)
+    return res
+
+
+def make_samples(num_samples, seconds, framerate=22050):
+    from django.core.files.base import ContentFile
+    from chats.models import SpeechSample
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(framerate)
+        w.writeframes(os.urandom(2 * framerate * seconds))
+    data = buffer.getvalue()
+
+    samples = []
+    for i in range(num_samples):
+        sample = SpeechSample(text=f"sentence {i}")
+        sample.audio = ContentFile(data, name="sample.wav")
+        sample.save()
+        samples.append(sample)
+    return samples
+
+
+def previous(samples):
+    from django.conf import settings
+    from django.core.files.base import ContentFile
+    from chats.models import Message
+
+    output_path = os.path.join(settings.MEDIA_ROOT, f'{uuid.uuid4().hex}.wav')
+    message = Message(text="text")
+    message.audio = ContentFile(join_wavs(samples, output_path), name="tts-audio-file.wav")
+    message.save()
+
+
+def incremental(samples):
+    from chats.tasks import MessageAudioBuilder, create_response_message
+
+    builder = MessageAudioBuilder()
+    for sample in samples:
+        builder.add(sample)
+    create_response_message(None, "text", builder.finish())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--seconds", type=int, default=5, help="length of every sample")
+    args = parser.parse_args()
+
+    setup_django()
+    from django.test import override_settings
+
+    media_root = tempfile.mkdtemp()
+    rows = []
+    try:
+        with override_settings(MEDIA_ROOT=media_root):
+            samples = make_samples(args.samples, args.seconds)
+            for name, build in (("join_wavs", previous), ("MessageAudioBuilder", incremental)):
+                tracemalloc.start()
+                t0 = time.perf_counter()
+                build(samples)
+                elapsed = time.perf_counter() - t0
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                rows.append((name, f"{elapsed * 1000:.0f}", f"{peak / 2 ** 20:.1f}"))
+    finally:
+        shutil.rmtree(media_root)
+
+    print(f"{args.samples} samples of {args.seconds} s")
+    print_table(("method", "ms", "peak MiB"), rows)
+
+
+if __name__ == "__main__":
+    main()
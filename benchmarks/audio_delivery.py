@@ -0,0 +1,76 @@
+"""Compares serving speech sample audio with the previous BinaryRenderer approach.
+
+BinaryRenderer read the whole file into memory on every request and returned
+it through DRF. The speech sample endpoint now streams the file, or the byte
+range a seeking player asks for, with media.serve_file. Peak Python memory
+of one request is measured with tracemalloc, along with its time.
+
+Usage (from the repository root):
+    SECRET_KEY_PATH=... python -m benchmarks.audio_delivery --megabytes 20
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.common import setup_django, print_table
+
+
+def read_whole(sample):
+    # what BinaryRenderer.render did
+    with open(sample.audio.path, 'rb') as f:
+        return len(f.read())
+
+
+def fetch(client, url, **headers):
+    resp = client.get(url, **headers)
+    return sum(len(chunk) for chunk in resp.streaming_content)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=int, default=20, help="size of the audio file")
+    args = parser.parse_args()
+
+    setup_django()
+    from django.core.files.base import ContentFile
+    from django.test import Client, override_settings
+    from chats.models import SpeechSample
+
+    media_root = tempfile.mkdtemp()
+    rows = []
+    try:
+        with override_settings(MEDIA_ROOT=media_root):
+            sample = SpeechSample(text="long text")
+            sample.audio = ContentFile(os.urandom(args.megabytes * 2 ** 20), name="sample.wav")
+            sample.save()
+
+            client = Client()
+            url = f"/chats/speech-samples/{sample.pk}/"
+            # imports and url resolution outside of the measurements
+            fetch(client, url)
+
+            methods = [
+                ("BinaryRenderer read", lambda: read_whole(sample)),
+                ("streamed whole file", lambda: fetch(client, url)),
+                ("streamed last 64 KiB", lambda: fetch(client, url, HTTP_RANGE="bytes=-65536")),
+            ]
+            for name, serve in methods:
+                tracemalloc.start()
+                t0 = time.perf_counter()
+                sent = serve()
+                elapsed = time.perf_counter() - t0
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                rows.append((name, f"{sent / 2 ** 20:.2f}", f"{elapsed * 1000:.1f}", f"{peak / 2 ** 20:.2f}"))
+    finally:
+        shutil.rmtree(media_root)
+
+    print(f"audio file of {args.megabytes} MiB")
+    print_table(("method", "sent MiB", "ms", "peak MiB"), rows)
+
+
+if __name__ == "__main__":
+    main()
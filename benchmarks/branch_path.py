@@ -0,0 +1,76 @@
+"""Compares loading a conversation branch by walking parent links with the single query loader.
+
+Usage (from the repository root):
+    SECRET_KEY_PATH=<path> python -m benchmarks.branch_path
+"""
+import argparse
+from benchmarks.common import setup_django, measure, print_table
+
+
+def walk_parents(message):
+    history = [message]
+    while message.parent:
+        message = message.parent
+        history.append(message)
+    return list(reversed(history))
+
+
+def build_thread(user, depth):
+    from chats.models import Message, Chat, Configuration
+
+    configuration = Configuration.objects.create(user=user, name="bench", tools=[])
+    parent = Message.objects.create(text="Message 0")
+    Chat.objects.create(user=user, prompt=parent, configuration=configuration)
+    for i in range(1, depth):
+        parent = Message.objects.create(text=f"Message {i}", parent=parent)
+    return parent.pk
+
+
+def count_queries(func):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as ctx:
+        func()
+    return len(ctx.captured_queries)
+
+
+def main(depths, repeats):
+    from django.contrib.auth.models import User
+    from chats.models import Message
+
+    user = User.objects.create_user(username="bench", password="bench")
+
+    rows = []
+    for depth in depths:
+        leaf_id = build_thread(user, depth)
+
+        def parent_walk():
+            message = Message.objects.get(pk=leaf_id)
+            history = walk_parents(message)
+            return history[0].chat.configuration
+
+        def branch_loader():
+            history = Message.objects.branch(leaf_id)
+            return history[0].chat.configuration
+
+        rows.append((
+            depth,
+            count_queries(parent_walk),
+            f"{measure(parent_walk, repeats) * 1000:.2f}",
+            count_queries(branch_loader),
+            f"{measure(branch_loader, repeats) * 1000:.2f}"
+        ))
+
+    header = ("depth", "walk queries", "walk ms", "branch queries", "branch ms")
+    print_table(header, rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark conversation branch loading")
+    parser.add_argument("--depths", type=int, nargs="+", default=[10, 50, 100, 200, 400])
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    main(args.depths, args.repeats)
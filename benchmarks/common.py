@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, ".")
+
+
+def setup_django(settings_module="mysite.test_settings"):
+    """Configure django and create a throw-away test database for a benchmark run.
+
+    Test settings read a secret key, so SECRET_KEY_PATH has to be set as usual.
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+
+    import django
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+
+def measure(func, repeats=20):
+    """Return median wall time in seconds of calling func() repeatedly"""
+    timings = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t0)
+    return statistics.median(timings)
+
+
+def print_table(header, rows):
+    widths = [max(len(str(v)) for v in column) for column in zip(header, *rows)]
+    line = "  ".join(f"{{:>{w}}}" for w in widths)
+    print(line.format(*header))
+    for row in rows:
+        print(line.format(*row))
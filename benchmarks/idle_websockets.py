@@ -0,0 +1,71 @@
+"""Measures CPU used by the websocket gateway while many connected clients stay idle.
+
+The gateway runs in-process, so the reported CPU share covers both the server
+and the idle clients. Needs a running Redis server.
+
+Usage (from the repository root):
+    python -m benchmarks.idle_websockets --clients 500 --idle 10
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+import websockets
+import redis.asyncio as redis
+import websocket_server
+
+
+async def connect_clients(url, n):
+    clients = []
+    for _ in range(n):
+        session_id = uuid.uuid4().hex
+        ws = await websockets.connect(url)
+        await ws.send(session_id)
+        clients.append((session_id, ws))
+    return clients
+
+
+async def check_delivery(redis_url, clients):
+    session_id, ws = clients[0]
+    r = redis.from_url(redis_url)
+    msg = json.dumps({'event': 'tokens_arrived', 'data': 'ping'})
+    await r.publish(f'{websocket_server.TOKEN_STREAM}:{session_id}', msg)
+    received = await asyncio.wait_for(ws.recv(), timeout=5)
+    await r.aclose()
+    return received == msg
+
+
+async def run(n_clients, idle_seconds, redis_url, port):
+    server = asyncio.create_task(websocket_server.main("127.0.0.1", port, redis_url))
+    await asyncio.sleep(0.5)
+
+    clients = await connect_clients(f"ws://127.0.0.1:{port}", n_clients)
+    await asyncio.sleep(1)
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    await asyncio.sleep(idle_seconds)
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+
+    delivered = await check_delivery(redis_url, clients)
+
+    for _, ws in clients:
+        await ws.close()
+    server.cancel()
+
+    print(f"clients: {n_clients}")
+    print(f"idle wall time: {wall:.2f}s, cpu time: {cpu:.3f}s, cpu share: {100 * cpu / wall:.2f}%")
+    print(f"message delivered after idle period: {delivered}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Idle websocket clients load test")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--idle", type=float, default=10)
+    parser.add_argument("--redis-url", type=str, default="redis://localhost")
+    parser.add_argument("--port", type=int, default=9555)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.clients, args.idle, args.redis_url, args.port))
@@ -0,0 +1,167 @@
+"""Measures concurrent completion throughput of the LLM manager service (llm_services/llamacpp.py).
+
+The service is run in-process on top of a stub llama-server, which streams
+every /completion response at a fixed token rate and serves as many requests
+at once as the model has slots. N clients request completions at the same
+time, while another client calls /list-models. This is done with the
+single-threaded HTTPServer used before and with LLMServiceServer.
+
+Usage (from the repository root):
+    python -m benchmarks.llm_service_throughput --clients 1 4 16 --tokens 50 --rate 100
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from benchmarks.common import print_table
+
+
+class StubLlamaServer(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    num_tokens = 50
+    rate = 100
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        for i in range(self.num_tokens):
+            time.sleep(1 / self.rate)
+            self.send_event({"content": f" token{i}", "stop": False})
+        self.send_event({"content": "", "stop": True, "stopping_word": ""})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_event(self, entry):
+        event = f"data: {json.dumps(entry)}\n\n".encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+
+    def log_message(self, *args):
+        pass
+
+
+def run_stub(argv):
+    """Entry point of the stub, started by the service with llama-server arguments"""
+    port = int(argv[argv.index("--port") + 1])
+    StubLlamaServer.num_tokens = int(os.environ["STUB_TOKENS"])
+    StubLlamaServer.rate = float(os.environ["STUB_RATE"])
+    server = ThreadingHTTPServer(("localhost", port), StubLlamaServer)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def make_stub_executable(directory):
+    path = os.path.join(directory, "llama-server")
+    with open(path, "w") as f:
+        f.write(f'#!/bin/sh\nexec {sys.executable} -m benchmarks.llm_service_throughput --stub "$@"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def complete(url, model_id):
+    data = json.dumps({"prompt": "prompt", "model_id": model_id})
+    headers = {"Content-Type": "application/json", "Connection": "close"}
+    with requests.post(f"{url}/completion", data=data, headers=headers, stream=True) as resp:
+        return sum(1 for line in resp.iter_lines() if line)
+
+
+def run(server_class, handler_class, model_id, num_clients):
+    server = server_class(("127.0.0.1", 0), handler_class)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    control_latency = []
+
+    def call_control():
+        # issued once the completions have started streaming
+        time.sleep(0.05)
+        t0 = time.perf_counter()
+        requests.get(f"{url}/list-models", headers={"Connection": "close"})
+        control_latency.append(time.perf_counter() - t0)
+
+    clients = [threading.Thread(target=complete, args=(url, model_id)) for _ in range(num_clients)]
+    control = threading.Thread(target=call_control)
+
+    t0 = time.perf_counter()
+    for client in clients:
+        client.start()
+    control.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - t0
+    control.join()
+
+    server.shutdown()
+    server.server_close()
+    return elapsed, control_latency[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=100, help="tokens per second of every slot")
+    parser.add_argument("--stub", action="store_true", help=argparse.SUPPRESS)
+    args, rest = parser.parse_known_args()
+
+    if args.stub:
+        run_stub(rest)
+        return
+
+    from llm_services.llamacpp import llm_manager, HttpHandler, LLMServiceServer
+
+    class SingleThreadedServer(HTTPServer):
+        request_queue_size = 64
+
+    class QuietHandler(HttpHandler):
+        def log_message(self, *args):
+            pass
+
+    os.environ["STUB_TOKENS"] = str(args.tokens)
+    os.environ["STUB_RATE"] = str(args.rate)
+    directory = tempfile.mkdtemp()
+    model_path = os.path.join(directory, "model.gguf")
+    open(model_path, "wb").close()
+
+    llm_manager.setup(exec_path=make_stub_executable(directory), host="localhost", port=9700,
+                      parallel=max(args.clients))
+    model_id = llm_manager.start_model(model_path, {})
+
+    rows = []
+    # hides request logging of the service
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            # waits for the stub to come up
+            run(LLMServiceServer, QuietHandler, model_id, 1)
+
+            for num_clients in args.clients:
+                total_tokens = num_clients * (args.tokens + 1)
+                row = [num_clients]
+                for server_class in (SingleThreadedServer, LLMServiceServer):
+                    elapsed, control = run(server_class, QuietHandler, model_id, num_clients)
+                    row.extend([f"{total_tokens / elapsed:.0f}", f"{control * 1000:.0f}"])
+                rows.append(row)
+        finally:
+            llm_manager.pool.stop_all()
+            shutil.rmtree(directory)
+
+    print(f"{args.tokens} tokens per completion at {args.rate:.0f} tokens/s per slot")
+    print_table(("clients", "HTTPServer tok/s", "control ms", "threaded tok/s", "control ms"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Measures prompt rendering time of tool-using rounds on long chats.
+
+A chat of N messages gets several rounds of tool calls and results appended,
+and the prompt is rendered after every round, once with a fresh renderer per
+round (rendering the whole history) and once with a renderer reused across
+rounds, as Agent does.
+
+Usage (from the repository root):
+    python -m benchmarks.prompt_rendering --messages 50 200 1000
+"""
+import argparse
+
+from benchmarks.common import measure, print_table
+from pygentify.messages import JinjaChatFactory
+
+
+def make_history(factory, num_messages):
+    history = [factory.create_system_msg("You are a helpful assistant.")]
+    for i in range(num_messages // 2):
+        history.append(factory.create_user_msg(f"Question number {i}: " + "lorem ipsum " * 30))
+        history.append(factory.create_ai_msg(f"Answer number {i}: " + "dolor sit amet " * 40))
+    return history
+
+
+def run_rounds(factory, history, rounds, get_renderer):
+    history = list(history)
+    for i in range(rounds):
+        history.append(factory.create_tool_call("search", {"query": f"query {i}"}))
+        history.append(factory.create_tool_result("search", f"result {i}"))
+        get_renderer()(history, continue_gen=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    factory = JinjaChatFactory('llama3', None)
+
+    rows = []
+    for num_messages in args.messages:
+        history = make_history(factory, num_messages)
+
+        def fresh():
+            run_rounds(factory, history, args.rounds, factory.get_chat_renderer)
+
+        def cached():
+            renderer = factory.get_chat_renderer()
+            # the first render of the turn renders everything, later rounds only the delta
+            renderer(history)
+            run_rounds(factory, history, args.rounds, lambda: renderer)
+
+        full = measure(fresh, args.repeats)
+        incremental = measure(cached, args.repeats)
+        rows.append((num_messages, args.rounds, f"{full * 1000:.2f}", f"{incremental * 1000:.2f}"))
+
+    print_table(("messages", "rounds", "full ms", "incremental ms"), rows)
+
+
+if __name__ == "__main__":
+    main()
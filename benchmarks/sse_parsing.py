@@ -0,0 +1,97 @@
+"""Measures Python-side overhead of parsing streamed llama-server responses.
+
+A local fake llama-server streams a pre-recorded /completion response of N
+tokens as fast as it can (chunked transfer encoding, one event per chunk, like
+llama-server). The response is consumed with the byte-at-a-time iter_lines
+parser used before and with LlamaCpp.stream_response.
+
+Usage (from the repository root):
+    python -m benchmarks.sse_parsing --tokens 2000 10000
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from benchmarks.common import print_table
+from pygentify import http_client
+from pygentify.llm_backends import LlamaCpp, GenerationSpec, fast_json
+
+
+def record_response(num_tokens):
+    events = []
+    for i in range(num_tokens):
+        entry = {"content": f" token{i}", "stop": False, "id_slot": 0, "multimodal": False, "index": 0}
+        events.append(f"data: {json.dumps(entry)}\n\n".encode())
+
+    final = {"content": "", "stop": True, "stopping_word": "", "tokens_cached": num_tokens,
+             "timings": {"prompt_ms": 1.0, "predicted_n": num_tokens}}
+    events.append(f"data: {json.dumps(final)}\n\n".encode())
+    return events
+
+
+class FakeLlamaServer(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    events = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for event in self.events:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):
+        pass
+
+
+def byte_at_a_time(url):
+    resp = http_client.post(f"{url}/completion", data="{}", stream=True)
+    count = 0
+    for line in resp.iter_lines(chunk_size=1):
+        if line:
+            entry = json.loads(line.decode("utf-8")[6:])
+            count += 1
+            if entry["stop"]:
+                break
+    return count
+
+
+def buffered(url):
+    llm = LlamaCpp(url, GenerationSpec({}))
+    return sum(1 for _ in llm("prompt"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, nargs="+", default=[2000, 10000])
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeLlamaServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    rows = []
+    for num_tokens in args.tokens:
+        FakeLlamaServer.events = record_response(num_tokens)
+
+        results = []
+        for consume in (byte_at_a_time, buffered):
+            t0 = time.perf_counter()
+            consume(url)
+            results.append(num_tokens / (time.perf_counter() - t0))
+
+        rows.append((num_tokens, f"{results[0]:.0f}", f"{results[1]:.0f}", f"{results[1] / results[0]:.1f}x"))
+
+    print(f"json decoder: {fast_json.__name__}")
+    print_table(("tokens", "iter_lines tok/s", "buffered tok/s", "speedup"), rows)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
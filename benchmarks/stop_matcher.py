@@ -0,0 +1,64 @@
+"""Compares incremental stop detection of TextCompleter with rescanning the whole response per token.
+
+A synthetic code-heavy response of N tokens whose closing fence comes last is
+streamed through TextCompleter and through the previous implementation, which
+concatenated strings and called str.count on the full response for every token.
+
+Usage (from the repository root):
+    python -m benchmarks.stop_matcher --tokens 1000 10000
+"""
+import argparse
+
+from benchmarks.common import measure, print_table
+from pygentify.completion import TextCompleter
+
+CODE_TOKENS = ["def", " f", "(x", "):", "\n   ", " return", " x", " *", " `", "2", "`", "\n"]
+
+
+def make_tokens(num_tokens):
+    body = [CODE_TOKENS[i % len(CODE_TOKENS)] for i in range(num_tokens - 2)]
+    return ["Here:\n```python\n"] + body + ["```", " done"]
+
+
+def finilize_response(text, token):
+    suffix = ""
+    for ch in token:
+        if not text.endswith("```"):
+            text += ch
+            suffix += ch
+
+    return text, suffix
+
+
+def rescanning_completion(tokens, stop_token="```"):
+    raw_response = ""
+    for token in tokens:
+        if (raw_response + token).count(stop_token) == 2:
+            raw_response, _ = finilize_response(raw_response, token)
+            break
+        raw_response += token
+    return raw_response
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = []
+    for num_tokens in args.tokens:
+        tokens = make_tokens(num_tokens)
+        completer = TextCompleter(lambda input_text: iter(tokens))
+
+        assert completer("") == rescanning_completion(tokens)
+
+        old = measure(lambda: rescanning_completion(tokens), args.repeats)
+        new = measure(lambda: completer(""), args.repeats)
+        rows.append((num_tokens, f"{old * 1000:.2f}", f"{new * 1000:.2f}", f"{old / new:.1f}x"))
+
+    print_table(("tokens", "rescan ms", "incremental ms", "speedup"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Measures Redis publish rate and token latency of ProcessorDevice for different coalescing windows.
+
+A synthetic token stream is fed into ProcessorDevice at a fixed rate while a
+subscriber on the same channel records when every token becomes visible to a
+client. Redis ops are counted with INFO commandstats. Needs a running Redis server.
+
+Usage (from the repository root):
+    SECRET_KEY_PATH=... python -m benchmarks.token_coalescing --tokens 500 --rate 200
+"""
+import argparse
+import json
+import threading
+import time
+import redis
+
+from benchmarks.common import setup_django, print_table
+
+TEXT = ("The quick brown fox jumps over the lazy dog, and then it runs back home "
+        "to tell everyone about it. Nobody believes the story! Why would they? ")
+
+
+class NullSentenceProcessor:
+    def process_sentence(self, sentence):
+        pass
+
+
+def make_tokens(num_tokens):
+    words = (TEXT * (num_tokens // 20 + 1)).split(' ')
+    return [' ' + word for word in words[:num_tokens]]
+
+
+def publish_calls(r):
+    return r.info('commandstats').get('cmdstat_publish', {}).get('calls', 0)
+
+
+def run(r, window, max_bytes, tokens, rate):
+    from django.test import override_settings
+    from chats.tasks import ProcessorDevice
+
+    channel = f'token_stream:benchmark-{window}-{max_bytes}'
+    received = []
+
+    pubsub = r.pubsub()
+    pubsub.subscribe(channel)
+    pubsub.get_message(timeout=1)
+
+    def listen():
+        total = 0
+        while total < sum(map(len, tokens)):
+            message = pubsub.get_message(timeout=5)
+            if message is None:
+                break
+            if message['type'] == 'message':
+                total += len(json.loads(message['data'])['data'])
+                received.append((total, time.perf_counter()))
+
+    listener = threading.Thread(target=listen)
+    listener.start()
+
+    with override_settings(TOKEN_COALESCE_WINDOW=window, TOKEN_COALESCE_MAX_BYTES=max_bytes):
+        device = ProcessorDevice(r, channel, NullSentenceProcessor())
+
+    produced = []
+    calls_before = publish_calls(r)
+    t0 = time.perf_counter()
+    offset = 0
+    for i, token in enumerate(tokens):
+        # pace tokens like a model generating at a steady rate
+        delay = t0 + i / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        offset += len(token)
+        produced.append((offset, time.perf_counter()))
+        device.on_token(token)
+    device.flush()
+    elapsed = time.perf_counter() - t0
+
+    listener.join()
+    pubsub.close()
+    # INFO itself is not counted, SUBSCRIBE/UNSUBSCRIBE are not PUBLISH calls
+    publishes = publish_calls(r) - calls_before
+
+    latencies = []
+    frames = iter(received)
+    frame_end, frame_time = next(frames)
+    for token_end, token_time in produced:
+        while frame_end < token_end:
+            frame_end, frame_time = next(frames)
+        latencies.append(frame_time - token_time)
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    return publishes, publishes / elapsed, p50, p99
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--tokens", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=200, help="tokens per second")
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 0.02, 0.05, 0.1, 0.25])
+    parser.add_argument("--max-bytes", type=int, default=512)
+    args = parser.parse_args()
+
+    setup_django()
+    r = redis.Redis(host=args.redis_host)
+    tokens = make_tokens(args.tokens)
+
+    rows = []
+    for window in args.windows:
+        publishes, ops, p50, p99 = run(r, window, args.max_bytes, tokens, args.rate)
+        rows.append((f"{window * 1000:.0f}", args.max_bytes, publishes, f"{ops:.0f}",
+                     f"{p50 * 1000:.2f}", f"{p99 * 1000:.2f}"))
+
+    print(f"{args.tokens} tokens at {args.rate:.0f} tokens/s")
+    print_table(("window ms", "max bytes", "publishes", "publish/s", "p50 ms", "p99 ms"), rows)
+
+
+if __name__ == "__main__":
+    main()
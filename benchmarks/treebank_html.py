@@ -0,0 +1,73 @@
+"""Compares treebank serialization with markdown rendered on every read against stored html.
+
+Usage (from the repository root):
+    SECRET_KEY_PATH=<path> python -m benchmarks.treebank_html
+"""
+import argparse
+import random
+from benchmarks.common import setup_django, measure, print_table
+
+sample_text = """Here is the code:
+```python
+for i in range(5):
+    print('hello world')
+```
+It prints **hello world** five times. See [docs](https://docs.python.org) for `range`.
+"""
+
+
+def build_tree(user, size):
+    from chats.models import Message, Chat
+
+    root = Message.objects.create(text=sample_text)
+    Chat.objects.create(user=user, prompt=root)
+
+    nodes = [root]
+    for _ in range(size - 1):
+        parent = random.choice(nodes)
+        nodes.append(Message.objects.create(text=sample_text, parent=parent))
+    return root
+
+
+def main(sizes, repeats):
+    from django.contrib.auth.models import User
+    from chats.serializers import TreebankSerializer, TreebankReplySerializer
+    from chats.utils import render_message_html
+
+    class RenderingReplySerializer(TreebankReplySerializer):
+        def get_html(self, obj):
+            return render_message_html(obj.text)
+
+    class RenderingTreebankSerializer(TreebankSerializer):
+        reply_serializer_class = RenderingReplySerializer
+
+    user = User.objects.create_user(username="bench", password="bench")
+    random.seed(0)
+
+    rows = []
+    for size in sizes:
+        root = build_tree(user, size)
+
+        def stored_html():
+            return TreebankSerializer(root).data
+
+        def rendered_html():
+            return RenderingTreebankSerializer(root).data
+
+        rows.append((
+            size,
+            f"{measure(rendered_html, repeats) * 1000:.2f}",
+            f"{measure(stored_html, repeats) * 1000:.2f}"
+        ))
+
+    print_table(("messages", "render per read ms", "stored html ms"), rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark treebank serialization with stored html")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    setup_django()
+    main(args.sizes, args.repeats)
@@ -0,0 +1,82 @@
+"""Measures time to first audio and audio lag of the TTS pipeline for different concurrency limits.
+
+Sentences are queued at a fixed rate, as the token stream completes them, and
+are synthesized by a TTS backend with a fixed latency. Samples are saved as
+SpeechSample rows and files, as in production. Events go nowhere.
+
+Usage (from the repository root):
+    SECRET_KEY_PATH=... python -m benchmarks.tts_pipeline --sentences 20 --interval 0.3 --latency 1.0
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from queue import Queue
+
+from benchmarks.common import setup_django, print_table
+
+
+class NullBus:
+    def publish(self, channel, payload):
+        pass
+
+
+class LatencyTtsBackend:
+    def __init__(self, audio_file, latency):
+        with open(audio_file, "rb") as f:
+            self.audio = f.read()
+        self.latency = latency
+
+    def synthesize(self, text, voice_id):
+        time.sleep(self.latency)
+        return self.audio
+
+
+def run(concurrency, num_sentences, interval):
+    from django.test import override_settings
+    from chats.tasks import Consumer
+
+    voice_id = f'voice-{concurrency}'
+    with override_settings(TTS_CONCURRENCY=concurrency, EVENT_TRANSPORT="pubsub"):
+        queue = Queue()
+        consumer = Consumer(queue, NullBus(), 'benchmark', voice_id)
+        consumer.start()
+        for i in range(num_sentences):
+            time.sleep(interval)
+            queue.put(f'Sentence number {i}.')
+        queue.put('')
+        consumer.join()
+    return consumer.stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sentences", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.3, help="seconds between sentences")
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds to synthesize a sentence")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    setup_django()
+    import tts
+    from django.test import override_settings
+
+    tts.tts_backend = LatencyTtsBackend("test_data/sample.wav", args.latency)
+
+    media_root = tempfile.mkdtemp()
+    rows = []
+    try:
+        with override_settings(MEDIA_ROOT=media_root):
+            for concurrency in args.concurrency:
+                stats = run(concurrency, args.sentences, args.interval)
+                rows.append((concurrency, f"{stats['time_to_first_audio']:.2f}",
+                             f"{stats['mean_lag']:.2f}", f"{stats['max_lag']:.2f}"))
+    finally:
+        shutil.rmtree(media_root)
+
+    print(f"{args.sentences} sentences every {args.interval:.2f} s, {args.latency:.2f} s of synthesis each")
+    print_table(("concurrency", "first audio s", "mean lag s", "max lag s"), rows)
+
+
+if __name__ == "__main__":
+    main()
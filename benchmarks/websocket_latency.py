@@ -0,0 +1,126 @@
+"""Measures token delivery latency through the websocket gateway for different worker counts.
+
+For every worker count the gateway is started as a separate process. Client
+processes open sockets, publish synthetic token streams into Redis for their
+sessions and record the time from publishing a token to receiving it.
+Needs a running Redis server.
+
+Usage (from the repository root):
+    python -m benchmarks.websocket_latency --workers 1 2 4 --sockets 400 --tokens 100
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+import websockets
+import redis.asyncio as redis
+
+TOKEN_STREAM = "token_stream"
+
+
+async def stream_tokens(r, session_id, ws, num_tokens, interval):
+    latencies = []
+    channel = f'{TOKEN_STREAM}:{session_id}'
+
+    async def receive():
+        for _ in range(num_tokens):
+            msg = json.loads(await ws.recv())
+            latencies.append(time.time() - msg['sent_at'])
+
+    receiver = asyncio.create_task(receive())
+    for i in range(num_tokens):
+        msg = {'event': 'tokens_arrived', 'data': f'token{i} ', 'sent_at': time.time()}
+        await r.publish(channel, json.dumps(msg))
+        await asyncio.sleep(interval)
+
+    await asyncio.wait_for(receiver, timeout=60)
+    return latencies
+
+
+async def run_clients(url, redis_url, num_sockets, num_tokens, interval):
+    r = redis.from_url(redis_url)
+
+    sessions = []
+    for _ in range(num_sockets):
+        session_id = uuid.uuid4().hex
+        ws = await websockets.connect(url, max_queue=None)
+        await ws.send(session_id)
+        sessions.append((session_id, ws))
+
+    # give the gateway time to register sessions
+    await asyncio.sleep(1)
+
+    results = await asyncio.gather(*[stream_tokens(r, session_id, ws, num_tokens, interval)
+                                     for session_id, ws in sessions])
+    for _, ws in sessions:
+        await ws.close()
+    await r.aclose()
+    return [latency for latencies in results for latency in latencies]
+
+
+def client_process(args):
+    return asyncio.run(run_clients(*args))
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise Exception(f"Gateway did not start listening on port {port}")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure(num_workers, args):
+    cmd = [sys.executable, "websocket_server.py", "--port", str(args.port),
+           "--redis-host", args.redis_host, "--workers", str(num_workers), "--log-level", "WARNING"]
+    server = subprocess.Popen(cmd)
+    try:
+        wait_for_port(args.port)
+        time.sleep(1)
+
+        url = f"ws://127.0.0.1:{args.port}"
+        redis_url = f"redis://{args.redis_host}"
+        per_process = args.sockets // args.client_processes
+        job = (url, redis_url, per_process, args.tokens, args.interval)
+
+        with multiprocessing.Pool(args.client_processes) as pool:
+            results = pool.map(client_process, [job] * args.client_processes)
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = [latency * 1000 for chunk in results for latency in chunk]
+    return (num_workers, len(latencies),
+            f"{statistics.median(latencies):.2f}", f"{percentile(latencies, 99):.2f}")
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, ".")
+    from benchmarks.common import print_table
+
+    parser = argparse.ArgumentParser(description="Websocket gateway token latency benchmark")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--sockets", type=int, default=400)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--interval", type=float, default=0.02, help="seconds between tokens of one stream")
+    parser.add_argument("--client-processes", type=int, default=4)
+    parser.add_argument("--redis-host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=9558)
+    args = parser.parse_args()
+
+    rows = [measure(num_workers, args) for num_workers in args.workers]
+    print_table(("workers", "tokens", "p50 ms", "p99 ms"), rows)
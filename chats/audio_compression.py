@@ -0,0 +1,133 @@
+"""Compressed copies of speech audio.
+
+Speech samples and message audio are written as WAV. When AUDIO_COMPRESSION_ENABLED
+is set, they are encoded by AUDIO_COMPRESSION_COMMAND (Opus in an Ogg container
+with ffmpeg by default) on a pool of background threads of the process which saved
+them, and the compressed copy is served in place of the original from then on.
+WAV originals are deleted AUDIO_WAV_RETENTION_DAYS after they were made by the
+compress_audio management command, except those of cached speech samples, which
+are still concatenated into message audio.
+"""
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+from .models import Message, SpeechSample
+
+EXTENSION = "ogg"
+
+HAS_AUDIO = Q(audio__isnull=False) & ~Q(audio='')
+HAS_COMPRESSED_COPY = Q(audio_compressed__isnull=False) & ~Q(audio_compressed='')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=settings.AUDIO_COMPRESSION_WORKERS,
+                                       thread_name_prefix='audio-compression')
+        return _pool
+
+
+def schedule(instance):
+    """Compresses audio of a saved SpeechSample or Message in the background.
+
+    Returns a future of the compressed file name, or None when compression is disabled.
+    """
+    if not settings.AUDIO_COMPRESSION_ENABLED or not instance.audio:
+        return None
+    return get_pool().submit(_compress_in_background, instance)
+
+
+def _compress_in_background(instance):
+    # pool threads outlive requests and tasks, so they drop stale connections themselves
+    close_old_connections()
+    return compress(instance)
+
+
+def encode(input_path, output_path):
+    command = [arg.format(input=input_path, output=output_path)
+               for arg in settings.AUDIO_COMPRESSION_COMMAND]
+    subprocess.run(command, check=True, capture_output=True, timeout=settings.AUDIO_COMPRESSION_TIMEOUT)
+
+
+def compress(instance):
+    """Writes a compressed copy of the audio of an instance and stores its name.
+
+    Returns the name, or None when the audio could not be encoded.
+    """
+    if instance.audio_compressed:
+        return instance.audio_compressed.name
+
+    field = instance._meta.get_field('audio_compressed')
+    stem, _ = os.path.splitext(os.path.basename(instance.audio.name))
+    name = field.storage.get_available_name(field.generate_filename(instance, f'{stem}.{EXTENSION}'))
+    path = field.storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    try:
+        encode(instance.audio.path, path)
+    except (OSError, subprocess.SubprocessError) as e:
+        stderr = getattr(e, 'stderr', None)
+        details = stderr.decode(errors='replace').strip() if stderr else e
+        print(f'Failed to compress audio of {type(instance).__name__} {instance.pk}: {details}')
+        field.storage.delete(name)
+        return None
+
+    if not type(instance).objects.filter(pk=instance.pk).update(audio_compressed=name):
+        # deleted while being encoded, e.g. evicted from the speech cache
+        field.storage.delete(name)
+        return None
+
+    instance.audio_compressed.name = name
+    return name
+
+
+def uncompressed(model):
+    return model.objects.filter(HAS_AUDIO).exclude(HAS_COMPRESSED_COPY)
+
+
+def compress_pending():
+    """Compresses all audio which has no compressed copy yet, one file at a time.
+
+    Returns the number of compressed files.
+    """
+    compressed = 0
+    for model in (SpeechSample, Message):
+        for instance in uncompressed(model).only('pk', 'audio', 'audio_compressed').iterator():
+            if compress(instance):
+                compressed += 1
+    return compressed
+
+
+def prune_originals():
+    """Deletes WAV originals which have a compressed copy and are older than AUDIO_WAV_RETENTION_DAYS.
+
+    Returns the number of deleted files.
+    """
+    days = settings.AUDIO_WAV_RETENTION_DAYS
+    if days is None:
+        return 0
+
+    made_before = timezone.now() - timedelta(days=days)
+    expired = [
+        Message.objects.filter(HAS_AUDIO, HAS_COMPRESSED_COPY, date_time__lt=made_before),
+        SpeechSample.objects.filter(HAS_AUDIO, HAS_COMPRESSED_COPY, date_time__lt=made_before,
+                                    cache_key__isnull=True)
+    ]
+
+    pruned = 0
+    for queryset in expired:
+        for instance in queryset.only('pk', 'audio').iterator():
+            instance.audio.delete(save=False)
+            type(instance).objects.filter(pk=instance.pk).update(audio='')
+            pruned += 1
+    return pruned
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from chats.models import Message
+
+
+class Command(BaseCommand):
+    help = "Render and store html of messages whose stored html is missing or outdated"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        messages = Message.objects.only("id", "text", "html", "html_key").order_by("pk")
+
+        batch = []
+        updated = 0
+        for message in messages.iterator(chunk_size=batch_size):
+            if message.refresh_html():
+                batch.append(message)
+
+            if len(batch) >= batch_size:
+                updated += self.flush(batch)
+
+        updated += self.flush(batch)
+        self.stdout.write(self.style.SUCCESS(f"Rendered html of {updated} message(s)"))
+
+    def flush(self, batch):
+        count = len(batch)
+        if batch:
+            Message.objects.bulk_update(batch, ["html", "html_key"])
+            batch.clear()
+        return count
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from chats import audio_compression
+
+
+class Command(BaseCommand):
+    help = ("Compress speech and message audio which has no compressed copy yet "
+            "and delete WAV originals older than AUDIO_WAV_RETENTION_DAYS")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--no-prune", action="store_true", help="keep all WAV originals")
+
+    def handle(self, *args, **options):
+        compressed = audio_compression.compress_pending()
+        pruned = 0 if options["no_prune"] else audio_compression.prune_originals()
+        self.stdout.write(self.style.SUCCESS(
+            f"Compressed {compressed} audio file(s), deleted {pruned} WAV original(s)"
+        ))
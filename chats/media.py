@@ -0,0 +1,195 @@
+import base64
+import hashlib
+import io
+import os
+import mimetypes
+import re
+from PIL import Image
+from django.conf import settings
+from django.core.cache import caches
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse, Http404
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag, http_date, parse_http_date_safe
+
+
+IMAGE_MODE_INLINE = "inline"
+IMAGE_MODE_THUMBNAIL = "thumbnail"
+IMAGE_MODE_URL = "url"
+
+IMAGE_MODES = [IMAGE_MODE_INLINE, IMAGE_MODE_THUMBNAIL, IMAGE_MODE_URL]
+
+
+def file_digest(field_file):
+    """Returns a pair (sha256 hex digest, size in bytes) of the file content"""
+    opened_here = field_file.closed
+
+    sha256 = hashlib.sha256()
+    size = 0
+    for chunk in field_file.chunks():
+        sha256.update(chunk)
+        size += len(chunk)
+
+    if opened_here:
+        field_file.close()
+    return sha256.hexdigest(), size
+
+
+def media_cache():
+    return caches[settings.MEDIA_CACHE_ALIAS]
+
+
+def cached_data_uri(image, digest, thumbnail=False):
+    """Returns a data URI of an image (or of its thumbnail) cached under the image content hash"""
+    kind = IMAGE_MODE_THUMBNAIL if thumbnail else IMAGE_MODE_INLINE
+    key = f'image-data-uri:{kind}:{digest}'
+    cache = media_cache()
+
+    data_uri = cache.get(key)
+    if data_uri is None:
+        data_uri = make_thumbnail_uri(image) if thumbnail else make_data_uri(image)
+        cache.set(key, data_uri, timeout=None)
+    return data_uri
+
+
+def make_data_uri(image):
+    with open(image.path, "rb") as f:
+        data = f.read()
+
+    _, extension = os.path.splitext(image.path)
+    extension = extension[1:]
+    return encode_data_uri(data, extension)
+
+
+def make_thumbnail_uri(image):
+    with Image.open(image.path) as img:
+        img.thumbnail(settings.MESSAGE_IMAGE_THUMBNAIL_SIZE)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=85)
+    return encode_data_uri(buffer.getvalue(), "jpeg")
+
+
+def encode_data_uri(data, extension):
+    image_b64_string = base64.b64encode(data).decode('utf-8')
+    return f"data:image/{extension};base64,{image_b64_string}"
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+    """Returns the first and the last byte of a single range of the Range header.
+
+    Returns None when the whole file should be sent: the header is malformed
+    or asks for several ranges, which are not supported.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+    if not first:
+        # the last bytes of the file
+        length = int(last)
+        if not length or not size:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable()
+    last = int(last) if last else size - 1
+    return first, min(last, size - 1)
+
+
+def if_range_matches(request, etag, last_modified):
+    """Tells if a range may be sent: If-Range is missing or matches the current file"""
+    if_range = request.headers.get('If-Range')
+    if if_range is None:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        # weak validators never match
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def read_range(file, length, block_size=FileResponse.block_size):
+    try:
+        while length > 0:
+            data = file.read(min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        file.close()
+
+
+def serve_file(request, field_file, content_type=None, digest=None):
+    """Responds with a stored file.
+
+    When MEDIA_X_ACCEL_REDIRECT_PREFIX is set, the file is handed off to nginx
+    through X-Accel-Redirect, which also answers range requests; otherwise it
+    is streamed by django, whole or the single byte range of a Range header.
+    Responses carry an ETag and Last-Modified and may be answered with
+    304 Not Modified. The ETag of files named by their content digest is the
+    digest, and such files are cached by browsers for good.
+    """
+    storage = field_file.storage
+    try:
+        size = storage.size(field_file.name)
+        last_modified = int(storage.get_modified_time(field_file.name).timestamp())
+    except FileNotFoundError:
+        raise Http404()
+
+    etag = quote_etag(digest or f'{last_modified:x}-{size:x}')
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content_type = content_type or mimetypes.guess_type(field_file.name)[0] or 'application/octet-stream'
+        response = make_file_response(request, field_file, content_type, size, etag, last_modified)
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if digest:
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
+def make_file_response(request, field_file, content_type, size, etag, last_modified):
+    prefix = settings.MEDIA_X_ACCEL_REDIRECT_PREFIX
+    if prefix:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = prefix + field_file.name
+        return response
+
+    byte_range = None
+    range_header = request.headers.get('Range')
+    if range_header and if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    if byte_range is None:
+        response = FileResponse(field_file.open('rb'), content_type=content_type)
+    else:
+        first, last = byte_range
+        file = field_file.open('rb')
+        file.seek(first)
+        response = StreamingHttpResponse(read_range(file, last - first + 1), status=206,
+                                         content_type=content_type)
+        response['Content-Length'] = str(last - first + 1)
+        response['Content-Range'] = f'bytes {first}-{last}/{size}'
+
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 05:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0025_alter_message_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='image_sha256',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='image_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
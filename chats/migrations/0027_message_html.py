@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 05:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0026_message_image_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='html',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='html_key',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0027_message_html'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='speechsample',
+            name='cache_key',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='speechsample',
+            name='last_used',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='speechsample',
+            name='size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='speechsample',
+            name='voice_id',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0028_speechsample_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='audio_compressed',
+            field=models.FileField(blank=True, null=True, upload_to='uploads/audio'),
+        ),
+        migrations.AddField(
+            model_name='speechsample',
+            name='audio_compressed',
+            field=models.FileField(blank=True, null=True, upload_to='uploads/audio'),
+        ),
+    ]
@@ -1,7 +1,12 @@
 from django.db import models
+from django.db.models import Q, Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.expressions import RawSQL
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.contrib.auth.models import User
 from rest_framework.reverse import reverse
+from .media import file_digest
+from .utils import render_message_html, message_html_key
 
 
 class SystemMessage(models.Model):
@@ -82,8 +87,120 @@ class Chat(models.Model):
     date_time = models.DateTimeField(auto_now_add=True, blank=True)
 
 
+class MessageQuerySet(models.QuerySet):
+    def ancestors_of(self, message_id):
+        """Filter messages lying on the path from the root to a given message (inclusive)"""
+        return self.filter(pk__in=RawSQL(branch_path_sql(), [message_id]))
+
+    def branch(self, message):
+        """Load the whole root-to-leaf path ending with the given message in a single query.
+
+        Messages come back ordered from the root to the leaf, with the chat and
+        its configuration already attached to the root message.
+        """
+        message_id = getattr(message, 'pk', message)
+        path = self.ancestors_of(message_id).select_related('chat__configuration')
+        by_id = {msg.pk: msg for msg in path}
+
+        history = []
+        msg = by_id.get(message_id)
+        while msg is not None:
+            history.append(msg)
+            msg = by_id.get(msg.parent_id)
+
+        history.reverse()
+        for parent, child in zip(history, history[1:]):
+            child.parent = parent
+        return history
+
+    def descendants_of(self, message_id):
+        """Filter messages of the subtree rooted at a given message (inclusive)"""
+        return self.filter(pk__in=RawSQL(subtree_sql(), [message_id]))
+
+    def tree(self, message):
+        """Load every message of the subtree rooted at the given message.
+
+        Returns a list ordered by primary key (the root goes first). Attachments are
+        prefetched, so the query count stays fixed regardless of the size of the tree.
+        """
+        message_id = getattr(message, 'pk', message)
+        subtree = self.descendants_of(message_id).select_related('chat').prefetch_related('attachments')
+        return list(subtree.order_by('pk'))
+
+    def with_tree_counts(self):
+        """Annotate messages with the number of replies, siblings and their position among siblings"""
+        siblings = Message.objects.filter(parent=OuterRef('parent')).order_by().values('parent')
+        earlier_siblings = siblings.filter(pk__lt=OuterRef('pk'))
+        return self.annotate(
+            replies_count=Count('replies'),
+            siblings_count=Coalesce(Subquery(siblings.annotate(n=Count('pk')).values('n')), 1),
+            branch_index=Coalesce(Subquery(earlier_siblings.annotate(n=Count('pk')).values('n')), 0)
+        )
+
+    def active_branch(self, message):
+        """Load the branch going through a given message.
+
+        The branch starts at the root, goes through the message and continues down
+        following the earliest reply at every level (the same choice the client makes
+        by default). Messages are annotated with tree counts (see with_tree_counts).
+        """
+        message_id = getattr(message, 'pk', message)
+        in_branch = (Q(pk__in=RawSQL(branch_path_sql(), [message_id])) |
+                     Q(pk__in=RawSQL(first_replies_sql(), [message_id])))
+        branch = self.filter(in_branch).with_tree_counts().select_related('chat')
+        by_parent = {msg.parent_id: msg for msg in branch.prefetch_related('attachments')}
+
+        history = []
+        msg = by_parent.get(None)
+        while msg is not None:
+            history.append(msg)
+            msg = by_parent.get(msg.pk)
+        return history
+
+
+def branch_path_sql():
+    table = Message._meta.db_table
+    return f"""
+        WITH RECURSIVE branch_path(id, parent_id) AS (
+            SELECT id, parent_id FROM {table} WHERE id = %s
+            UNION ALL
+            SELECT m.id, m.parent_id FROM {table} m
+            INNER JOIN branch_path ON m.id = branch_path.parent_id
+        )
+        SELECT id FROM branch_path
+    """
+
+
+def subtree_sql():
+    table = Message._meta.db_table
+    return f"""
+        WITH RECURSIVE subtree(id) AS (
+            SELECT id FROM {table} WHERE id = %s
+            UNION ALL
+            SELECT m.id FROM {table} m
+            INNER JOIN subtree ON m.parent_id = subtree.id
+        )
+        SELECT id FROM subtree
+    """
+
+
+def first_replies_sql():
+    table = Message._meta.db_table
+    return f"""
+        WITH RECURSIVE first_replies(id) AS (
+            SELECT id FROM {table} WHERE id = %s
+            UNION ALL
+            SELECT (SELECT MIN(m.id) FROM {table} m WHERE m.parent_id = first_replies.id)
+            FROM first_replies WHERE first_replies.id IS NOT NULL
+        )
+        SELECT id FROM first_replies WHERE id IS NOT NULL
+    """
+
+
 class Message(models.Model):
     text = models.CharField(max_length=8000)
+    html = models.TextField(blank=True, null=True)
+    html_key = models.CharField(max_length=40, blank=True, null=True)
     parent = models.ForeignKey('Message', related_name='replies', on_delete=models.CASCADE, 
                                blank=True, null=True)
 
@@ -92,22 +209,71 @@ class Message(models.Model):
     date_time = models.DateTimeField(auto_now_add=True, blank=True)
 
     audio = models.FileField(upload_to="uploads/audio", blank=True, null=True)
+    # see chats.audio_compression
+    audio_compressed = models.FileField(upload_to="uploads/audio", blank=True, null=True)
 
     image = models.ImageField(upload_to="uploads/chat_images", blank=True, null=True)
+    image_sha256 = models.CharField(max_length=64, blank=True, null=True)
+    image_size = models.PositiveIntegerField(blank=True, null=True)
 
     attachments_text = models.TextField(max_length=100000, blank=True, null=True)
 
+    objects = MessageQuerySet.as_manager()
+
+    # name of the image file image_sha256 was computed for
+    digested_image_name = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # deferred fields are not loaded here
+        if {'image', 'image_sha256'} <= set(field_names) and instance.image_sha256:
+            instance.digested_image_name = instance.image.name
+        return instance
+
+    def save(self, *args, **kwargs):
+        if not self.image:
+            self.image_sha256 = self.image_size = None
+        elif not self.image_sha256 or self.image.name != self.digested_image_name:
+            self.image_sha256, self.image_size = file_digest(self.image)
+        self.refresh_html()
+        super().save(*args, **kwargs)
+        # the file of a new image gets its final name when it is saved
+        self.digested_image_name = self.image.name if self.image else None
+
+    def refresh_html(self):
+        """Render html from text unless the stored one is up to date. Returns True when re-rendered"""
+        key = message_html_key(self.text)
+        if self.html is not None and self.html_key == key:
+            return False
+
+        self.html = render_message_html(self.text)
+        self.html_key = key
+        return True
+
+    def get_html(self):
+        """Returns rendered html, storing it for messages saved before html was kept in the database"""
+        if self.refresh_html() and self.pk:
+            Message.objects.filter(pk=self.pk).update(html=self.html, html_key=self.html_key)
+        return self.html
+
+    def ensure_image_digest(self):
+        """Compute and store the image digest of a message saved before digests existed"""
+        if self.image and not self.image_sha256:
+            self.image_sha256, self.image_size = file_digest(self.image)
+            self.digested_image_name = self.image.name
+            Message.objects.filter(pk=self.pk).update(image_sha256=self.image_sha256,
+                                                       image_size=self.image_size)
+
     @property
     def human_produced(self):
         return self.generation_details is None
 
     @property
     def initial_prompt(self):
-        message = self
-        while message.parent:
-            message = message.parent
-        
-        return message
+        if self.parent_id is None:
+            return self
+        return Message.objects.ancestors_of(self.pk).get(parent__isnull=True)
 
     @property
     def siblings(self):
@@ -116,14 +282,23 @@ class Message(models.Model):
         
         return self.parent.replies.all()
 
-    def get_chat(self):
-        return self._get_chat(msg=self)
+    def get_image_url(self):
+        return reverse('message-image', args=[self.pk])
+
+    def get_audio_url(self):
+        return reverse('message-audio', args=[self.pk])
 
-    def _get_chat(self, msg):
-        try:
-            return msg.chat
-        except Message.chat.RelatedObjectDoesNotExist:
-            return self._get_chat(msg.parent)
+    @property
+    def playable_audio(self):
+        """The compressed copy of the audio when there is one, otherwise the WAV original"""
+        return self.audio_compressed or self.audio
+
+    def get_chat(self):
+        if self.parent_id is None:
+            return self.chat
+        return Chat.objects.select_related('configuration').get(
+            prompt__in=Message.objects.ancestors_of(self.pk)
+        )
 
 
 class Attachment(models.Model):
@@ -139,10 +314,22 @@ class Attachment(models.Model):
 class SpeechSample(models.Model):
     text = models.CharField(max_length=1024)
     audio = models.FileField(upload_to="uploads/audio")
+    audio_compressed = models.FileField(upload_to="uploads/audio", blank=True, null=True)
     date_time = models.DateTimeField(auto_now_add=True, blank=True)
 
+    # samples with a cache key are reused for the same voice and text, see chats.tts_cache
+    voice_id = models.CharField(max_length=100, blank=True, null=True)
+    cache_key = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+    size = models.PositiveIntegerField(blank=True, null=True)
+    last_used = models.DateTimeField(blank=True, null=True, db_index=True)
+
     def __str__(self) -> str:
         return self.text
 
     def get_absolute_url(self):
         return reverse('speechsample-detail', args=[self.pk])
+
+    @property
+    def playable_audio(self):
+        """The compressed copy of the audio when there is one, otherwise the WAV original"""
+        return self.audio_compressed or self.audio
@@ -1,13 +1,14 @@
-import re
-import base64
-import os
-import markdown
 import bleach
+from django.conf import settings
 from rest_framework import serializers
 from .models import SystemMessage, Preset, Configuration, Chat, Message, Attachment, SpeechSample
+from . import media
+from .utils import clean_message_text
 
 
 class SpeechSampleSerializer(serializers.ModelSerializer):
+    audio = serializers.FileField(source='playable_audio', read_only=True)
+
     class Meta:
         model = SpeechSample
         fields = ['id', 'text', 'audio']
@@ -79,12 +80,44 @@ class AttachmentSerializer(serializers.ModelSerializer):
         read_only_fields = ['original_name', 'file', 'message']
 
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageImageMixin:
+    """Serializes the image of a message either inline (full image or thumbnail) or by reference.
+
+    The mode comes from the "image_mode" query parameter and defaults to MESSAGE_IMAGE_MODE.
+    """
+    def get_image_b64(self, obj):
+        mode = self.get_image_mode()
+        if not obj.image or mode == media.IMAGE_MODE_URL:
+            return None
+
+        obj.ensure_image_digest()
+        thumbnail = (mode == media.IMAGE_MODE_THUMBNAIL)
+        return media.cached_data_uri(obj.image, obj.image_sha256, thumbnail=thumbnail)
+
+    def get_image_ref(self, obj):
+        if not obj.image:
+            return None
+
+        obj.ensure_image_digest()
+        return {
+            'url': obj.get_image_url(),
+            'sha256': obj.image_sha256,
+            'size': obj.image_size
+        }
+
+    def get_image_mode(self):
+        request = self.context.get('request')
+        mode = request and request.query_params.get('image_mode')
+        return mode if mode in media.IMAGE_MODES else settings.MESSAGE_IMAGE_MODE
+
+
+class MessageSerializer(MessageImageMixin, serializers.ModelSerializer):
     chat = serializers.PrimaryKeyRelatedField(many=False, required=False, queryset=Chat.objects.all())
 
     clean_text = serializers.SerializerMethodField()
     html = serializers.SerializerMethodField()
     image_b64 = serializers.SerializerMethodField()
+    image_ref = serializers.SerializerMethodField()
     attachments = serializers.ListField(
         child=serializers.FileField(max_length=None, allow_empty_file=True),
         allow_empty=True, min_length=None, max_length=None, write_only=True, required=False)
@@ -93,34 +126,29 @@ class MessageSerializer(serializers.ModelSerializer):
 
     attached_files = serializers.SerializerMethodField()
 
+    audio = serializers.SerializerMethodField()
+
     class Meta:
         model = Message
         fields = ['id', 'text', 'clean_text', 'html', 'date_time',
                   'generation_details', 'parent', 'replies', 'chat',
-                  'audio', 'image', 'image_b64', 'attachments', 'attached_files', 'relative_paths']
+                  'audio', 'image', 'image_b64', 'image_ref',
+                  'attachments', 'attached_files', 'relative_paths']
         read_only_fields = ['replies', 'audio']
 
     def get_clean_text(self, obj):
-        # todo: use better representation of messages in Message that separates tool calls from normal text
-        tags_to_remove = []
+        return clean_message_text(obj.text)
 
-        output = obj.text
-        for open_tag, close_tag in tags_to_remove:
-            pattern = re.compile(f'{open_tag}.*{close_tag}')
-            output = pattern.sub("", output)
-            output = output.replace(open_tag, "").replace(close_tag, "")
-        
-        return output
+    def get_audio(self, obj):
+        """URL of the audio endpoint, which streams byte ranges for seeking"""
+        return obj.get_audio_url() if obj.playable_audio else None
 
     def get_html(self, obj):
-        return markdown.markdown(self.get_clean_text(obj), extensions=['fenced_code'])
+        return obj.get_html()
 
     def get_attached_files(self, obj):
         return [attachment.original_name for attachment in obj.attachments.all()]
 
-    def get_image_b64(self, obj):
-        return to_data_uri(obj.image)
-
     def create(self, validated_data):
         attachments = []
         if 'attachments' in validated_data:
@@ -155,41 +183,61 @@ class MessageSerializer(serializers.ModelSerializer):
         return file_path
 
 
-class TreebankSerializer(serializers.ModelSerializer):
+class BranchMessageSerializer(MessageSerializer):
+    """Message of a windowed treebank, with counts in place of nested replies"""
+    replies_count = serializers.IntegerField(read_only=True)
+    siblings_count = serializers.IntegerField(read_only=True)
+    branch_index = serializers.IntegerField(read_only=True)
+
+    class Meta(MessageSerializer.Meta):
+        fields = ['id', 'text', 'clean_text', 'html', 'date_time',
+                  'generation_details', 'parent', 'chat', 'audio', 'image', 'image_b64',
+                  'image_ref', 'attachments', 'attached_files', 'relative_paths',
+                  'replies_count', 'siblings_count', 'branch_index']
+        read_only_fields = ['audio']
+
+
+class TreebankReplySerializer(MessageSerializer):
+    replies = serializers.SerializerMethodField()
+
+    def get_replies(self, obj):
+        # nested replies are linked by TreebankSerializer once every node is serialized
+        return []
+
+
+class TreebankSerializer(MessageImageMixin, serializers.ModelSerializer):
+    """Serializes the whole tree of messages rooted at the given message.
+
+    Messages are loaded with a fixed number of queries and nested in memory,
+    instead of querying replies of every node recursively.
+    """
+    reply_serializer_class = TreebankReplySerializer
+
     replies = serializers.SerializerMethodField()
     image_b64 = serializers.SerializerMethodField()
+    image_ref = serializers.SerializerMethodField()
     attached_files = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
         fields = ['id', 'text', 'date_time', 'generation_details', 'parent',
-                  'replies', 'chat', 'image', 'image_b64', 'attached_files']
+                  'replies', 'chat', 'image', 'image_b64', 'image_ref', 'attached_files']
         read_only_fields = ['replies', 'chat']
 
-    def get_replies(self, obj):
-        res = []
-        for reply in obj.replies.all():
-            item = MessageSerializer(instance=reply).data
-            item['replies'] = self.get_replies(reply)
-            res.append(item)
-    
-        return res
+    def to_representation(self, instance):
+        root, *descendants = Message.objects.tree(instance)
 
-    def get_image_b64(self, obj):
-        return to_data_uri(obj.image)
-
-    def get_attached_files(self, obj):
-        return [attachment.original_name for attachment in obj.attachments.all()]
+        self.tree_replies = {}
+        replies = self.reply_serializer_class(descendants, many=True, context=self.context)
+        for item in replies.data:
+            item['replies'] = self.tree_replies.setdefault(item['id'], [])
+            self.tree_replies.setdefault(item['parent'], []).append(item)
 
+        return super().to_representation(root)
 
-def to_data_uri(image):
-    if not image:
-        return None
+    def get_replies(self, obj):
+        return self.tree_replies.get(obj.id, [])
 
-    with open(image.path, "rb") as f:
-        data = f.read()
+    def get_attached_files(self, obj):
+        return [attachment.original_name for attachment in obj.attachments.all()]
 
-    _, extension = os.path.splitext(image.path)
-    extension = extension[1:]
-    image_b64_string = base64.b64encode(data).decode('utf-8')
-    return f"data:image/{extension};base64,{image_b64_string}"
\ No newline at end of file
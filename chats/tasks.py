@@ -1,6 +1,8 @@
 import threading
 import time
 import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue
 import json
 import os
@@ -13,16 +15,18 @@ import markdown
 import bleach
 from django.core.files.base import ContentFile
 from django.conf import settings
+from django.db import close_old_connections
 import llm_utils
 import tts
 from chats.models import SpeechSample, Message
 from .serializers import MessageSerializer
 
-from .utils import join_wavs
+from .utils import WavConcatenator, WavFormatError
+from . import tts_cache, audio_compression
 from pygentify import (
     Agent, OutputDevice, TextCache, TooManyRoundsError, sandboxes_registry
 )
-from pygentify.llm_backends import LlamaCpp, GenerationSpec as PygentifySpec
+from pygentify.llm_backends import LlamaCpp, GenerationSpec as PygentifySpec, pick_slot
 from pygentify.messages import JinjaChatFactory
 from pygentify.tool_calling import SimpleTagBasedToolUse, tool_registry, create_docs
 
@@ -30,9 +34,38 @@ TOKEN_STREAM = 'token_stream'
 SPEECH_CHANNEL = 'speech_stream'
 STOPWORD = "[|END_OF_STREAM|]"
 STOP_SPEECH = "[|END_OF_SPEECH|]"
+EVENT_STREAM = 'session_events'
+
+
+def publish_event(redis_obj, channel, event, data):
+    """Publish an event in the wire format of websocket clients.
+
+    The websocket gateway forwards published payloads to clients byte for byte.
+    With EVENT_TRANSPORT set to "streams", events of all channels of a session
+    are appended to one capped Redis stream instead, so that reconnecting
+    clients can resume from the last event they have seen.
+    """
+    msg = {'event': event, 'data': data}
+    payload = json.dumps(msg)
+
+    if settings.EVENT_TRANSPORT == 'streams':
+        _, _, session_id = channel.partition(':')
+        key = f'{EVENT_STREAM}:{session_id}'
+        pipe = redis_obj.pipeline(transaction=False)
+        pipe.xadd(key, {'payload': payload}, maxlen=settings.EVENT_STREAM_MAXLEN, approximate=True)
+        pipe.expire(key, settings.EVENT_STREAM_TTL)
+        pipe.execute()
+    else:
+        redis_obj.publish(channel, payload)
 
 
 def synthesize_speech(text, voice_id):
+    if settings.TTS_CACHE_ENABLED:
+        sample = tts_cache.get_or_synthesize(text, voice_id, tts.tts_backend.synthesize)
+        if sample is None:
+            raise NoSpeechSampleError()
+        return sample
+
     speech_data = tts.tts_backend.synthesize(text, voice_id)
     if not speech_data:
         raise NoSpeechSampleError()
@@ -42,6 +75,7 @@ def synthesize_speech(text, voice_id):
     sample.audio = audio_file
     sample.text = text
     sample.save()
+    audio_compression.schedule(sample)
 
     return sample
 
@@ -50,39 +84,196 @@ class NoSpeechSampleError(Exception):
     pass
 
 
+_tts_limits = {}
+_tts_limits_lock = threading.Lock()
+
+
+def get_tts_concurrency(voice_id):
+    return settings.TTS_VOICE_CONCURRENCY.get(voice_id, settings.TTS_CONCURRENCY)
+
+
+_tts_pool = None
+_tts_pool_size = None
+_tts_pool_lock = threading.Lock()
+
+
+def get_tts_pool():
+    """Returns the executor synthesizing sentences of every generation of the process.
+
+    Its threads are kept between generations, and with them their HTTP
+    sessions to the TTS service. It has as many threads as the highest
+    concurrency of any voice, get_tts_limit() limits every voice to its own.
+    """
+    global _tts_pool, _tts_pool_size
+    size = max([settings.TTS_CONCURRENCY, *settings.TTS_VOICE_CONCURRENCY.values()])
+    with _tts_pool_lock:
+        if _tts_pool_size != size:
+            if _tts_pool is not None:
+                _tts_pool.shutdown(wait=False)
+            _tts_pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix='tts')
+            _tts_pool_size = size
+        return _tts_pool
+
+
+def get_tts_limit(voice_id):
+    """Returns a semaphore limiting concurrent synthesis of a voice across generations of the process"""
+    with _tts_limits_lock:
+        limit = _tts_limits.get(voice_id)
+        if limit is None:
+            limit = threading.BoundedSemaphore(get_tts_concurrency(voice_id))
+            _tts_limits[voice_id] = limit
+        return limit
+
+
 class Consumer(threading.Thread):
-    def __init__(self, queue, redis_bus, socket_session_id, voice_id):
+    """Turns sentences put on the queue into speech samples.
+
+    Several sentences are synthesized at the same time on a pool of threads
+    (see TTS_CONCURRENCY), but speech_sample_arrived events are published
+    in the order of sentences.
+    """
+    def __init__(self, queue, redis_bus, socket_session_id, voice_id, audio_builder=None):
         super().__init__()
         self.queue = queue
         self.redis_bus = redis_bus
         self.session_id = socket_session_id
         self.voice_id = voice_id
+        self.audio_builder = audio_builder
         self.samples = []
 
+        # (sentence, time it was queued, future of synthesis) in sentence order
+        self.pending = Queue()
+
+        self.started_at = None
+        self.first_audio_at = None
+        self.lags = []
+        self.stats = {}
+
     def run(self):
-        speech_channel = f'{SPEECH_CHANNEL}:{self.session_id}'
+        self.started_at = time.time()
+        publisher = threading.Thread(target=self.publish_samples)
+        publisher.start()
+
+        pool = get_tts_pool()
         while True:
             sentence = self.queue.get()
             if sentence == '' or not self.voice_id:
                 self.queue.task_done()
                 break
 
+            future = pool.submit(self.synthesize_in_pool, sentence)
+            self.pending.put((sentence, time.time(), future))
+            self.queue.task_done()
+
+        # the publisher waits for every pending sample
+        self.pending.put(None)
+        publisher.join()
+
+    def synthesize_in_pool(self, sentence):
+        # pool threads outlive generations, so they drop stale connections themselves
+        close_old_connections()
+        return self.synthesize(sentence)
+
+    def synthesize(self, sentence):
+        with get_tts_limit(self.voice_id):
             t0 = time.time()
             try:
                 sample = synthesize_speech(sentence, self.voice_id)
-                self.samples.append(sample)
-            except Exception as e:
+            except Exception:
+                sample = None
+                traceback.print_exc()
+            return sample, time.time() - t0
+
+    def publish_samples(self):
+        speech_channel = f'{SPEECH_CHANNEL}:{self.session_id}'
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+
+            sentence, queued_at, future = item
+            # samples synthesized ahead of time wait for the previous ones
+            sample, elapsed = future.result()
+
+            if sample is None:
                 url = None
                 sample_id = None
-                traceback.print_exc()
             else:
+                self.samples.append(sample)
                 url = sample.get_absolute_url()
                 sample_id = sample.pk
 
-            elapsed = time.time() - t0
+                if self.audio_builder:
+                    self.audio_builder.add(sample)
+
             message = dict(text=sentence, url=url, gen_time_seconds=elapsed, id=sample_id)
-            self.redis_bus.publish(speech_channel, json.dumps(message))
-            self.queue.task_done()
+            publish_event(self.redis_bus, speech_channel, 'speech_sample_arrived', message)
+
+            published_at = time.time()
+            if self.first_audio_at is None:
+                self.first_audio_at = published_at
+            # lag of audio behind the token stream, which had the sentence at queued_at
+            self.lags.append(published_at - queued_at)
+
+        self.update_stats()
+
+    def update_stats(self):
+        if not self.lags:
+            return
+
+        self.stats = dict(time_to_first_audio=self.first_audio_at - self.started_at,
+                          mean_lag=sum(self.lags) / len(self.lags),
+                          max_lag=max(self.lags))
+
+
+class MessageAudioBuilder:
+    """Writes speech samples into a new Message.audio file, in one pass, as they arrive.
+
+    Samples whose format differs from the first one are skipped.
+    """
+    def __init__(self):
+        self.name = None
+        self.file = None
+        self.concatenator = None
+
+    def add(self, sample):
+        if self.file is None:
+            self._open()
+
+        try:
+            self.concatenator.add(sample.audio.path)
+        except (WavFormatError, wave.Error, OSError) as e:
+            print(f'Skipped speech sample {sample.pk} of message audio: {e}')
+
+    def _open(self):
+        field = Message._meta.get_field('audio')
+        self.name = field.storage.get_available_name(field.generate_filename(None, f'{uuid.uuid4().hex}.wav'))
+        path = field.storage.path(self.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'wb')
+        self.concatenator = WavConcatenator(self.file)
+
+    def finish(self):
+        """Completes the file. Returns its name in the storage, or None if no sample was written"""
+        if self.file is None:
+            return None
+
+        frames = self.concatenator.close()
+        self.file.close()
+        self.file = None
+        if not frames:
+            self.discard()
+            return None
+        return self.name
+
+    def discard(self):
+        if self.file is not None:
+            self.concatenator.close()
+            self.file.close()
+            self.file = None
+        if self.name:
+            Message._meta.get_field('audio').storage.delete(self.name)
+            self.name = None
 
 
 def parse_attachment(attachment):
@@ -233,13 +424,7 @@ class ChatRendererToList(ChatRenderer):
 
 
 def get_saved_history(last_message):
-    message = last_message
-    chat_history = [message]
-    while message.parent:
-        message = message.parent
-        chat_history.append(message)
-
-    return list(reversed(chat_history))
+    return Message.objects.branch(last_message)
 
 
 def get_system_message(first_message, tool_use_helper):
@@ -254,6 +439,45 @@ def get_system_message(first_message, tool_use_helper):
     return system_message
 
 
+class TokenCoalescer:
+    """Groups streamed text into fewer tokens_arrived events.
+
+    Pending text is published with the text which grows it past max_bytes or
+    arrives `window` seconds after it, whichever comes first, and the rest
+    by flush() at the end of generation. A window of 0 publishes every
+    piece of text as soon as it arrives.
+    """
+    def __init__(self, redis_obj, channel, window=0.0, max_bytes=0):
+        self.redis_obj = redis_obj
+        self.channel = channel
+        self.window = window
+        self.max_bytes = max_bytes
+        self.parts = []
+        self.size = 0
+        self.pending_since = None
+
+    def add(self, text):
+        if not text:
+            return
+
+        now = time.monotonic()
+        if self.pending_since is None:
+            self.pending_since = now
+        self.parts.append(text)
+        self.size += len(text.encode('utf-8'))
+
+        if (self.window <= 0 or (self.max_bytes and self.size >= self.max_bytes)
+                or now - self.pending_since >= self.window):
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            publish_event(self.redis_obj, self.channel, 'tokens_arrived', ''.join(self.parts))
+            self.parts = []
+            self.size = 0
+        self.pending_since = None
+
+
 class ProcessorDevice(OutputDevice):
     def __init__(self, redis_obj, channel, sentence_processor):
         super().__init__()
@@ -263,6 +487,9 @@ class ProcessorDevice(OutputDevice):
         self.generated_text = ''
         self.sentence = ''
         self.sentence_processor = sentence_processor
+        self.coalescer = TokenCoalescer(redis_obj, channel,
+                                        window=settings.TOKEN_COALESCE_WINDOW,
+                                        max_bytes=settings.TOKEN_COALESCE_MAX_BYTES)
 
     def on_token(self, token):
         self.cache.fill(token)
@@ -277,30 +504,39 @@ class ProcessorDevice(OutputDevice):
         self.send(new_text)
 
     def send(self, text):
+        sentence_ended = False
         for ch in text:
             self.sentence += ch
 
             if ch in ".!?":
                 self.sentence_processor.process_sentence(self.sentence)
                 self.sentence = ''
+                sentence_ended = True
 
         self.generated_text += text
-        msg = {'event': 'tokens_arrived', 'data': text}
-        self.redis_obj.publish(self.channel, json.dumps(msg))
+        self.coalescer.add(text)
+
+        if sentence_ended:
+            self.flush()
+
+    def flush(self):
+        self.coalescer.flush()
 
 
 class PygentifyTextGenerator:
     def __init__(self, redis_obj, tokens_channel):
         self.redis_obj = redis_obj
         self.tokens_channel = tokens_channel
+        self.output_device = None
 
     def __call__(self, generation_spec):
         llm = llm_utils.token_generator
         stop_word = ["<|tool_use_end|>"]
         #stop_word = generation_spec.stop_word # todo: this should work
-        llm.set_spec(generation_spec.sampling_config, stop_word=stop_word)
+        llm.set_spec(generation_spec.sampling_config, stop_word=stop_word, slot_id=generation_spec.slot_id)
 
         output_device = ProcessorDevice(self.redis_obj, self.tokens_channel, self)
+        self.output_device = output_device
         temp_output_device = OutputDevice()
 
         spec_tools = generation_spec.tools or []
@@ -330,9 +566,16 @@ class PygentifyTextGenerator:
         except TooManyRoundsError:
             print("TooManyRoundsError, stopped generating")
             pass
+        finally:
+            output_device.flush()
 
         return output_device.generated_text
 
+    def flush_tokens(self):
+        """Publish buffered tokens so that they reach clients before the next event"""
+        if self.output_device:
+            self.output_device.flush()
+
     def process_token(self, token):
         pass
 
@@ -386,8 +629,7 @@ class PygentifyProducer(PygentifyTextGenerator):
         self.builds_channel = builds_channel
 
     def process_token(self, token):
-        msg = {'event': 'tokens_arrived', 'data': token}
-        self.redis_obj.publish(self.tokens_channel, json.dumps(msg))
+        publish_event(self.redis_obj, self.tokens_channel, 'tokens_arrived', token)
 
     def process_sentence(self, sentence):
         self.queue.put(sentence)
@@ -406,12 +648,12 @@ class PygentifyProducer(PygentifyTextGenerator):
         })
 
     def _notify_about_tool_use(self, event_type, data):
-        msg = {'event': event_type, 'data': data}
-        self.redis_obj.publish(self.tokens_channel, json.dumps(msg))
+        self.flush_tokens()
+        publish_event(self.redis_obj, self.tokens_channel, event_type, data)
 
     def process_api_call_segment(self, text):
-        msg = {'event': 'generation_paused', 'data': text}
-        self.redis_obj.publish(self.tokens_channel, json.dumps(msg))
+        self.flush_tokens()
+        publish_event(self.redis_obj, self.tokens_channel, 'generation_paused', text)
 
     def process_build_start(self, context):
         self._notify_event_started("build_started", context)
@@ -426,20 +668,22 @@ class PygentifyProducer(PygentifyTextGenerator):
         self._notify_event_finished("code_execution_finished", result)
 
     def _notify_event_started(self, event_type, data):
+        self.flush_tokens()
         msg = dict(data)
         self.fix_field_if_exists(msg, "src_tree", format_files)
 
         msg['build_event'] = event_type
-        self.redis_obj.publish(self.builds_channel, json.dumps(msg))
+        publish_event(self.redis_obj, self.builds_channel, event_type, msg)
 
     def _notify_event_finished(self, event_type, data):
+        self.flush_tokens()
         msg = dict(data)
         self.fix_field_if_exists(msg, "stdout", fix_linebreaks)
         self.fix_field_if_exists(msg, "stderr", fix_linebreaks)
         self.fix_field_if_exists(msg, "src_tree", format_files)
 
         msg["build_event"] = event_type
-        self.redis_obj.publish(self.builds_channel, json.dumps(msg))
+        publish_event(self.redis_obj, self.builds_channel, event_type, msg)
 
     def fix_field_if_exists(self, mapping, field, fix):
         if field in mapping:
@@ -475,27 +719,25 @@ def process_attachments(message):
     message.save()
 
 
-def create_response_message(parent, response_text, audio_samples):
+def create_response_message(parent, response_text, audio_name=None):
     response_message = Message()
     response_message.text = response_text
     response_message.parent = parent
 
-    if audio_samples:
-        output_name = f'{uuid.uuid4().hex}.wav'
-        output_path = os.path.join(settings.MEDIA_ROOT, output_name)
-        audio_data = join_wavs(audio_samples, output_path)
-        response_message.audio = ContentFile(audio_data, name="tts-audio-file.wav")
+    if audio_name:
+        # the file has been written into the storage already (see MessageAudioBuilder)
+        response_message.audio.name = audio_name
 
     response_message.save()
-    
+    audio_compression.schedule(response_message)
+
     return response_message
 
 
-def encode_chat_thread(last_message):
+def encode_chat_thread(db_history):
     tool_use = SimpleTagBasedToolUse.create_default()
     msg_factory = JinjaChatFactory('llama3', tool_use)
-    
-    db_history = get_saved_history(last_message)
+
     system_message = get_system_message(db_history[0], tool_use)
 
     history = []
@@ -533,37 +775,46 @@ def generate_response_message(generation_spec_dict, socket_session_id, redis_obj
 
     queue = Queue()
 
-    consumer = Consumer(queue, redis_object, socket_session_id, generation_spec.voice_id)
+    audio_builder = MessageAudioBuilder()
+    consumer = Consumer(queue, redis_object, socket_session_id, generation_spec.voice_id, audio_builder)
     consumer.start()
 
     message_history = get_saved_history(message)
     configuration = message_history[0].chat.configuration
 
     # todo: monkey patching will do for now
-    generation_spec.history = encode_chat_thread(message)
+    generation_spec.history = encode_chat_thread(message_history)
     generation_spec.sandboxes = configuration.sandboxes
     generation_spec.tools = configuration.tools
+    generation_spec.slot_id = pick_slot(message_history[0].chat.pk, settings.LLM_SERVER_SLOTS)
 
     producer = PygentifyProducer(queue, redis_object, token_channel, builds_channel)
+    response_text = None
     try:
         response_text = producer(generation_spec)
     except Exception as e:
         print('Generation failed:', str(e))
         raise
     finally:
-        redis_object.publish(token_channel, STOPWORD)
+        publish_event(redis_object, token_channel, 'end_of_stream', STOPWORD)
         queue.put('')
         consumer.join()
-        redis_object.publish(f'{SPEECH_CHANNEL}:{socket_session_id}', STOP_SPEECH)
+        publish_event(redis_object, f'{SPEECH_CHANNEL}:{socket_session_id}', 'end_of_speech', STOP_SPEECH)
+
+        if response_text is None:
+            audio_builder.discard()
+
+    if consumer.stats:
+        print("Speech:", consumer.stats)
 
-    wav_samples = consumer.samples
+    # samples were appended as they arrived, only the header is left to write
+    audio_name = audio_builder.finish()
 
-    response_message = create_response_message(message, response_text, wav_samples)   
+    response_message = create_response_message(message, response_text, audio_name)
     serializer = MessageSerializer(response_message)
     serialized_msg = serializer.data
     
-    msg = {'event': 'generation_complete', 'data': serialized_msg}
-    redis_object.publish(token_channel, json.dumps(msg))
+    publish_event(redis_object, token_channel, 'generation_complete', serialized_msg)
 
 
 @shared_task
@@ -575,5 +826,4 @@ def generate_llm_response(generation_spec_dict, socket_session_id):
         generate_response_message(generation_spec_dict, socket_session_id, redis_object)
     except Exception as e:
         traceback.print_exc()
-        msg = {'event': 'generation_error', 'data': str(e)}
-        redis_object.publish(token_channel, json.dumps(msg))
+        publish_event(redis_object, token_channel, 'generation_error', str(e))
@@ -0,0 +1,126 @@
+import threading
+import time
+import unittest
+from llm_services.llamacpp import ModelPool
+
+
+class FakeInstance:
+    """Stands in for a llama-server process, loading takes until `loaded` is set"""
+    def __init__(self, model_id, loaded):
+        self.model_id = model_id
+        self.model_path = model_id
+        self.port = None
+        self.parallel = 1
+        self.memory = 1
+        self.active = 0
+        self.loading = False
+        self.loaded = loaded
+        self.started = 0
+        self.stopped = False
+
+    def start(self):
+        self.started += 1
+        self.loaded.wait(5)
+
+    def info(self):
+        return {'model_id': self.model_id, 'loading': self.loading}
+
+    def stop(self):
+        self.stopped = True
+
+
+class FakePool(ModelPool):
+    def __init__(self, max_models):
+        super().__init__()
+        self.configure("llama-server", "localhost", 9000, max_models=max_models)
+        self.loaded = threading.Event()
+        self.created = []
+
+    def _create_instance(self, model_id):
+        instance = FakeInstance(model_id, self.loaded)
+        self.created.append(instance)
+        return instance
+
+    def load(self, model_id):
+        self.configs[model_id] = (model_id, {})
+        with self.lease(model_id) as instance:
+            return instance
+
+
+def run_in_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.start()
+    return thread
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+class ModelPoolTests(unittest.TestCase):
+    def test_resident_model_is_served_while_another_loads(self):
+        pool = FakePool(max_models=2)
+        pool.loaded.set()
+        pool.load('first')
+        pool.loaded.clear()
+
+        loading = run_in_thread(pool.load, 'second')
+        self.assertTrue(wait_until(lambda: 'second' in pool.instances))
+
+        with pool.lease('first') as instance:
+            self.assertEqual('first', instance.model_id)
+        loading_states = {info['model_id']: info['loading'] for info in pool.list_instances()}
+        self.assertEqual({'first': False, 'second': True}, loading_states)
+
+        pool.loaded.set()
+        loading.join()
+        self.assertFalse(pool.instances['second'].loading)
+
+    def test_concurrent_requests_load_model_once(self):
+        pool = FakePool(max_models=2)
+        threads = [run_in_thread(pool.load, 'model') for _ in range(3)]
+        self.assertTrue(wait_until(lambda: len(pool.created) >= 1))
+        time.sleep(0.05)
+        pool.loaded.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(pool.created))
+        self.assertEqual(1, pool.created[0].started)
+
+    def test_queued_loads_get_different_ports(self):
+        pool = FakePool(max_models=2)
+        pool.loaded.set()
+        pool.load('resident')
+
+        # both loads wait for the busy resident model to become idle
+        with pool.lease('resident'):
+            pool.max_models = 1
+            threads = [run_in_thread(pool.load, model_id) for model_id in ('first', 'second')]
+            time.sleep(0.05)
+            pool.max_models = 3
+        for thread in threads:
+            thread.join()
+
+        ports = [instance.port for instance in pool.instances.values()]
+        self.assertEqual(len(ports), len(set(ports)))
+
+    def test_failed_load_frees_its_place(self):
+        pool = FakePool(max_models=1)
+        create_instance = pool._create_instance
+
+        def fail():
+            raise OSError('no such executable')
+
+        def create_failing(model_id):
+            instance = create_instance(model_id)
+            instance.start = fail
+            return instance
+
+        pool._create_instance = create_failing
+        with self.assertRaises(OSError):
+            pool.load('model')
+        self.assertEqual({}, dict(pool.instances))
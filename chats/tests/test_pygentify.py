@@ -1,6 +1,22 @@
+import asyncio
+import json
+import threading
 import unittest
-from pygentify.tool_calling import find_code_section, parse_code_section, detect_language
-from pygentify.completion import finilize_response
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pygentify.tool_calling import (
+    find_code_section, parse_code_section, detect_language, TagScanner, SimpleTagBasedToolUse
+)
+from pygentify.messages import JinjaChatFactory, group_messages, collate
+from pygentify.jinja_env import env
+from pygentify import http_client
+from pygentify import AsyncAgent, OutputDevice
+from pygentify.llm_backends import (
+    LlamaCpp, AsyncLlamaCpp, GenerationSpec, pick_slot, prompt_cache_stats, iter_sse_data
+)
+from llm_utils import generators
+from llm_utils.generators import LlamaCppServer
+from pygentify.completion import TextCompleter, AsyncTextCompleter, StopSequenceMatcher
 
 
 class FindCodeSectionTests(unittest.TestCase):
@@ -165,29 +181,515 @@ class DetectLanguageTests(unittest.TestCase):
         self.assertEqual("javascript", detect_language(code))
 
 
-class ResponseFinializationTests(unittest.TestCase):
-    def test(self):
-        expected_text = "```some text```"
-        text, token = finilize_response("```some text", "```")
-        self.assertEqual(expected_text, text)
-        self.assertEqual("```", token)
+class StopSequenceMatcherTests(unittest.TestCase):
+    def test_match_split_across_pieces(self):
+        matcher = StopSequenceMatcher(["```"])
+        self.assertEqual([], list(matcher.feed("text `")))
+        self.assertEqual([], list(matcher.feed("`")))
+        self.assertEqual([1], list(matcher.feed("`python")))
+        self.assertEqual(1, matcher.matches)
+
+    def test_counts_non_overlapping_matches_like_str_count(self):
+        for text in ["````", "``````", "```` ```", "a```b``", "`` ``` ``"]:
+            matcher = StopSequenceMatcher(["```"])
+            for ch in text:
+                list(matcher.feed(ch))
+            self.assertEqual(text.count("```"), matcher.matches, text)
+
+    def test_multiple_sequences(self):
+        matcher = StopSequenceMatcher(["</tool>", "ool>x", "STOP"])
+        self.assertEqual([9, 14], list(matcher.feed("a </tool> STOP</tool")))
+
+
+class TextCompleterTests(unittest.TestCase):
+    def complete(self, tokens):
+        completer = TextCompleter(lambda input_text: iter(tokens))
+        received = []
+        completer.on_token = received.append
+        return completer("prompt"), received
+
+    def test_stops_after_closing_fence(self):
+        response, received = self.complete(["Sure:\n``", "`python\nprint(1)\n`", "``\nmore", " text"])
+        self.assertEqual("Sure:\n```python\nprint(1)\n```", response)
+        self.assertEqual(["Sure:\n``", "`python\nprint(1)\n`", "``"], received)
+
+    def test_both_fences_in_one_token(self):
+        response, _ = self.complete(["```", "x```suffix"])
+        self.assertEqual("```x```", response)
+
+    def test_without_stop_sequence(self):
+        response, _ = self.complete(["no ", "code"])
+        self.assertEqual("no code", response)
+
+
+class TagScannerTests(unittest.TestCase):
+    def scan(self, tokens):
+        scanner = TagScanner("<|start|>", "<|end|>")
+        pieces = []
+        for token in tokens:
+            pieces.extend(scanner.feed(token))
+        pieces.extend(scanner.finish())
+        return pieces
+
+    def outside_text(self, pieces):
+        return ''.join(text for kind, text, _ in pieces if kind == TagScanner.OUTSIDE)
+
+    def test_tags_split_across_tokens(self):
+        pieces = self.scan(["Hi <|st", "art|>{\"a\"", ": 1}<|e", "nd", "|> bye"])
+        self.assertEqual("Hi  bye", self.outside_text(pieces))
+        self.assertEqual([(TagScanner.START_TAG, "<|start|>", 3), (TagScanner.END_TAG, "<|end|>", 20)],
+                         [p for p in pieces if p[0] in (TagScanner.START_TAG, TagScanner.END_TAG)])
+        self.assertEqual('{"a": 1}', ''.join(text for kind, text, _ in pieces if kind == TagScanner.INSIDE))
+
+    def test_both_tags_in_one_token(self):
+        pieces = self.scan(["a<|start|>x<|end|>b"])
+        self.assertEqual([(TagScanner.OUTSIDE, "a", 0), (TagScanner.START_TAG, "<|start|>", 1),
+                          (TagScanner.INSIDE, "x", 10), (TagScanner.END_TAG, "<|end|>", 11),
+                          (TagScanner.OUTSIDE, "b", 18)], pieces)
+
+    def test_only_possible_tag_prefix_is_held_back(self):
+        scanner = TagScanner("<|start|>", "<|end|>")
+        self.assertEqual([(TagScanner.OUTSIDE, "text ", 0)], scanner.feed("text <|s"))
+        self.assertEqual([(TagScanner.OUTSIDE, "<|s|> more", 5)], scanner.feed("|> more"))
+        self.assertEqual("", scanner.pending)
+
+    def test_unfinished_prefix_is_returned_by_finish(self):
+        self.assertEqual("end <|", self.outside_text(self.scan(["end <", "|"])))
+
+
+class SimpleTagBasedToolUseTests(unittest.TestCase):
+    def test_find(self):
+        tool_use = SimpleTagBasedToolUse.create_default()
+        s = 'Let me check. <|tool_use_start|>{"tool_name": "x",\n "args": {}}<|tool_use_end|>'
+        offset, length, body = tool_use.find(s)
+        self.assertEqual(14, offset)
+        self.assertEqual(len(s) - 14, length)
+        self.assertEqual('{"tool_name": "x",\n "args": {}}', body)
+
+    def test_unterminated_tool_use_is_not_found(self):
+        tool_use = SimpleTagBasedToolUse.create_default()
+        self.assertFalse(tool_use.contains_tool_use('<|tool_use_start|>{"tool_name": "x"'))
+
+
+class JinjaChatRendererTests(unittest.TestCase):
+    def setUp(self):
+        self.factory = JinjaChatFactory('llama3', None)
+        self.history = [self.factory.create_system_msg("Be brief"),
+                        self.factory.create_user_msg("What time is it?"),
+                        self.factory.create_ai_msg("Let me check."),
+                        self.factory.create_tool_call("clock", {})]
+
+    def render_from_scratch(self, messages):
+        template = env.get_template('llama_3.jinja')
+        messages = [collate(group) for group in group_messages(messages)]
+        return template.render(messages=messages) + '<|start_header_id|>assistant<|end_header_id|>'
+
+    def test_appended_history_renders_like_full_history(self):
+        renderer = self.factory.get_chat_renderer()
+        self.assertEqual(self.render_from_scratch(self.history), renderer(self.history))
+
+        self.history.append(self.factory.create_tool_result("clock", "noon"))
+        self.assertEqual(self.render_from_scratch(self.history), renderer(self.history))
+
+        self.history.append(self.factory.create_ai_msg("It is noon."))
+        self.history.append(self.factory.create_user_msg("Thanks"))
+        self.assertEqual(self.render_from_scratch(self.history), renderer(self.history))
+
+    def test_only_new_groups_are_rendered(self):
+        renderer = self.factory.get_chat_renderer()
+        renderer(self.history)
+
+        rendered = []
+        render_block = renderer.render_block
+        renderer.render_block = lambda message: rendered.append(message) or render_block(message)
+
+        self.history.append(self.factory.create_tool_result("clock", "noon"))
+        renderer(self.history)
+
+        # the tool group got a new message, the groups before it come from the cache
+        self.assertEqual(1, len(rendered))
+        self.assertEqual("tool", rendered[0].role)
+
+    def test_changed_history_is_rendered_again(self):
+        renderer = self.factory.get_chat_renderer()
+        renderer(self.history)
+
+        other_history = self.history[:2] + [self.factory.create_ai_msg("No idea.")]
+        self.assertEqual(self.render_from_scratch(other_history), renderer(other_history))
+
+    def test_continue_generation(self):
+        renderer = self.factory.get_chat_renderer()
+        history = self.history[:3]
+        expected = (self.render_from_scratch(history[:2])[:-len('<|start_header_id|>assistant<|end_header_id|>')] +
+                    '<|start_header_id|>assistant<|end_header_id|>\n\nLet me check.')
+        self.assertEqual(expected, renderer(history, continue_gen=True))
+
+
+class FakeRequestMaker:
+    def post(self, url, data, **kwargs):
+        self.url = url
+        self.payload = json.loads(data)
+
+
+class SlotAffinityTests(unittest.TestCase):
+    def test_same_chat_gets_same_slot(self):
+        self.assertEqual(pick_slot(42, 4), pick_slot(42, 4))
+        self.assertTrue(all(0 <= pick_slot(chat_id, 4) < 4 for chat_id in range(100)))
+        self.assertEqual(4, len({pick_slot(chat_id, 4) for chat_id in range(100)}))
+
+    def test_no_slot_without_slots_configured(self):
+        self.assertIsNone(pick_slot(42, None))
+
+    def test_slot_is_sent_to_server(self):
+        llm = LlamaCpp("http://llm", GenerationSpec({}, slot_id=3))
+        llm.request_maker = FakeRequestMaker()
+        llm.start_streaming("prompt", {}, None)
+        self.assertEqual(3, llm.request_maker.payload["id_slot"])
+        self.assertTrue(llm.request_maker.payload["cache_prompt"])
+
+    def test_slot_is_omitted_by_default(self):
+        llm = LlamaCpp("http://llm", GenerationSpec({}))
+        llm.request_maker = FakeRequestMaker()
+        llm.start_streaming("prompt", {}, None)
+        self.assertNotIn("id_slot", llm.request_maker.payload)
+
+    def test_cache_stats(self):
+        stats = prompt_cache_stats({"tokens_cached": 900, "tokens_evaluated": 1000,
+                                    "timings": {"prompt_ms": 12.5}})
+        self.assertEqual(900, stats["tokens_cached"])
+        self.assertEqual(12.5, stats["prompt_ms"])
+
+
+class FinishedLlamaCpp:
+    """Stands in for LlamaCpp, streams one token and reports cache usage"""
+    def __init__(self, base_url, generation_spec, proxies=None):
+        self.response_data = {"tokens_cached": 5, "tokens_evaluated": 8}
+
+    def __call__(self, prompt):
+        yield "token"
+
+
+class LlamaCppServerTests(unittest.TestCase):
+    def generate(self, server, prompt):
+        tokens = server(prompt)
+        while True:
+            try:
+                next(tokens)
+            except StopIteration as stop:
+                return stop.value
+
+    def test_cache_stats_are_returned_and_logged_per_call(self):
+        server = LlamaCppServer("http://llm", {})
+        server.set_spec({}, stop_word=None, slot_id=1)
+        with mock.patch.object(generators, 'LlamaCpp', FinishedLlamaCpp):
+            with self.assertLogs('llm_utils.generators', level='INFO') as logs:
+                first = self.generate(server, "system question")
+                second = self.generate(server, "system questiontoken next question")
+
+        self.assertEqual(0, first["prompt_prefix_chars"])
+        # the generated token is in the cache of the slot as well
+        self.assertEqual(len("system questiontoken"), second["prompt_prefix_chars"])
+        self.assertEqual(5, second["tokens_cached"])
+        self.assertIn("slot_id=1", logs.output[1])
+
+
+class CountingHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    failures_left = 0
+
+    def do_GET(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.clients.add(self.client_address)
+        if CountingHandler.failures_left:
+            CountingHandler.failures_left -= 1
+            status = 503
+        else:
+            status = 200
+        body = b'{"ok": true}'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpClientTests(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), CountingHandler)
+        self.server.clients = set()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        http_client.configure(backoff_factor=0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        http_client.configure(**http_client.DEFAULT_CONFIG)
+
+    def test_connection_is_reused(self):
+        for _ in range(5):
+            self.assertEqual(200, http_client.post(self.url, data='{}').status_code)
+        self.assertEqual(1, len(self.server.clients))
+
+    def test_each_thread_has_own_session(self):
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(http_client.get_session()))
+        thread.start()
+        thread.join()
+        self.assertIs(http_client.get_session(), http_client.get_session())
+        self.assertIsNot(sessions[0], http_client.get_session())
+
+    def test_default_timeout(self):
+        http_client.configure(connect_timeout=1, read_timeout=7)
+        self.assertEqual((1, 7), http_client.get_session().timeout)
+
+    def test_get_is_retried_on_unavailable_service(self):
+        CountingHandler.failures_left = 2
+        self.assertEqual(200, http_client.get(self.url).status_code)
+
+    def test_post_is_not_retried_on_error_status(self):
+        CountingHandler.failures_left = 1
+        self.assertEqual(503, http_client.post(self.url).status_code)
+        CountingHandler.failures_left = 0
+
+    def test_unknown_option(self):
+        with self.assertRaises(ValueError):
+            http_client.configure(pool_size=3)
+
+
+class FakeRawResponse:
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def read1(self, amt):
+        return self.chunks.pop(0) if self.chunks else b""
+
+
+class FakeStreamedResponse:
+    def __init__(self, chunks):
+        self.raw = FakeRawResponse(chunks)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class SseReaderTests(unittest.TestCase):
+    def test_lines_split_across_chunks(self):
+        resp = FakeStreamedResponse([b'data: {"a"', b': 1}\n\ndata: {"b": 2}\r\n', b'\r\ndata: {"c": 3}'])
+        self.assertEqual([b'{"a": 1}', b'{"b": 2}', b'{"c": 3}'], list(iter_sse_data(resp)))
+
+    def test_other_lines_are_skipped(self):
+        resp = FakeStreamedResponse([b': comment\nevent: x\ndata:\ndata: {}\n\n'])
+        self.assertEqual([b'{}'], list(iter_sse_data(resp)))
+
+    def test_padded_llava_lines(self):
+        resp = FakeStreamedResponse([b'______{"content": "a"}\n______{"content"', b': "b"}\n'])
+        self.assertEqual([b'{"content": "a"}', b'{"content": "b"}'], list(iter_sse_data(resp)))
+
+    def test_llama_cpp_stream(self):
+        events = [{"content": "Hello", "stop": False}, {"content": " world", "stop": False},
+                  {"content": "", "stop": True, "stopping_word": "", "tokens_cached": 5}]
+        body = b''.join(b'data: ' + json.dumps(e).encode() + b'\n\n' for e in events)
+        resp = FakeStreamedResponse([body[:10], body[10:]])
+
+        llm = LlamaCpp("http://llm", GenerationSpec({}))
+        llm.start_streaming = lambda *args: resp
+        self.assertEqual(["Hello", " world", ""], list(llm("prompt")))
+        self.assertEqual(5, llm.response_data["tokens_cached"])
+        self.assertTrue(resp.closed)
+
+
+class StreamingLatencyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+    received = None
+
+    def do_POST(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'data: {"content": "first", "stop": false}\n\n')
+        self.wfile.flush()
+        # the rest of the response is sent only after the client has seen the first event
+        StreamingLatencyHandler.received.wait(5)
+        self.wfile.write(b'data: {"content": "", "stop": true, "stopping_word": ""}\n\n')
+
+    def log_message(self, *args):
+        pass
+
+
+class SseStreamingTests(unittest.TestCase):
+    def test_events_are_delivered_before_response_ends(self):
+        StreamingLatencyHandler.received = threading.Event()
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StreamingLatencyHandler)
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        try:
+            llm = LlamaCpp(f'http://127.0.0.1:{server.server_address[1]}', GenerationSpec({}))
+            tokens = llm("prompt")
+            self.assertEqual("first", next(tokens))
+            StreamingLatencyHandler.received.set()
+            self.assertEqual([""], list(tokens))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class AsyncTokens:
+    """Async LLM yielding given tokens, recording whether the stream was closed"""
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.closed = False
 
-        text, token = finilize_response("```some text`", "``")
-        self.assertEqual(expected_text, text)
-        self.assertEqual("``", token)
-
-        text, token = finilize_response("```some text``", "`")
-        self.assertEqual(expected_text, text)
-        self.assertEqual("`", token)
-
-        text, token = finilize_response("```some text```", "```suffix")
-        self.assertEqual(expected_text, text)
-        self.assertEqual("", token)
-
-        text, token = finilize_response("```some text", "```something else")
-        self.assertEqual(expected_text, text)
-        self.assertEqual("```", token)
-
-        text, token = finilize_response("```some text`", "```")
-        self.assertEqual(expected_text, text)
-        self.assertEqual("``", token)
+    async def __call__(self, input_text):
+        try:
+            for token in self.responses.pop(0):
+                await asyncio.sleep(0)
+                yield token
+        finally:
+            self.closed = True
+
+
+class AsyncTextCompleterTests(unittest.TestCase):
+    def test_stops_after_closing_fence(self):
+        llm = AsyncTokens(["Sure:\n``", "`python\nprint(1)\n`", "``\nmore", " text"])
+        completer = AsyncTextCompleter(llm)
+        received = []
+        completer.on_token = received.append
+
+        response = asyncio.run(completer("prompt"))
+        self.assertEqual("Sure:\n```python\nprint(1)\n```", response)
+        self.assertEqual(["Sure:\n``", "`python\nprint(1)\n`", "``"], received)
+        self.assertTrue(llm.closed)
+
+
+def done_call(answer):
+    body = json.dumps({"tool_name": "done_tool", "args": {"answer": answer}})
+    return ["<|tool_use_start|>", body, "<|tool_use_end|>"]
+
+
+class TokenRecorder(OutputDevice):
+    def __init__(self):
+        super().__init__()
+        self.tokens = []
+
+    def on_token(self, token):
+        self.tokens.append(token)
+
+
+class AsyncAgentTests(unittest.TestCase):
+    def create_agent(self, llm, tools=None, output_device=None):
+        return AsyncAgent(llm, tools or {}, output_device=output_device or OutputDevice(),
+                          temp_output_device=OutputDevice())
+
+    def test_done_tool(self):
+        agent = self.create_agent(AsyncTokens(["Done. "] + done_call(42)))
+        self.assertEqual({"answer": 42}, asyncio.run(agent("question")))
+
+    def test_possible_tag_start_at_end_of_round_is_streamed(self):
+        device = TokenRecorder()
+        agent = self.create_agent(AsyncTokens(["1 ", "<|"], done_call(1)), output_device=device)
+        asyncio.run(agent("question"))
+        self.assertEqual("1 <|", "".join(device.tokens))
+
+    def test_tool_calls_do_not_block_other_agents(self):
+        other_generated = threading.Event()
+
+        def wait_for_other(**kwargs):
+            # blocks a worker thread until the other agent has generated its response
+            return other_generated.wait(5)
+
+        tool_call = json.dumps({"tool_name": "wait_for_other", "args": {}})
+        first = self.create_agent(
+            AsyncTokens(["<|tool_use_start|>", tool_call, "<|tool_use_end|>"], done_call("first")),
+            tools={"wait_for_other": wait_for_other}
+        )
+        second = self.create_agent(AsyncTokens(done_call("second")))
+        second.add_listener("tool_call_started", lambda **kwargs: other_generated.set())
+
+        async def run_both():
+            return await asyncio.gather(first("question"), second("question"))
+
+        self.assertEqual([{"answer": "first"}, {"answer": "second"}], asyncio.run(run_both()))
+        self.assertIn('"result": true', first.history[-3].content.render())
+
+
+class UnterminatedEventHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_POST(self):
+        self.send_response(200)
+        self.end_headers()
+        # the last event is not followed by a newline
+        self.wfile.write(b'data: {"content": "first", "stop": false}\n\n')
+        self.wfile.write(b'data: {"content": "", "stop": true, "stopping_word": ""}')
+
+    def log_message(self, *args):
+        pass
+
+
+class AsyncLlamaCppTests(unittest.TestCase):
+    def start_server(self, handler_class):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f'http://127.0.0.1:{server.server_address[1]}'
+
+    def test_events_are_delivered_before_response_ends(self):
+        StreamingLatencyHandler.received = threading.Event()
+        url = self.start_server(StreamingLatencyHandler)
+
+        async def generate():
+            llm = AsyncLlamaCpp(url, GenerationSpec({}))
+            tokens = []
+            async for token in llm("prompt"):
+                tokens.append(token)
+                StreamingLatencyHandler.received.set()
+            return tokens, llm.response_data
+
+        tokens, response_data = asyncio.run(generate())
+        self.assertEqual(["first", ""], tokens)
+        self.assertTrue(response_data["stop"])
+
+    def test_unterminated_last_event(self):
+        url = self.start_server(UnterminatedEventHandler)
+
+        async def generate():
+            llm = AsyncLlamaCpp(url, GenerationSpec({}))
+            return [token async for token in llm("prompt")], llm.response_data
+
+        tokens, response_data = asyncio.run(generate())
+        self.assertEqual(["first", ""], tokens)
+        self.assertTrue(response_data["stop"])
+
+    def test_client_is_closed_only_when_owned(self):
+        url = self.start_server(UnterminatedEventHandler)
+        created = []
+
+        def create_client():
+            created.append(create_async_client())
+            return created[-1]
+
+        async def generate(client=None):
+            llm = AsyncLlamaCpp(url, GenerationSpec({}), client=client)
+            return [token async for token in llm("prompt")]
+
+        async def run():
+            await generate()
+            async with create_async_client() as shared:
+                await generate(shared)
+                return created[0].is_closed, shared.is_closed, len(created)
+
+        create_async_client = http_client.create_async_client
+        http_client.create_async_client = create_client
+        try:
+            owned_closed, shared_closed, num_created = asyncio.run(run())
+        finally:
+            http_client.create_async_client = create_async_client
+
+        self.assertTrue(owned_closed)
+        self.assertFalse(shared_closed)
+        self.assertEqual(1, num_created)
@@ -0,0 +1,222 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+import redis.asyncio as redis
+import websocket_server
+from websocket_server import SessionHub, StreamHub, parse_hello
+
+
+class ParseHelloTests(unittest.TestCase):
+    def test_bare_session_id(self):
+        self.assertEqual(('session', None), parse_hello('session'))
+
+    def test_reconnect_hello(self):
+        hello = json.dumps({"session_id": 42, "last_id": "1700000000000-3"})
+        self.assertEqual(('42', '1700000000000-3'), parse_hello(hello))
+
+    def test_malformed_last_id_is_ignored(self):
+        for last_id in ["abc", "1-2\n", "1-2-3", "-1-2", "1", "", 12, None, ["1-2"], "١-٢"]:
+            with self.subTest(last_id=last_id):
+                hello = json.dumps({"session_id": "session", "last_id": last_id})
+                self.assertEqual(('session', None), parse_hello(hello))
+
+    def test_missing_session_id(self):
+        with self.assertRaises(KeyError):
+            parse_hello('{"last_id": "1-0"}')
+
+
+class FlakyHub(SessionHub):
+    """Fails with the given errors, then listens until cancelled"""
+    def __init__(self, errors):
+        super().__init__('redis://localhost', reconnect_delay=0)
+        self.errors = list(errors)
+        self.calls = 0
+        self.listening = asyncio.Event()
+
+    async def listen(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.listening.set()
+        await asyncio.Future()
+
+
+class SessionHubTests(unittest.TestCase):
+    def test_messages_are_routed_by_session(self):
+        async def run():
+            hub = SessionHub('redis://localhost')
+            first, _ = await hub.register('first')
+            second, _ = await hub.register('second')
+
+            hub.dispatch(b'token_stream:first', b'{"event": "token"}')
+            hub.unregister('second', second)
+            hub.dispatch(b'token_stream:second', b'{"event": "token"}')
+            return first.get_nowait(), second.empty(), hub.sessions
+
+        frame, second_empty, sessions = asyncio.run(run())
+        self.assertEqual(b'{"event": "token"}', frame)
+        self.assertTrue(second_empty)
+        self.assertEqual([b'first'], list(sessions))
+
+    def test_hub_survives_errors(self):
+        async def run():
+            hub = FlakyHub([redis.ConnectionError('lost'), redis.ResponseError('bad id'), ValueError('bad')])
+            task = asyncio.create_task(hub.run())
+            await asyncio.wait_for(hub.listening.wait(), timeout=5)
+            task.cancel()
+            return hub.calls
+
+        with self.assertLogs('websocket_server', level='ERROR'):
+            self.assertEqual(4, asyncio.run(run()))
+
+    def test_slow_consumer_is_disconnected(self):
+        async def run():
+            hub = SessionHub('redis://localhost')
+            hub.queue_size = 2
+            queue, _ = await hub.register('session')
+            for i in range(3):
+                hub.dispatch(b'token_stream:session', b'{"event": "token"}')
+
+            websocket = FakeWebSocket('session')
+            await asyncio.wait_for(websocket_server.forward(queue, websocket), timeout=5)
+            return websocket
+
+        with self.assertLogs('websocket_server', level='WARNING'):
+            websocket = asyncio.run(run())
+        self.assertEqual([], websocket.sent)
+        self.assertEqual(1013, websocket.close_code)
+
+
+class LostConnection:
+    """Redis client whose subscriptions fail, recording whether it was closed"""
+    def __init__(self):
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed = True
+
+    def pubsub(self):
+        return self
+
+    async def psubscribe(self, *patterns):
+        raise redis.ConnectionError('lost')
+
+    async def xread(self, *args, **kwargs):
+        raise redis.ConnectionError('lost')
+
+
+class ConnectionCleanupTests(unittest.TestCase):
+    def listen(self, hub):
+        connection = LostConnection()
+        with mock.patch.object(websocket_server.redis, 'from_url', return_value=connection):
+            with self.assertRaises(redis.ConnectionError):
+                asyncio.run(hub.listen())
+        return connection
+
+    def test_session_hub_closes_its_client(self):
+        self.assertTrue(self.listen(SessionHub('redis://localhost')).closed)
+
+    def test_stream_hub_closes_its_client(self):
+        async def stream_hub():
+            hub = StreamHub('redis://localhost')
+            await hub.register('session')
+            return hub
+
+        self.assertTrue(self.listen(asyncio.run(stream_hub())).closed)
+
+
+class FakeStreams:
+    def __init__(self, entries):
+        self.entries = entries
+        self.ranges = []
+
+    async def xrange(self, key, min, max):
+        self.ranges.append((key, min, max))
+        return self.entries
+
+
+class StreamHubTests(unittest.TestCase):
+    def test_missed_entries_are_fetched_for_another_socket_of_session(self):
+        entries = [(b'5-0', {b'payload': b'{"event": "token", "data": "a"}'})]
+
+        async def run():
+            hub = StreamHub('redis://localhost')
+            hub.connection = FakeStreams(entries)
+            _, first_backlog = await hub.register('session', '3-0')
+            hub.dispatch_entry(b'session', b'6-0', {b'payload': b'{"event": "token", "data": "b"}'})
+            _, backlog = await hub.register('session', '4-0')
+            return hub, first_backlog, backlog
+
+        hub, first_backlog, backlog = asyncio.run(run())
+        self.assertEqual([], first_backlog)
+        self.assertEqual([b'{"id":"5-0","event": "token", "data": "a"}'], backlog)
+        self.assertEqual([(b'session_events:session', b'(4-0', b'6-0')], hub.connection.ranges)
+
+    def test_session_without_last_id_is_read_from_start(self):
+        async def run():
+            hub = StreamHub('redis://localhost')
+            await hub.register('session')
+            return hub.offsets
+
+        self.assertEqual({b'session': b'0-0'}, asyncio.run(run()))
+
+
+class FakeWebSocket:
+    def __init__(self, hello):
+        self.hello = hello
+        self.sent = []
+        self.close_code = None
+
+    async def recv(self):
+        return self.hello
+
+    async def send(self, frame, text=False):
+        self.sent.append(frame)
+
+    async def close(self, code=1000, reason=''):
+        self.close_code = code
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # the client disconnects right after the hello
+        await asyncio.sleep(0.01)
+        raise StopAsyncIteration
+
+
+class RecordingHub(SessionHub):
+    def __init__(self):
+        super().__init__('redis://localhost')
+        self.registered = []
+
+    async def register(self, session_id, last_id=None):
+        self.registered.append((session_id, last_id))
+        queue, _ = await super().register(session_id, last_id)
+        return queue, [b'{"id":"1-0","event":"token"}']
+
+
+class HandlerTests(unittest.TestCase):
+    def setUp(self):
+        self.original_hub = websocket_server.hub
+        websocket_server.hub = RecordingHub()
+
+    def tearDown(self):
+        websocket_server.hub = self.original_hub
+
+    def test_backlog_is_sent_and_session_unregistered(self):
+        websocket = FakeWebSocket('{"session_id": "session", "last_id": "not an id"}')
+        asyncio.run(websocket_server.handler(websocket))
+
+        self.assertEqual([('session', None)], websocket_server.hub.registered)
+        self.assertEqual([b'{"id":"1-0","event":"token"}'], websocket.sent)
+        self.assertEqual({}, websocket_server.hub.sessions)
+
+    def test_malformed_hello_is_dropped(self):
+        with self.assertLogs('websocket_server', level='WARNING'):
+            asyncio.run(websocket_server.handler(FakeWebSocket('{"last_id": "1-0"}')))
+        self.assertEqual([], websocket_server.hub.registered)
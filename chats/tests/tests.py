@@ -1,11 +1,33 @@
 import unittest
 import base64
-from io import BytesIO
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import wave
+from queue import Queue
+from io import BytesIO, StringIO
+from unittest import mock
 from dataclasses import dataclass
-from django.test import TestCase
+from datetime import timedelta
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.core.management import call_command
+from django.core.files.base import ContentFile
 from django.contrib.auth.models import User
+from django.utils import timezone
 from chats.tests.common import default_configuration_data, default_preset_data, default_system_msg_data
-from chats import models, serializers
+from chats import models, serializers, tasks, tts_cache, audio_compression
+from chats.utils import WavConcatenator, WavFormatError
+import tts
+from tts.backends import RemoteTtsBackend
+from pygentify import http_client
+from pygentify.messages import JinjaChatFactory
 from django.db.models import Model
 from rest_framework.serializers import BaseSerializer
 
@@ -462,6 +484,7 @@ class MessageCreateTestCase(AbstractViewSetTestCase, EndPointCreateTests):
                     audio=None,
                     image=None,
                     image_b64=None,
+                    image_ref=None,
                     attached_files=[])
 
     def test_image_upload(self):
@@ -542,6 +565,116 @@ class MessageCreateTestCase(AbstractViewSetTestCase, EndPointCreateTests):
 
         # todo: more tests: unauthorized message create at nth level, missing parent ids, chat_ids, etc.
 
+class MessageImageTests(TestCase):
+    sample_img = (b"GIF89a\x01\x00\x01\x00\x00\x00\x00!\xf9\x04\x01\x00\x00\x00"
+                  b"\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x01\x00\x00")
+
+    def setUp(self):
+        self.credentials = dict(username="user", password="password")
+        self.user = User.objects.create_user(**self.credentials)
+
+        self.stranger_credentials = dict(username="stranger", password="stranger")
+        User.objects.create_user(**self.stranger_credentials)
+
+        image = ContentFile(self.sample_img, name="image.gif")
+        self.message = models.Message.objects.create(text="Look at this", image=image)
+        self.chat = models.Chat.objects.create(user=self.user, prompt=self.message)
+        self.image_url = f'/chats/messages/{self.message.pk}/image/'
+
+    def test_image_digest_is_computed_on_save(self):
+        self.assertEqual(hashlib.sha256(self.sample_img).hexdigest(), self.message.image_sha256)
+        self.assertEqual(len(self.sample_img), self.message.image_size)
+
+    def test_image_digest_is_recomputed_when_image_is_replaced(self):
+        other_img = self.sample_img.replace(b"\x01\x00\x00\x02", b"\x01\x00\x00\x03")
+        message = models.Message.objects.get(pk=self.message.pk)
+        message.image = ContentFile(other_img, name="image.gif")
+        message.save()
+
+        message = models.Message.objects.get(pk=self.message.pk)
+        self.assertEqual(hashlib.sha256(other_img).hexdigest(), message.image_sha256)
+
+        message.text = "Only the text changed"
+        message.save()
+        self.assertEqual(hashlib.sha256(other_img).hexdigest(), message.image_sha256)
+
+        message.image = None
+        message.save()
+        self.assertIsNone(models.Message.objects.get(pk=self.message.pk).image_sha256)
+
+    def test_image_is_inlined_by_default(self):
+        data = serializers.MessageSerializer(self.message).data
+        expected = "data:image/gif;base64," + base64.b64encode(self.sample_img).decode()
+        self.assertEqual(expected, data["image_b64"])
+        self.assertEqual(self.image_url, data["image_ref"]["url"])
+        self.assertEqual(self.message.image_sha256, data["image_ref"]["sha256"])
+        self.assertEqual(len(self.sample_img), data["image_ref"]["size"])
+
+    @override_settings(MESSAGE_IMAGE_MODE="url")
+    def test_image_is_referenced_by_url(self):
+        data = serializers.MessageSerializer(self.message).data
+        self.assertIsNone(data["image_b64"])
+        self.assertEqual(self.image_url, data["image_ref"]["url"])
+
+    def test_thumbnail_mode_of_treebank(self):
+        self.client.login(**self.credentials)
+        resp = self.client.get(f'/chats/treebanks/{self.chat.pk}/?image_mode=thumbnail')
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp.json()["image_b64"].startswith("data:image/jpeg;base64,"))
+
+    def test_owner_can_fetch_image(self):
+        self.client.login(**self.credentials)
+        resp = self.client.get(self.image_url)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(self.sample_img, b"".join(resp.streaming_content))
+
+        resp = self.client.get(self.image_url, HTTP_IF_NONE_MATCH=resp["ETag"])
+        self.assertEqual(304, resp.status_code)
+
+    @override_settings(MEDIA_X_ACCEL_REDIRECT_PREFIX="/protected-media/")
+    def test_image_is_handed_off_to_nginx(self):
+        self.client.login(**self.credentials)
+        resp = self.client.get(self.image_url)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("/protected-media/" + self.message.image.name, resp["X-Accel-Redirect"])
+        self.assertEqual(b"", resp.content)
+
+    def test_stranger_cannot_fetch_image(self):
+        self.client.login(**self.stranger_credentials)
+        resp = self.client.get(self.image_url)
+        self.assertEqual(404, resp.status_code)
+
+
+class MessageHtmlTests(TestCase):
+    def test_html_is_rendered_on_save(self):
+        message = models.Message.objects.create(text="Some *markdown*")
+        stored = models.Message.objects.get(pk=message.pk)
+        self.assertEqual("<p>Some <em>markdown</em></p>", stored.html)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(stored.html, stored.get_html())
+
+        self.assertEqual(stored.html, serializers.MessageSerializer(stored).data["html"])
+
+    def test_outdated_html_is_rendered_and_stored_lazily(self):
+        message = models.Message.objects.create(text="Some *markdown*")
+        models.Message.objects.filter(pk=message.pk).update(html=None, html_key=None)
+
+        stored = models.Message.objects.get(pk=message.pk)
+        self.assertEqual("<p>Some <em>markdown</em></p>", stored.get_html())
+        self.assertEqual(message.html_key, models.Message.objects.get(pk=message.pk).html_key)
+
+    def test_backfill_command(self):
+        message = models.Message.objects.create(text="Some *markdown*")
+        models.Message.objects.update(html=None, html_key=None)
+
+        call_command("backfill_message_html", stdout=StringIO())
+
+        stored = models.Message.objects.get(pk=message.pk)
+        self.assertEqual("<p>Some <em>markdown</em></p>", stored.html)
+        self.assertEqual(message.html_key, stored.html_key)
+
+
 class VoiceListTests(TestCase):
     # todo: more tests for edge cases (network errors, etc.)
 
@@ -561,6 +694,63 @@ class VoiceListTests(TestCase):
         self.assertEqual(403, resp.status_code)
 
 
+class FakeResponse:
+    def __init__(self, status_code=200, content=b'', json_data=None):
+        self.status_code = status_code
+        self.content = content
+        self.json_data = json_data
+
+    def json(self):
+        return self.json_data
+
+
+class FakeSession:
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        return self.response
+
+
+class RemoteTtsBackendTests(TestCase):
+    def setUp(self):
+        self.backend = RemoteTtsBackend('tts', 9000, use_tls=False)
+
+    def make_session(self, **response_fields):
+        session = FakeSession(FakeResponse(**response_fields))
+        patcher = mock.patch.object(http_client, 'get_session', return_value=session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return session
+
+    def test_list_voices(self):
+        voices = [{"voice_id": "Voice 1", "url": "/voice-sample/?voice_id=Voice 1"}]
+        session = self.make_session(json_data=voices)
+
+        self.assertEqual(voices, self.backend.list_voices())
+        method, url, kwargs = session.requests[0]
+        self.assertEqual(('GET', 'http://tts:9000/voices/'), (method, url))
+        self.assertIsNone(kwargs['data'])
+
+    def test_list_voices_of_failing_service(self):
+        self.make_session(status_code=500)
+        self.assertEqual([], self.backend.list_voices())
+
+    def test_get_voice_sample(self):
+        session = self.make_session(content=b'RIFF')
+        self.assertEqual(b'RIFF', self.backend.get_voice_sample('Voice 1'))
+        self.assertEqual('http://tts:9000/voice-sample/?voice_id=Voice 1', session.requests[0][1])
+
+    def test_synthesize(self):
+        session = self.make_session(content=b'RIFF')
+        self.assertEqual(b'RIFF', self.backend.synthesize('Hello', 'Voice 1'))
+        method, url, kwargs = session.requests[0]
+        self.assertEqual(('POST', 'http://tts:9000/tts/'), (method, url))
+        self.assertEqual({"text": "Hello", "voice_id": "Voice 1"}, json.loads(kwargs['data']))
+
+
 class TranscribeSpeechTests(TestCase):
     # todo: more tests for edge cases (network errors, etc.)
     def test_logged_in_user_can_transcribe(self):
@@ -623,6 +813,135 @@ class TreeBankTests(TestCase):
         self.assertEqual(403, resp.status_code)
 
 
+class TreebankSerializerTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="user", password="password")
+        self.root = models.Message.objects.create(text="Root")
+        models.Chat.objects.create(user=user, prompt=self.root)
+
+    def grow_tree(self, num_branches, depth):
+        for i in range(num_branches):
+            parent = self.root
+            for j in range(depth):
+                parent = models.Message.objects.create(text=f"Branch {i}, level {j}", parent=parent)
+                models.Attachment.objects.create(original_name=f"file_{i}_{j}.txt", file="f.txt",
+                                                 message=parent)
+
+    def test_replies_are_nested(self):
+        self.grow_tree(num_branches=2, depth=3)
+        data = serializers.TreebankSerializer(self.root).data
+
+        self.assertEqual(2, len(data["replies"]))
+        first, second = data["replies"]
+        self.assertEqual("Branch 0, level 0", first["text"])
+        self.assertEqual("Branch 1, level 0", second["text"])
+        self.assertEqual(["file_0_0.txt"], first["attached_files"])
+
+        leaf = first["replies"][0]["replies"][0]
+        self.assertEqual("Branch 0, level 2", leaf["text"])
+        self.assertEqual([], leaf["replies"])
+
+    def test_number_of_queries_does_not_depend_on_tree_size(self):
+        self.grow_tree(num_branches=1, depth=1)
+        with self.assertNumQueries(2):
+            serializers.TreebankSerializer(self.root).data
+
+        self.grow_tree(num_branches=10, depth=10)
+        with self.assertNumQueries(2):
+            serializers.TreebankSerializer(self.root).data
+
+
+class WindowedTreeBankTests(TestCase):
+    branch_url = '/chats/treebanks/{}/branch/'
+    replies_url = '/chats/messages/{}/replies/'
+
+    def setUp(self):
+        self.credentials = dict(username="user", password="password")
+        self.user = User.objects.create_user(**self.credentials)
+
+        self.stranger_credentials = dict(username="stranger", password="stranger")
+        User.objects.create_user(**self.stranger_credentials)
+
+        self.root = models.Message.objects.create(text="Root")
+        self.chat = models.Chat.objects.create(user=self.user, prompt=self.root)
+
+        self.first = models.Message.objects.create(parent=self.root, text="Response 1")
+        self.second = models.Message.objects.create(parent=self.root, text="Response 2")
+        models.Message.objects.create(parent=self.first, text="Follow up 1")
+        models.Message.objects.create(parent=self.second, text="Follow up 2")
+        models.Message.objects.create(parent=self.second, text="Follow up 3")
+
+    def get_branch(self, query=''):
+        self.client.login(**self.credentials)
+        resp = self.client.get(self.branch_url.format(self.chat.pk) + query)
+        self.assertEqual(200, resp.status_code, resp.json())
+        return resp.json()["messages"]
+
+    def test_default_branch_follows_first_replies(self):
+        messages = self.get_branch()
+        self.assertEqual(["Root", "Response 1", "Follow up 1"], [msg["text"] for msg in messages])
+        self.assertEqual([2, 1, 0], [msg["replies_count"] for msg in messages])
+        self.assertEqual([1, 2, 1], [msg["siblings_count"] for msg in messages])
+        self.assertEqual([0, 0, 0], [msg["branch_index"] for msg in messages])
+
+    def test_branch_through_given_message(self):
+        messages = self.get_branch(f'?message={self.second.pk}')
+        self.assertEqual(["Root", "Response 2", "Follow up 2"], [msg["text"] for msg in messages])
+        self.assertEqual([2, 2, 0], [msg["replies_count"] for msg in messages])
+        self.assertEqual([0, 1, 0], [msg["branch_index"] for msg in messages])
+
+    def test_image_mode_of_branch(self):
+        self.root.image = ContentFile(MessageImageTests.sample_img, name="image.gif")
+        self.root.save()
+
+        root = self.get_branch('?image_mode=url')[0]
+        self.assertIsNone(root["image_b64"])
+        self.assertEqual(f'/chats/messages/{self.root.pk}/image/', root["image_ref"]["url"])
+
+        root = self.get_branch('?image_mode=thumbnail')[0]
+        self.assertTrue(root["image_b64"].startswith("data:image/jpeg;base64,"))
+
+    def test_cannot_get_branch_through_message_of_other_chat(self):
+        other_root = models.Message.objects.create(text="Other root")
+        models.Chat.objects.create(user=self.user, prompt=other_root)
+
+        self.client.login(**self.credentials)
+        resp = self.client.get(self.branch_url.format(self.chat.pk) + f'?message={other_root.pk}')
+        self.assertEqual(404, resp.status_code)
+
+    def test_stranger_cannot_get_branch(self):
+        self.client.login(**self.stranger_credentials)
+        resp = self.client.get(self.branch_url.format(self.chat.pk))
+        self.assertEqual(404, resp.status_code)
+
+    def test_replies_are_paginated_with_cursor(self):
+        self.client.login(**self.credentials)
+        resp = self.client.get(self.replies_url.format(self.root.pk) + '?page_size=1')
+        self.assertEqual(200, resp.status_code)
+        page = resp.json()
+        self.assertEqual(["Response 1"], [msg["text"] for msg in page["results"]])
+        self.assertEqual(1, page["results"][0]["replies_count"])
+
+        page = self.client.get(page["next"]).json()
+        self.assertEqual(["Response 2"], [msg["text"] for msg in page["results"]])
+        self.assertEqual(1, page["results"][0]["branch_index"])
+        self.assertIsNone(page["next"])
+
+    def test_stranger_cannot_list_replies(self):
+        self.client.login(**self.stranger_credentials)
+        resp = self.client.get(self.replies_url.format(self.root.pk))
+        self.assertEqual(404, resp.status_code)
+
+    def test_replies_of_message_without_chat_are_not_found(self):
+        orphan = models.Message.objects.create(text="Orphan")
+        models.Message.objects.create(parent=orphan, text="Reply")
+
+        self.client.login(**self.credentials)
+        for message in [orphan, orphan.replies.get()]:
+            resp = self.client.get(self.replies_url.format(message.pk))
+            self.assertEqual(404, resp.status_code)
+
+
 class EmptyTreeBankTests(TestCase):
     def test_logged_user_receives_empty_dict_for_empty_chat_tree(self):
         credentials = dict(username="user", password="password")
@@ -636,6 +955,678 @@ class EmptyTreeBankTests(TestCase):
         self.assertEqual({}, resp.json())
 
 
+class BranchPathTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="user", password="password")
+        configuration = models.Configuration.objects.create(**default_configuration_data(user))
+
+        self.root = models.Message.objects.create(text="Message 0")
+        self.chat = models.Chat.objects.create(user=user, prompt=self.root, configuration=configuration)
+
+        parent = self.root
+        self.path = [self.root]
+        for i in range(1, 30):
+            parent = models.Message.objects.create(text=f"Message {i}", parent=parent)
+            self.path.append(parent)
+
+        models.Message.objects.create(text="Sibling branch", parent=self.path[10])
+
+    def test_branch_is_loaded_from_root_to_leaf(self):
+        history = models.Message.objects.branch(self.path[-1])
+        self.assertEqual([msg.pk for msg in self.path], [msg.pk for msg in history])
+
+    def test_branch_is_loaded_in_single_query(self):
+        with self.assertNumQueries(1):
+            history = models.Message.objects.branch(self.path[-1].pk)
+            self.assertEqual(self.chat.configuration.pk, history[0].chat.configuration.pk)
+            self.assertEqual(history[-2], history[-1].parent)
+
+    def test_branch_of_root_message(self):
+        history = models.Message.objects.branch(self.root)
+        self.assertEqual([self.root], history)
+
+    def test_initial_prompt_and_chat_of_nested_message(self):
+        leaf = models.Message.objects.get(pk=self.path[-1].pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.root, leaf.initial_prompt)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.chat, leaf.get_chat())
+
+
+class PromptStabilityTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="user", password="password")
+        configuration_data = dict(default_configuration_data(user), tools=["add"])
+        configuration = models.Configuration.objects.create(**configuration_data)
+
+        self.root = models.Message.objects.create(text="Question 0")
+        models.Chat.objects.create(user=user, prompt=self.root, configuration=configuration,
+                                   system_message="Be brief.")
+
+        self.path = [self.root]
+        for i in range(1, 6):
+            self.path.append(models.Message.objects.create(text=f"Message {i}", parent=self.path[-1]))
+
+    def render(self, leaf):
+        factory = JinjaChatFactory('llama3', None)
+        history = tasks.encode_chat_thread(models.Message.objects.branch(leaf))
+        return factory.get_chat_renderer()(history)
+
+    def test_prompt_of_branch_is_byte_identical_across_renders(self):
+        prompt = self.render(self.path[2])
+        self.assertIn("Be brief.", prompt)
+        self.assertIn("add", prompt)
+        self.assertEqual(prompt, self.render(self.path[2]))
+
+    def test_prompt_of_earlier_turn_is_prefix_of_later_turn(self):
+        earlier = self.render(self.path[2])
+        later = self.render(self.path[4])
+        self.assertTrue(later.startswith(earlier))
+
+
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+        self.streams = {}
+        self.ttls = {}
+
+    def publish(self, channel, payload):
+        self.published.append((channel, json.loads(payload)))
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def xadd(self, key, fields, maxlen=None, approximate=True):
+        entries = self.streams.setdefault(key, [])
+        entries.append(json.loads(fields['payload']))
+        del entries[:-maxlen]
+
+    def expire(self, key, seconds):
+        self.ttls[key] = seconds
+
+    def execute(self):
+        pass
+
+
+class NullSentenceProcessor:
+    def process_sentence(self, sentence):
+        pass
+
+
+class TokenCoalescingTests(TestCase):
+    def make_device(self, **coalesce_settings):
+        self.redis = FakeRedis()
+        with override_settings(**coalesce_settings):
+            return tasks.ProcessorDevice(self.redis, 'token_stream:1', NullSentenceProcessor())
+
+    def published_text(self):
+        return [msg['data'] for _, msg in self.redis.published]
+
+    def test_zero_window_publishes_every_token(self):
+        device = self.make_device(TOKEN_COALESCE_WINDOW=0)
+        device.send('Hello')
+        device.send(' world')
+        self.assertEqual(['Hello', ' world'], self.published_text())
+        self.assertEqual('tokens_arrived', self.redis.published[0][1]['event'])
+
+    def test_tokens_are_grouped_within_window(self):
+        device = self.make_device(TOKEN_COALESCE_WINDOW=60, TOKEN_COALESCE_MAX_BYTES=0)
+        device.send('Hello')
+        device.send(' world')
+        self.assertEqual([], self.published_text())
+
+        device.flush()
+        self.assertEqual(['Hello world'], self.published_text())
+
+    def test_sentence_boundary_flushes_immediately(self):
+        device = self.make_device(TOKEN_COALESCE_WINDOW=60, TOKEN_COALESCE_MAX_BYTES=0)
+        device.send('Hi')
+        device.send('!')
+        device.send(' And')
+        self.assertEqual(['Hi!'], self.published_text())
+
+    def test_byte_limit_flushes(self):
+        device = self.make_device(TOKEN_COALESCE_WINDOW=60, TOKEN_COALESCE_MAX_BYTES=4)
+        device.send('ab')
+        device.send('cd')
+        device.send('e')
+        self.assertEqual(['abcd'], self.published_text())
+
+    def test_window_expiry_flushes(self):
+        device = self.make_device(TOKEN_COALESCE_WINDOW=0.01, TOKEN_COALESCE_MAX_BYTES=0)
+        device.send('Hello')
+        time.sleep(0.02)
+        device.send(' world')
+        device.send(' again')
+        self.assertEqual(['Hello world'], self.published_text())
+
+
+class FakeSample:
+    def __init__(self, pk):
+        self.pk = pk
+
+    def get_absolute_url(self):
+        return f'/chats/speech-samples/{self.pk}/'
+
+
+class SlowConsumer(tasks.Consumer):
+    """Synthesizes the n-th of given sentences in delays[n] seconds"""
+    def __init__(self, delays, *args):
+        super().__init__(*args)
+        self.delays = delays
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+        self.threads = set()
+
+    def synthesize(self, sentence):
+        with tasks.get_tts_limit(self.voice_id):
+            with self.lock:
+                self.threads.add(threading.current_thread())
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+
+            index = int(sentence)
+            time.sleep(self.delays[index])
+
+            with self.lock:
+                self.running -= 1
+            return FakeSample(index), self.delays[index]
+
+
+class SpeechPipelineTests(TestCase):
+    def run_consumer(self, delays, voice_id='voice'):
+        redis_obj = FakeRedis()
+        queue = Queue()
+        consumer = SlowConsumer(delays, queue, redis_obj, 'session', voice_id)
+        consumer.start()
+        for i in range(len(delays)):
+            queue.put(str(i))
+        queue.put('')
+        consumer.join()
+        return consumer, [msg['data']['id'] for _, msg in redis_obj.published]
+
+    @override_settings(TTS_CONCURRENCY=3)
+    def test_samples_are_published_in_sentence_order(self):
+        # later sentences finish synthesis first
+        consumer, published = self.run_consumer([0.2, 0.1, 0.0, 0.0], voice_id='ordered_voice')
+        self.assertEqual([0, 1, 2, 3], published)
+        self.assertEqual([0, 1, 2, 3], [sample.pk for sample in consumer.samples])
+        self.assertEqual(3, consumer.max_running)
+
+    @override_settings(TTS_CONCURRENCY=3, TTS_VOICE_CONCURRENCY={'slow_voice': 1})
+    def test_concurrency_limit_of_voice(self):
+        consumer, published = self.run_consumer([0.02, 0.02, 0.02], voice_id='slow_voice')
+        self.assertEqual([0, 1, 2], published)
+        self.assertEqual(1, consumer.max_running)
+
+    @override_settings(TTS_CONCURRENCY=2)
+    def test_generations_share_pool_threads(self):
+        first, _ = self.run_consumer([0.02, 0.02], voice_id='shared_voice')
+        second, _ = self.run_consumer([0.02, 0.02], voice_id='shared_voice')
+        self.assertIs(tasks.get_tts_pool(), tasks.get_tts_pool())
+        self.assertLessEqual(len(first.threads | second.threads), 2)
+        self.assertTrue(all(thread.name.startswith('tts') for thread in first.threads))
+
+    def test_stats(self):
+        consumer, _ = self.run_consumer([0.05, 0.0], voice_id='stats_voice')
+        self.assertGreaterEqual(consumer.stats['time_to_first_audio'], 0.05)
+        self.assertGreaterEqual(consumer.stats['max_lag'], 0.05)
+        self.assertEqual(2, len(consumer.lags))
+
+    def test_without_voice(self):
+        consumer, published = self.run_consumer([0.0], voice_id=None)
+        self.assertEqual([], published)
+        self.assertEqual({}, consumer.stats)
+
+
+class CountingTtsBackend:
+    def __init__(self):
+        self.calls = []
+
+    def synthesize(self, text, voice_id):
+        self.calls.append((text, voice_id))
+        return b'RIFF' + text.encode('utf-8')
+
+
+class TtsCacheTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root, TTS_CACHE_ENABLED=True)
+        self.settings_override.enable()
+
+        self.original_backend = tts.tts_backend
+        self.backend = tts.tts_backend = CountingTtsBackend()
+        tts_cache.index.clear()
+        tts_cache.cache_size.reset()
+
+    def tearDown(self):
+        tts.tts_backend = self.original_backend
+        tts_cache.index.clear()
+        tts_cache.cache_size.reset()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_repeated_sentence_is_synthesized_once(self):
+        first = tasks.synthesize_speech('Sure.', 'voice')
+        second = tasks.synthesize_speech('  Sure. ', 'voice')
+
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual([('Sure.', 'voice')], self.backend.calls)
+        self.assertEqual(1, models.SpeechSample.objects.count())
+
+    def test_sample_is_reused_by_other_processes(self):
+        first = tasks.synthesize_speech('Here is the code:', 'voice')
+        # a process with an empty index finds the sample in the database
+        tts_cache.index.clear()
+        second = tasks.synthesize_speech('Here is the code:', 'voice')
+
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(1, len(self.backend.calls))
+
+    def test_voices_are_cached_separately(self):
+        tasks.synthesize_speech('Sure.', 'voice')
+        tasks.synthesize_speech('Sure.', 'other voice')
+        self.assertEqual(2, len(self.backend.calls))
+
+    def test_deleted_sample_is_synthesized_again(self):
+        sample = tasks.synthesize_speech('Sure.', 'voice')
+        models.SpeechSample.objects.filter(pk=sample.pk).delete()
+
+        new_sample = tasks.synthesize_speech('Sure.', 'voice')
+        self.assertNotEqual(sample.pk, new_sample.pk)
+        self.assertEqual(2, len(self.backend.calls))
+
+    def test_least_recently_used_samples_are_evicted(self):
+        # every sample takes 10 bytes
+        with override_settings(TTS_CACHE_MAX_BYTES=25):
+            first = tasks.synthesize_speech('First.', 'voice')
+            second = tasks.synthesize_speech('Second', 'voice')
+            tasks.synthesize_speech('First.', 'voice')
+            tasks.synthesize_speech('Third.', 'voice')
+
+        texts = sorted(models.SpeechSample.objects.values_list('text', flat=True))
+        self.assertEqual(['First.', 'Third.'], texts)
+        self.assertTrue(os.path.exists(first.audio.path))
+        self.assertFalse(os.path.exists(second.audio.path))
+
+    def test_cache_size_is_not_summed_on_every_store(self):
+        def count_sums(text):
+            with CaptureQueriesContext(connection) as queries:
+                tasks.synthesize_speech(text, 'voice')
+            return sum('SUM(' in query['sql'].upper() for query in queries.captured_queries)
+
+        with override_settings(TTS_CACHE_MAX_BYTES=25):
+            self.assertEqual(1, count_sums('First.'))
+            self.assertEqual(0, count_sums('Second'))
+            # the running total exceeds the limit
+            self.assertEqual(1, count_sums('Third.'))
+
+        self.assertEqual(20, tts_cache.cache_size.total)
+
+    def test_cache_size_is_read_again_after_interval(self):
+        # samples stored by other processes are only seen in the database
+        tasks.synthesize_speech('First.', 'voice')
+        self.assertFalse(tts_cache.cache_size.add(10))
+
+        with override_settings(TTS_CACHE_SIZE_CHECK_INTERVAL=0):
+            time.sleep(0.01)
+            self.assertTrue(tts_cache.cache_size.add(10))
+
+    def test_only_duplicate_sentences_wait_for_synthesis(self):
+        other_synthesized = threading.Event()
+        calls = []
+
+        def synthesize(text, voice_id):
+            calls.append(text)
+            if text == 'Slow.':
+                # would time out if synthesis of another sentence had to wait for this one
+                self.assertTrue(other_synthesized.wait(5))
+            else:
+                other_synthesized.set()
+            return b'RIFF'
+
+        results = {}
+
+        def get(name, text):
+            results[name] = tts_cache.get_or_synthesize(text, 'voice', synthesize)
+
+        with mock.patch.object(tts_cache, 'lookup', return_value=None), \
+                mock.patch.object(tts_cache, 'store', side_effect=lambda key, *args: key):
+            threads = [threading.Thread(target=get, args=('first', 'Slow.'))]
+            threads[0].start()
+            while not calls:
+                time.sleep(0.001)
+            threads += [threading.Thread(target=get, args=args) for args in [('second', 'Slow.'), ('other', 'Fast.')]]
+            threads[1].start()
+            # the duplicate is waiting before the other sentence lets the first synthesis finish
+            time.sleep(0.05)
+            threads[2].start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(['Slow.', 'Fast.'], calls)
+        self.assertEqual(results['first'], results['second'])
+        self.assertEqual({}, tts_cache._in_flight)
+
+    @override_settings(TTS_CACHE_ENABLED=False)
+    def test_disabled_cache(self):
+        tasks.synthesize_speech('Sure.', 'voice')
+        tasks.synthesize_speech('Sure.', 'voice')
+        self.assertEqual(2, len(self.backend.calls))
+
+
+def make_wav(frames, framerate=16000, sampwidth=2):
+    buffer = BytesIO()
+    with wave.open(buffer, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(sampwidth)
+        w.setframerate(framerate)
+        w.writeframes(frames)
+    buffer.seek(0)
+    return buffer
+
+
+class WavConcatenatorTests(TestCase):
+    def test_frames_are_appended_in_order(self):
+        output = BytesIO()
+        concatenator = WavConcatenator(output)
+        concatenator.block_frames = 2
+        concatenator.add(make_wav(b'\x01\x00\x02\x00\x03\x00'))
+        concatenator.add(make_wav(b'\x04\x00'))
+        self.assertEqual(4, concatenator.close())
+
+        output.seek(0)
+        with wave.open(output, 'rb') as result:
+            self.assertEqual((1, 2, 16000, 4), result.getparams()[:4])
+            self.assertEqual(b'\x01\x00\x02\x00\x03\x00\x04\x00', result.readframes(10))
+
+    def test_mismatched_format_is_rejected(self):
+        output = BytesIO()
+        concatenator = WavConcatenator(output)
+        concatenator.add(make_wav(b'\x01\x00'))
+        with self.assertRaises(WavFormatError):
+            concatenator.add(make_wav(b'\x02\x00', framerate=22050))
+        with self.assertRaises(WavFormatError):
+            concatenator.add(make_wav(b'\x02', sampwidth=1))
+        self.assertEqual(1, concatenator.close())
+
+
+class MessageAudioBuilderTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def make_sample(self, frames, **wav_params):
+        sample = models.SpeechSample(text='text')
+        sample.audio = ContentFile(make_wav(frames, **wav_params).read(), name='sample.wav')
+        sample.save()
+        return sample
+
+    def test_message_audio_is_built_from_samples(self):
+        builder = tasks.MessageAudioBuilder()
+        builder.add(self.make_sample(b'\x01\x00'))
+        builder.add(self.make_sample(b'\x02\x00', framerate=8000))
+        builder.add(self.make_sample(b'\x03\x00'))
+        name = builder.finish()
+
+        message = tasks.create_response_message(None, 'text', name)
+        with wave.open(message.audio.path, 'rb') as result:
+            self.assertEqual(b'\x01\x00\x03\x00', result.readframes(10))
+        self.assertTrue(message.audio.name.startswith('uploads/audio/'))
+
+    def test_without_samples(self):
+        builder = tasks.MessageAudioBuilder()
+        self.assertIsNone(builder.finish())
+        self.assertFalse(tasks.create_response_message(None, 'text', None).audio)
+
+    def test_discard(self):
+        builder = tasks.MessageAudioBuilder()
+        builder.add(self.make_sample(b'\x01\x00'))
+        path = os.path.join(self.media_root, builder.name)
+        builder.discard()
+        self.assertFalse(os.path.exists(path))
+
+
+# stands in for ffmpeg: the "compressed" copy is the original with a marker in front
+FAKE_ENCODER = [sys.executable, "-c",
+                "import sys; data = open(sys.argv[1], 'rb').read(); open(sys.argv[2], 'wb').write(b'OggS' + data)",
+                "{input}", "{output}"]
+
+
+class AudioCompressionTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root,
+                                                   AUDIO_COMPRESSION_COMMAND=FAKE_ENCODER,
+                                                   AUDIO_WAV_RETENTION_DAYS=7)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def make_sample(self, data=b'RIFFdata', **fields):
+        sample = models.SpeechSample(text='text', **fields)
+        sample.audio = ContentFile(data, name='sample.wav')
+        sample.save()
+        return sample
+
+    def make_message(self):
+        message = models.Message(text='text')
+        message.audio = ContentFile(b'RIFFmessage', name='message.wav')
+        message.save()
+        return message
+
+    def age(self, instance, days):
+        made = timezone.now() - timedelta(days=days)
+        type(instance).objects.filter(pk=instance.pk).update(date_time=made)
+
+    def test_compressed_copy_is_served(self):
+        sample = self.make_sample()
+        name = audio_compression.compress(sample)
+
+        self.assertTrue(name.startswith('uploads/audio/sample'))
+        self.assertTrue(name.endswith('.ogg'))
+        sample.refresh_from_db()
+        self.assertEqual(name, sample.audio_compressed.name)
+        self.assertEqual('/media/' + name, serializers.SpeechSampleSerializer(sample).data['audio'])
+
+        resp = self.client.get(f'/chats/speech-samples/{sample.pk}/')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('audio/ogg', resp['Content-Type'])
+        self.assertEqual(b'OggSRIFFdata', b''.join(resp.streaming_content))
+
+    def test_original_is_served_until_compressed(self):
+        message = self.make_message()
+        data = serializers.MessageSerializer(message).data
+        self.assertEqual(f'/chats/messages/{message.pk}/audio/', data['audio'])
+
+        sample = self.make_sample()
+        resp = self.client.get(f'/chats/speech-samples/{sample.pk}/')
+        self.assertEqual(b'RIFFdata', b''.join(resp.streaming_content))
+
+    @override_settings(AUDIO_COMPRESSION_COMMAND=[sys.executable, "-c", "import sys; sys.exit('no encoder')"])
+    def test_failed_encoding(self):
+        sample = self.make_sample()
+        self.assertIsNone(audio_compression.compress(sample))
+
+        sample.refresh_from_db()
+        self.assertFalse(sample.audio_compressed)
+        self.assertEqual(['sample.wav'], os.listdir(os.path.join(self.media_root, 'uploads', 'audio')))
+
+    def test_compression_is_disabled_by_default(self):
+        self.assertIsNone(audio_compression.schedule(self.make_sample()))
+
+    def test_expired_originals_are_pruned(self):
+        old_message = self.make_message()
+        recent_message = self.make_message()
+        old_sample = self.make_sample()
+        cached_sample = self.make_sample(cache_key='key')
+        for instance in (old_message, recent_message, old_sample, cached_sample):
+            audio_compression.compress(instance)
+        for instance in (old_message, old_sample, cached_sample):
+            self.age(instance, days=8)
+        old_path = old_message.audio.path
+
+        self.assertEqual(2, audio_compression.prune_originals())
+
+        old_message.refresh_from_db()
+        self.assertFalse(old_message.audio)
+        self.assertFalse(os.path.exists(old_path))
+        self.assertEqual(old_message.audio_compressed, old_message.playable_audio)
+
+        recent_message.refresh_from_db()
+        cached_sample.refresh_from_db()
+        self.assertTrue(os.path.exists(recent_message.audio.path))
+        # cached samples are concatenated into message audio
+        self.assertTrue(os.path.exists(cached_sample.audio.path))
+
+    def test_originals_without_copy_are_kept(self):
+        message = self.make_message()
+        self.age(message, days=8)
+        self.assertEqual(0, audio_compression.prune_originals())
+
+    def test_command_compresses_older_files(self):
+        message = self.make_message()
+        sample = self.make_sample()
+
+        out = StringIO()
+        call_command('compress_audio', '--no-prune', stdout=out)
+        self.assertIn('Compressed 2 audio file(s)', out.getvalue())
+
+        message.refresh_from_db()
+        sample.refresh_from_db()
+        self.assertTrue(message.audio_compressed.name.endswith('.ogg'))
+        self.assertTrue(sample.audio_compressed.name.endswith('.ogg'))
+
+
+class AudioDeliveryTests(TestCase):
+    audio = bytes(range(10))
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.sample = models.SpeechSample(text='text')
+        self.sample.audio = ContentFile(self.audio, name='sample.wav')
+        self.sample.save()
+        self.sample_url = f'/chats/speech-samples/{self.sample.pk}/'
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def fetch(self, url=None, **headers):
+        return self.client.get(url or self.sample_url, **headers)
+
+    def test_whole_file_is_streamed(self):
+        resp = self.fetch()
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp.streaming)
+        self.assertEqual(self.audio, b''.join(resp.streaming_content))
+        self.assertEqual('10', resp['Content-Length'])
+        self.assertEqual('bytes', resp['Accept-Ranges'])
+        self.assertIn('ETag', resp)
+        self.assertIn('Last-Modified', resp)
+
+    def test_byte_ranges(self):
+        cases = [('bytes=2-5', 2, 5), ('bytes=4-', 4, 9), ('bytes=-3', 7, 9), ('bytes=8-100', 8, 9)]
+        for header, first, last in cases:
+            with self.subTest(header=header):
+                resp = self.fetch(HTTP_RANGE=header)
+                self.assertEqual(206, resp.status_code)
+                self.assertEqual(self.audio[first:last + 1], b''.join(resp.streaming_content))
+                self.assertEqual(str(last - first + 1), resp['Content-Length'])
+                self.assertEqual(f'bytes {first}-{last}/10', resp['Content-Range'])
+
+    def test_unsupported_ranges_get_whole_file(self):
+        for header in ['bytes=0-1,4-5', 'bytes=5-2', 'items=0-1', 'bytes=-']:
+            with self.subTest(header=header):
+                resp = self.fetch(HTTP_RANGE=header)
+                self.assertEqual(200, resp.status_code)
+                self.assertEqual(self.audio, b''.join(resp.streaming_content))
+
+    def test_unsatisfiable_range(self):
+        resp = self.fetch(HTTP_RANGE='bytes=10-')
+        self.assertEqual(416, resp.status_code)
+        self.assertEqual('bytes */10', resp['Content-Range'])
+
+    def test_range_of_changed_file_gets_whole_file(self):
+        resp = self.fetch(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"outdated"')
+        self.assertEqual(200, resp.status_code)
+
+        etag = self.fetch()['ETag']
+        resp = self.fetch(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=etag)
+        self.assertEqual(206, resp.status_code)
+
+    def test_conditional_requests(self):
+        resp = self.fetch()
+        self.assertEqual(304, self.fetch(HTTP_IF_NONE_MATCH=resp['ETag']).status_code)
+        self.assertEqual(304, self.fetch(HTTP_IF_MODIFIED_SINCE=resp['Last-Modified']).status_code)
+        self.assertEqual(200, self.fetch(HTTP_IF_NONE_MATCH='"other"').status_code)
+
+    @override_settings(MEDIA_X_ACCEL_REDIRECT_PREFIX="/protected-media/")
+    def test_audio_is_handed_off_to_nginx(self):
+        resp = self.fetch(HTTP_RANGE='bytes=2-5')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("/protected-media/" + self.sample.audio.name, resp["X-Accel-Redirect"])
+        self.assertEqual(b"", resp.content)
+
+    def test_samples_are_not_listed(self):
+        self.assertEqual(404, self.client.get('/chats/speech-samples/').status_code)
+
+    def test_missing_file(self):
+        self.sample.audio.delete(save=False)
+        self.assertEqual(404, self.fetch().status_code)
+
+    def test_message_audio_is_served_to_owner(self):
+        credentials = dict(username="user", password="password")
+        user = User.objects.create_user(**credentials)
+        User.objects.create_user(username="stranger", password="stranger")
+
+        message = models.Message(text='text')
+        message.audio = ContentFile(self.audio, name='message.wav')
+        message.save()
+        models.Chat.objects.create(user=user, prompt=message)
+        url = f'/chats/messages/{message.pk}/audio/'
+
+        self.client.login(**credentials)
+        resp = self.fetch(url, HTTP_RANGE='bytes=0-3')
+        self.assertEqual(206, resp.status_code)
+        self.assertEqual(self.audio[:4], b''.join(resp.streaming_content))
+
+        self.client.login(username="stranger", password="stranger")
+        self.assertEqual(404, self.fetch(url).status_code)
+
+
+class EventTransportTests(TestCase):
+    def test_pubsub_transport_publishes_to_channel(self):
+        redis_obj = FakeRedis()
+        tasks.publish_event(redis_obj, 'speech_stream:42', 'end_of_speech', tasks.STOP_SPEECH)
+        self.assertEqual([('speech_stream:42', {'event': 'end_of_speech', 'data': tasks.STOP_SPEECH})],
+                         redis_obj.published)
+
+    @override_settings(EVENT_TRANSPORT='streams', EVENT_STREAM_MAXLEN=2, EVENT_STREAM_TTL=60)
+    def test_streams_transport_appends_to_capped_session_stream(self):
+        redis_obj = FakeRedis()
+        tasks.publish_event(redis_obj, 'token_stream:42', 'tokens_arrived', 'a')
+        tasks.publish_event(redis_obj, 'build_events:42', 'build_started', {})
+        tasks.publish_event(redis_obj, 'token_stream:42', 'tokens_arrived', 'b')
+
+        self.assertEqual([], redis_obj.published)
+        self.assertEqual([{'event': 'build_started', 'data': {}}, {'event': 'tokens_arrived', 'data': 'b'}],
+                         redis_obj.streams['session_events:42'])
+        self.assertEqual(60, redis_obj.ttls['session_events:42'])
+
+
 class ReplyGenerationTests(TestCase):
     def test_anonymous_user_cannot_generate_text(self):
         resp = self.client.post("/chats/generate_reply/")
@@ -843,11 +1834,26 @@ def load_tests(loader, standard_tests, pattern):
     suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(ChatCreateRetrieveDeleteTestCase))
     suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(ChatPatchTestCase))
     suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(MessageCreateTestCase))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(MessageImageTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(MessageHtmlTests))
     suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(VoiceListTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(RemoteTtsBackendTests))
     suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TranscribeSpeechTests))
     suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TreeBankTests))
     suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(ReplyGenerationTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TokenCoalescingTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(EventTransportTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(SpeechPipelineTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TtsCacheTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(WavConcatenatorTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(MessageAudioBuilderTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(AudioCompressionTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(AudioDeliveryTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(PromptStabilityTests))
     suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(EmptyTreeBankTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(BranchPathTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TreebankSerializerTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(WindowedTreeBankTests))
 
     for test_case in base_test_cases:
         suite.addTest(collect_crud_suite(test_case))
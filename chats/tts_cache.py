@@ -0,0 +1,189 @@
+"""Content-addressed cache of synthesized speech.
+
+Samples are keyed by a hash of the voice id and the normalized sentence text.
+Their audio files are stored under MEDIA_ROOT, named by the key, and described
+by SpeechSample rows which are reused on a hit, so a repeated sentence costs no
+TTS call and no new file. An in-process LRU index keeps recently used samples
+to skip the database lookup for frequent phrases. The total size of cached
+samples is kept under TTS_CACHE_MAX_BYTES by deleting least recently used ones.
+"""
+import hashlib
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models import Sum
+from django.utils import timezone
+from .models import SpeechSample
+from . import audio_compression
+
+
+def normalize_text(text):
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split())
+
+
+def cache_key(voice_id, text):
+    data = f"{voice_id}\n{normalize_text(text)}".encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+class SampleIndex:
+    """LRU mapping of cache keys to SpeechSample instances, holds up to TTS_CACHE_INDEX_SIZE entries"""
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            sample = self.entries.get(key)
+            if sample is not None:
+                self.entries.move_to_end(key)
+            return sample
+
+    def put(self, key, sample):
+        with self.lock:
+            self.entries[key] = sample
+            self.entries.move_to_end(key)
+            while len(self.entries) > settings.TTS_CACHE_INDEX_SIZE:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+index = SampleIndex()
+
+
+class CacheSize:
+    """Running estimate of the total size of cached samples, to avoid summing them on every store.
+
+    The estimate is read from the database and then grows by samples stored in
+    this process. Samples stored or deleted by other processes are accounted
+    for when it is read again: once it exceeds TTS_CACHE_MAX_BYTES, or
+    TTS_CACHE_SIZE_CHECK_INTERVAL seconds after the last read.
+    """
+    def __init__(self):
+        self.total = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def add(self, size):
+        """Counts a stored sample. Returns True when the total has to be read from the database"""
+        with self.lock:
+            if self.total is None or time.monotonic() - self.checked_at > settings.TTS_CACHE_SIZE_CHECK_INTERVAL:
+                return True
+            self.total += size
+            return self.total > settings.TTS_CACHE_MAX_BYTES
+
+    def set(self, total):
+        with self.lock:
+            self.total = total
+            self.checked_at = time.monotonic()
+
+    def reset(self):
+        with self.lock:
+            self.total = None
+
+
+cache_size = CacheSize()
+
+# futures of samples being looked up or synthesized, so that the same sentence synthesized
+# twice at once (by concurrent pipelines) is synthesized only once
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def get_or_synthesize(text, voice_id, synthesize):
+    """Returns a cached sample of the text, or a new one made from synthesize(text, voice_id).
+
+    Returns None when synthesize returns no audio. Calls for a key which is
+    already being synthesized wait for that synthesis, other keys do not.
+    """
+    key = cache_key(voice_id, text)
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        owner = future is None
+        if owner:
+            future = _in_flight[key] = Future()
+
+    if not owner:
+        return future.result()
+
+    try:
+        sample = lookup(key)
+        if sample is None:
+            speech_data = synthesize(text, voice_id)
+            sample = store(key, voice_id, text, speech_data) if speech_data else None
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(sample)
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+    return sample
+
+
+def lookup(key):
+    """Returns the sample cached under a key and marks it as recently used, or None"""
+    now = timezone.now()
+
+    sample = index.get(key)
+    if sample is not None:
+        # the sample could have been evicted by another process
+        if SpeechSample.objects.filter(pk=sample.pk).update(last_used=now):
+            return sample
+        index.discard(key)
+
+    sample = SpeechSample.objects.filter(cache_key=key).first()
+    if sample is None:
+        return None
+
+    SpeechSample.objects.filter(pk=sample.pk).update(last_used=now)
+    index.put(key, sample)
+    return sample
+
+
+def store(key, voice_id, text, speech_data):
+    sample = SpeechSample(text=text, voice_id=voice_id, cache_key=key,
+                          size=len(speech_data), last_used=timezone.now())
+    sample.audio = ContentFile(speech_data, name=f"{key}.wav")
+    sample.save()
+    audio_compression.schedule(sample)
+
+    index.put(key, sample)
+    if settings.TTS_CACHE_MAX_BYTES is not None and cache_size.add(sample.size):
+        evict(keep=sample.pk)
+    return sample
+
+
+def evict(keep=None):
+    """Deletes least recently used samples (except keep) until cached ones fit into TTS_CACHE_MAX_BYTES"""
+    max_bytes = settings.TTS_CACHE_MAX_BYTES
+    if max_bytes is None:
+        return
+
+    cached = SpeechSample.objects.filter(cache_key__isnull=False)
+    total = cached.aggregate(total=Sum('size'))['total'] or 0
+    if total > max_bytes:
+        for sample in cached.exclude(pk=keep).order_by('last_used').iterator():
+            if total <= max_bytes:
+                break
+
+            total -= sample.size or 0
+            index.discard(sample.cache_key)
+            sample.audio.delete(save=False)
+            sample.audio_compressed.delete(save=False)
+            sample.delete()
+
+    cache_size.set(total)
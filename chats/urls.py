@@ -16,7 +16,11 @@ urlpatterns = [
     path('transcribe_speech/', views.transcribe_speech),
     path('completion/', views.generate_completion),
     path('treebanks/<int:pk>/', views.TreeBankDetailView.as_view()),
+    path('treebanks/<int:pk>/branch/', views.TreeBankBranchView.as_view()),
     path('messages/', views.MessageView.as_view()),
+    path('messages/<int:pk>/replies/', views.MessageRepliesView.as_view()),
+    path('messages/<int:pk>/image/', views.message_image, name='message-image'),
+    path('messages/<int:pk>/audio/', views.message_audio, name='message-audio'),
     #path('messages/<int:pk>/', views.message_detail), # todo: delete it (unused)
     path('tools-spec/', views.tools_specification),
     path('supported-tools/', views.supported_tools),
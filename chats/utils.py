@@ -1,25 +1,82 @@
 import wave
-import os
-
-
-def join_wavs(samples, result_path):
-    data= []
-    params = None
-
-    for sample in samples:
-        file_field = sample.audio
-        w = wave.open(file_field.path, 'rb')
-        params = w.getparams()
-        data.append(w.readframes(w.getnframes()))
-        w.close()
-
-    with wave.open(result_path, 'wb') as output:
-        output.setparams(params)
-        for row in data:
-            output.writeframes(row)
-
-    with open(result_path, 'rb') as f:
-        res = f.read()
-    
-    os.remove(result_path)
-    return res
+import re
+import hashlib
+import markdown
+
+
+# bump whenever the output of render_message_html changes to invalidate stored html
+HTML_RENDERER_VERSION = 1
+
+
+class WavFormatError(Exception):
+    pass
+
+
+class WavConcatenator:
+    """Appends WAV files to an output file one after another.
+
+    Frames are copied in blocks, so files are never held in memory as a whole.
+    The format of the output is taken from the first file added. Files with a
+    different channel count, sample width or frame rate raise WavFormatError
+    and leave the output unchanged. The header is completed by close(), so the
+    output file has to be seekable.
+    """
+    block_frames = 65536
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.writer = None
+        self.format = None
+        self.frames = 0
+
+    def add(self, source):
+        with wave.open(source, 'rb') as reader:
+            params = reader.getparams()
+            sample_format = (params.nchannels, params.sampwidth, params.framerate)
+
+            if self.writer is None:
+                self.writer = wave.open(self.output_file, 'wb')
+                self.writer.setnchannels(params.nchannels)
+                self.writer.setsampwidth(params.sampwidth)
+                self.writer.setframerate(params.framerate)
+                self.format = sample_format
+            elif sample_format != self.format:
+                raise WavFormatError(f'Expected (channels, sample width, frame rate) {self.format}, '
+                                     f'got {sample_format}')
+
+            while True:
+                frames = reader.readframes(self.block_frames)
+                if not frames:
+                    break
+                self.writer.writeframesraw(frames)
+                self.frames += len(frames) // (params.nchannels * params.sampwidth)
+
+    def close(self):
+        """Writes the final header, returns the number of frames written"""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        return self.frames
+
+
+def clean_message_text(text):
+    # todo: use better representation of messages in Message that separates tool calls from normal text
+    tags_to_remove = []
+
+    output = text
+    for open_tag, close_tag in tags_to_remove:
+        pattern = re.compile(f'{open_tag}.*{close_tag}')
+        output = pattern.sub("", output)
+        output = output.replace(open_tag, "").replace(close_tag, "")
+
+    return output
+
+
+def render_message_html(text):
+    return markdown.markdown(clean_message_text(text), extensions=['fenced_code'])
+
+
+def message_html_key(text):
+    """Identifies rendered html by renderer version and message text"""
+    data = f'{HTML_RENDERER_VERSION}:{text}'.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
@@ -13,7 +13,7 @@ from rest_framework.parsers import BaseParser
 from rest_framework.decorators import parser_classes, permission_classes
 from rest_framework.renderers import BaseRenderer
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import PermissionDenied, NotFound
 from django.http.response import StreamingHttpResponse, HttpResponseNotAllowed, HttpResponseBadRequest
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import get_object_or_404
@@ -28,38 +28,28 @@ from .serializers import (
     PresetSerializer,
     MessageSerializer,
     TreebankSerializer,
+    BranchMessageSerializer,
     SystemMessageSerializer,
     SpeechSampleSerializer
 )
-from chats import permissions
-from .utils import join_wavs
+from chats import permissions, media
 
 
 import llm_utils
 
 from tts import tts_backend
 from stt import stt_backend
-from .pagination import DefaultPagination
+from .pagination import DefaultPagination, RepliesPagination
 from .tasks import generate_llm_response
 from pygentify.tool_calling import tool_registry, default_tool_use_backend, create_docs
 
 
-class BinaryRenderer(BaseRenderer):
-    media_type = 'application/octet-stream'
+class AudioVerbatimRenderer(BaseRenderer):
+    media_type = 'audio/*'
     format = 'bin'
     render_style = 'binary'
     charset = None
 
-    def render(self, data, media_type=None, renderer_context=None):
-        view = renderer_context['view']
-
-        with open(view.get_object().audio.path, 'rb') as f:
-            return f.read()
-
-
-class AudioVerbatimRenderer(BinaryRenderer):
-    media_type = 'audio/*'
-
     def render(self, data, media_type=None, renderer_context=None):
         return data
 
@@ -115,13 +105,14 @@ class ConfigurationViewSet(viewsets.ModelViewSet):
         return Configuration.objects.filter(user=self.request.user)
 
 
-class SpeechSampleViewSet(viewsets.ReadOnlyModelViewSet):
+class SpeechSampleViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """Streams the audio of a speech sample. Samples are not listed: they belong to no user"""
     serializer_class = SpeechSampleSerializer
     queryset = SpeechSample.objects.all()
-    renderer_classes = [BinaryRenderer]
 
     def retrieve(self, request, *args, **kwargs):
-        return super().retrieve(request, *args, **kwargs)
+        sample = self.get_object()
+        return media.serve_file(request, sample.playable_audio)
 
 
 class VoiceSampleView(views.APIView):
@@ -230,7 +221,7 @@ class TreeBankDetailView(generics.RetrieveAPIView):
 
     def get_serializer(self, *args, **kwargs):
         chat = self.get_object()
-        return TreebankSerializer(chat.prompt)
+        return TreebankSerializer(chat.prompt, context=self.get_serializer_context())
 
     def get_queryset(self):
         return Chat.objects.filter(user=self.request.user)
@@ -241,6 +232,58 @@ class TreeBankDetailView(generics.RetrieveAPIView):
         return super().retrieve(request, *args, **kwargs)
 
 
+class TreeBankBranchView(generics.RetrieveAPIView):
+    """Windowed view of a chat tree.
+
+    Returns the branch going from the root through an optional "message" down to a leaf,
+    with counts of replies and siblings in place of nested subtrees. Subtrees are
+    expanded lazily through MessageRepliesView.
+    """
+    queryset = Chat.objects.all()
+    permission_classes = [IsAuthenticated, permissions.IsOwner]
+
+    def get_queryset(self):
+        return Chat.objects.filter(user=self.request.user)
+
+    def retrieve(self, request, *args, **kwargs):
+        chat = self.get_object()
+        if not chat.prompt_id:
+            return Response({'messages': []}, status=status.HTTP_200_OK)
+
+        try:
+            message_id = int(request.query_params.get('message', chat.prompt_id))
+        except ValueError:
+            raise ValidationError('Expected "message" to be an integer id')
+
+        branch = Message.objects.active_branch(message_id)
+        if not branch or branch[0].pk != chat.prompt_id:
+            raise NotFound(f'Message {message_id} does not belong to this chat')
+
+        serializer = BranchMessageSerializer(branch, many=True, context=self.get_serializer_context())
+        return Response({'messages': serializer.data}, status=status.HTTP_200_OK)
+
+
+class MessageRepliesView(generics.ListAPIView):
+    """Cursor-paginated replies of a message, used to lazily expand a chat tree"""
+    serializer_class = BranchMessageSerializer
+    pagination_class = RepliesPagination
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        parent = generics.get_object_or_404(Message.objects.all(), pk=self.kwargs['pk'])
+        try:
+            chat = parent.get_chat()
+        except Chat.DoesNotExist:
+            # a message tree whose chat was deleted
+            raise NotFound()
+
+        if chat.user != self.request.user:
+            raise NotFound()
+
+        replies = parent.replies.with_tree_counts()
+        return replies.select_related('chat').prefetch_related('attachments')
+
+
 class MessageView(generics.CreateAPIView):
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
@@ -279,6 +322,27 @@ class MessageView(generics.CreateAPIView):
         return ContentFile(image_data, name=f'prompt_image.{extension}')
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def message_image(request, pk):
+    message = get_object_or_404(Message.objects.all(), pk=pk)
+    if not message.image or message.get_chat().user != request.user:
+        raise NotFound()
+
+    message.ensure_image_digest()
+    return media.serve_file(request, message.image, digest=message.image_sha256)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def message_audio(request, pk):
+    message = get_object_or_404(Message.objects.all(), pk=pk)
+    if not message.playable_audio or message.get_chat().user != request.user:
+        raise NotFound()
+
+    return media.serve_file(request, message.playable_audio)
+
+
 def decode_data_image(data_uri):
     fmt, image_str = data_uri.split(';base64,')
     extension = fmt.split('/')[-1]
@@ -170,7 +170,7 @@ class Message extends React.Component {
 
                     {message.data.audio && (
                         <audio controls className="mt-3">
-                            <source src={message.data.audio} type="audio/wav" />
+                            <source src={message.data.audio} />
                             Your browser does not support the audio element.
                         </audio>
                     )}
@@ -21,6 +21,7 @@ import { SystemMessageList } from './system_messages';
 import { PresetsPage } from './presets';
 import { ConfigurationsPage } from './configurations';
 import { GenericFetchJson } from './generic_components';
+import { ResumableSocket } from './utils';
 
 class App extends React.Component {
     constructor() {
@@ -117,8 +118,6 @@ class App extends React.Component {
 const hostWithPort = window.location.host;
 const host = window.location.hostname || (hostWithPort && hostWithPort.split(":")[0]);
 
-const socket = new WebSocket(`ws://${host}:9000`);
-
 function getRandomInt(max) {
     return Math.floor(Math.random() * max);
 }
@@ -126,10 +125,7 @@ function getRandomInt(max) {
 let n = getRandomInt(Math.pow(2, 31));
 let socketSessionId = `${n}`;
 
-
-socket.addEventListener("open", (event) => {
-    socket.send(socketSessionId);
-});
+const socket = new ResumableSocket(`ws://${host}:9000`, socketSessionId);
 
 
 const router = createHashRouter([
@@ -302,6 +302,44 @@ class AudioPlaylistPlayer {
 }
 
 
+export class ResumableSocket extends EventTarget {
+    // Re-opens the websocket after it drops and asks the server to resend events
+    // published after the last one received (needs the "streams" event transport)
+    constructor(url, sessionId, reconnectDelay = 1000) {
+        super();
+        this.url = url;
+        this.sessionId = sessionId;
+        this.reconnectDelay = reconnectDelay;
+        this.lastId = null;
+        this.connect();
+    }
+
+    connect() {
+        this.socket = new WebSocket(this.url);
+
+        this.socket.addEventListener("open", event => {
+            if (this.lastId === null) {
+                this.socket.send(this.sessionId);
+            } else {
+                this.socket.send(JSON.stringify({ session_id: this.sessionId, last_id: this.lastId }));
+            }
+        });
+
+        this.socket.addEventListener("message", msgEvent => {
+            let payload = JSON.parse(msgEvent.data);
+            if (payload.id) {
+                this.lastId = payload.id;
+            }
+            this.dispatchEvent(new MessageEvent("message", { data: msgEvent.data }));
+        });
+
+        this.socket.addEventListener("close", event => {
+            setTimeout(() => this.connect(), this.reconnectDelay);
+        });
+    }
+}
+
+
 export function captureAndPlaySpeech(websocket, bufferingPlayer) {
     return new Promise((resolve, reject) => {
         const alistener = msgEvent => {
@@ -1,5 +1,6 @@
 import subprocess
 import base64
+import hashlib
 import threading
 import requests
 import time
@@ -7,11 +8,12 @@ import json
 import os
 import shutil
 import sys
-from llama_cpp import Llama, LlamaCache
-from llama_cpp.llama_chat_format import Llava15ChatHandler
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
 
 sys.path.insert(0, ".")
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from huggingface_hub import hf_hub_download
 from llm_services.common import models_root, models_registry
 
@@ -22,6 +24,10 @@ def uri_from_image(image_b64_string):
 
 class LLaVaGenerator:
     def __init__(self, model_path, launch_config):
+        # llama-cpp-python is needed only for multimodal models
+        from llama_cpp import Llama
+        from llama_cpp.llama_chat_format import Llava15ChatHandler
+
         mmprojector_file = launch_config['mmprojector']
         mmprojector_path = os.path.join(models_root, mmprojector_file)
         chat_handler = Llava15ChatHandler(clip_model_path=mmprojector_path)
@@ -52,6 +58,7 @@ class LLaVaGenerator:
 
     def enable_caching(self, params):
         if 'cache_prompt' in params and self.cache is None:
+            from llama_cpp import LlamaCache
             self.cache = LlamaCache()
             self.llm.set_cache(self.cache)
 
@@ -73,8 +80,8 @@ class LLaVaGenerator:
         it = self.llm.create_chat_completion(messages, stream=True, **sampling_params)
 
         def prepare_json_line(text, stop=False):
-            padding = "_" * 6 # because client strips 6 first characters
-            res = padding + json.dumps({"content": text, "stop": stop, "stopping_word": ""}) + '\n'
+            # same framing as llama-server events
+            res = "data: " + json.dumps({"content": text, "stop": stop, "stopping_word": ""}) + '\n'
             return res
 
         for chunk in it:
@@ -93,71 +100,34 @@ class LLaVaGenerator:
         yield prepare_json_line("", stop=True)
 
 
-class LLMManager:
-    def __init__(self):
-        self.executable_path = ""
-        self.host = ""
-        self.port = ""
-        self.context_size = ""
-
-        self.model_path = ""
-        self.launch_config = {}
-        self.llava = False
-
-        self.process = None
-        self.printing_thread = None
+class ModelInstance:
+    """A llama-server process serving one model with one launch config.
 
-        self.download_threads = []
-        self.downloads = {}
-
-        self.llava_generator = None
-
-    def setup(self, exec_path, host, port):
-        self.executable_path = exec_path
+    The server runs with "parallel" slots. At most that many requests are
+    forwarded to it at once, the rest wait for a free slot.
+    """
+    def __init__(self, model_id, executable_path, host, port, model_path, launch_config, parallel=1):
+        self.model_id = model_id
+        self.executable_path = executable_path
         self.host = host
-        self.port = str(port)
-
-    def configure_launch(self, model_path, launch_config):
+        # assigned by ModelPool once the instance has room to be loaded
+        self.port = None if port is None else str(port)
         self.model_path = model_path
         self.launch_config = launch_config
-        self.llava = 'mmprojector' in self.launch_config
+        self.parallel = int(launch_config.get('parallel', parallel))
+        self.memory = estimate_memory(model_path, launch_config)
 
-        if self.llava:
-            self.llava_generator = LLaVaGenerator(model_path, launch_config)
+        self.slots = threading.BoundedSemaphore(self.parallel)
 
-    def generate(self, data, content_type):
-        if self.llava:
-            params = json.loads(data)
-            messages = params.get('prompt', [])
-            yield from self.llava_generator(messages, params)
-            return
-        if self.process is None:
-            self.restart_llm()
-
-        url = f"http://localhost:{self.port}/completion"
-        headers = {'Content-Type': content_type}
+        # requests being served or waiting for a slot, the instance is not evicted while there are any
+        self.active = 0
+        # set while the model is being loaded, outside of the pool lock
+        self.loading = False
 
-        resp = self.post_with_retries(url, data, headers)
-        for line in resp.iter_lines():
-            if line:
-                line = line.decode() + '\n'
-                yield line
-
-    def post_with_retries(self, url, data, headers):
-        while True:
-            try:
-                return requests.post(url, data=data, headers=headers, stream=True)
-            except requests.exceptions.ConnectionError:
-                print(f"Connection error when posting to {url}")
-                time.sleep(1)
-
-    def restart_llm(self):
-        if not self.model_path:
-            raise Exception('Improperfly configured: no model path set')
-
-        if self.llava:
-            return
+        self.process = None
+        self.printing_thread = None
 
+    def start(self):
         context_size = self.launch_config.get('contextSize', 512)
         num_gpu_layers = self.launch_config.get('ngl', 0)
         num_threads = self.launch_config.get('numThreads', 2)
@@ -170,7 +140,9 @@ class LLMManager:
             "--model", self.model_path,
             "--threads", str(num_threads),
             #"--threads-batch", str(num_batch_threads),
-            "--ctx-size", str(context_size),
+            # context is shared by slots, every slot gets contextSize tokens
+            "--ctx-size", str(context_size * self.parallel),
+            "--parallel", str(self.parallel),
             "--n-gpu-layers", str(num_gpu_layers),
             "--batch-size", str(batch_size),
             #"--n-predict", str(n_predict),
@@ -178,10 +150,6 @@ class LLMManager:
             "--port", self.port
         ]
 
-        if self.process is not None:
-            self.process.terminate()
-            self.printing_thread.join()
-
         self.process = subprocess.Popen(popen_args,
                         universal_newlines=True,
                         stdout=subprocess.PIPE)
@@ -189,6 +157,266 @@ class LLMManager:
         self.printing_thread = PrintingThread(self.process)
         self.printing_thread.start()
 
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.printing_thread.join()
+            self.process = None
+
+    def generate(self, data, content_type):
+        url = f"http://{self.host}:{self.port}/completion"
+        headers = {'Content-Type': content_type}
+
+        with self.slots:
+            resp = post_with_retries(url, data, headers)
+            try:
+                # events are forwarded as they arrive, without splitting them into lines
+                yield from iter_chunks(resp)
+            finally:
+                resp.close()
+
+    def info(self):
+        return {
+            'model_id': self.model_id,
+            'file_name': os.path.basename(self.model_path),
+            'launch_params': self.launch_config,
+            'port': int(self.port),
+            'slots': self.parallel,
+            'active': self.active,
+            'loading': self.loading,
+            'memory': self.memory
+        }
+
+
+class LLaVaInstance(ModelInstance):
+    """Multimodal model run in-process with llama-cpp-python, serves one request at a time"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.parallel = 1
+        self.slots = threading.BoundedSemaphore(1)
+        self.generator = None
+
+    def start(self):
+        self.generator = LLaVaGenerator(self.model_path, self.launch_config)
+
+    def stop(self):
+        self.generator = None
+
+    def generate(self, data, content_type):
+        params = json.loads(data)
+        messages = params.get('prompt', [])
+        with self.slots:
+            for line in self.generator(messages, params):
+                yield line.encode('utf-8')
+
+
+def estimate_memory(model_path, launch_config):
+    """Estimates memory taken by a loaded model as the size of its weights files"""
+    size = os.path.getsize(model_path)
+    if 'mmprojector' in launch_config:
+        size += os.path.getsize(os.path.join(models_root, launch_config['mmprojector']))
+    return size
+
+
+def get_model_id(model_path, launch_config):
+    key = json.dumps([model_path, launch_config], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+def iter_chunks(resp, chunk_size=65536):
+    """Yields whatever part of a streamed response body has arrived"""
+    raw = resp.raw
+    if hasattr(raw, "read1"):
+        return iter(lambda: raw.read1(chunk_size), b"")
+    return resp.iter_content(chunk_size=None)
+
+
+def post_with_retries(url, data, headers):
+    while True:
+        try:
+            resp = requests.post(url, data=data, headers=headers, stream=True)
+        except requests.exceptions.ConnectionError:
+            print(f"Connection error when posting to {url}")
+            time.sleep(1)
+            continue
+
+        # llama-server answers 503 while it is loading the model
+        if resp.status_code != 503:
+            return resp
+        resp.close()
+        time.sleep(1)
+
+
+class ModelPool:
+    """Keeps up to max_models servers resident within memory_budget bytes.
+
+    Servers are evicted in least recently used order, but only when no
+    request is being served or waiting for them. When every resident server
+    is busy, loading another model waits until one becomes idle.
+    """
+    def __init__(self):
+        self.executable_path = ""
+        self.host = ""
+        self.base_port = 0
+        self.memory_budget = None
+        self.max_models = 1
+        self.parallel = 1
+
+        self.instances = OrderedDict()  # least recently used first
+        self.configs = {}  # launch arguments of every model started so far, by model id
+        # not reentrant: _ensure_started releases it once while loading a model
+        self.condition = threading.Condition(threading.Lock())
+
+    def configure(self, executable_path, host, base_port, memory_budget=None, max_models=1, parallel=1):
+        self.executable_path = executable_path
+        self.host = host
+        self.base_port = base_port
+        self.memory_budget = memory_budget
+        self.max_models = max_models
+        self.parallel = parallel
+
+    def start(self, model_path, launch_config):
+        """Makes sure that the model is loaded, returns its model id"""
+        model_id = get_model_id(model_path, launch_config)
+        with self.condition:
+            self.configs[model_id] = (model_path, launch_config)
+            self._ensure_started(model_id)
+        return model_id
+
+    @contextmanager
+    def lease(self, model_id=None):
+        """Returns the instance of a given model (or of the last used one) for the duration of a request"""
+        with self.condition:
+            if model_id is None:
+                if not self.instances:
+                    raise ModelNotLoadedError('No model has been started')
+                model_id = next(reversed(self.instances))
+            elif model_id not in self.configs:
+                raise ModelNotLoadedError(f'Unknown model id "{model_id}"')
+
+            # the model could have been evicted since it was started
+            instance = self._ensure_started(model_id)
+            instance.active += 1
+
+        try:
+            yield instance
+        finally:
+            with self.condition:
+                instance.active -= 1
+                self.condition.notify_all()
+
+    def list_instances(self):
+        with self.condition:
+            return [instance.info() for instance in self.instances.values()]
+
+    def _ensure_started(self, model_id):
+        """Returns the resident instance of a model, loading it first if needed.
+
+        Called with the condition held. The condition is released while the
+        model loads, so that requests to resident models are not held up.
+        """
+        instance = None
+        while True:
+            resident = self.instances.get(model_id)
+            if resident is not None:
+                if resident.loading:
+                    # loaded by another request
+                    self.condition.wait()
+                    continue
+                self.instances.move_to_end(model_id)
+                return resident
+
+            if instance is None:
+                instance = self._create_instance(model_id)
+
+            if self._fits(instance):
+                break
+
+            idle = [other for other in self.instances.values() if other.active == 0 and not other.loading]
+            if idle:
+                self._evict(idle[0])
+            else:
+                self.condition.wait()
+
+        # the instance takes its place (and port) before the lock is released
+        instance.port = str(self._free_port())
+        instance.loading = True
+        self.instances[model_id] = instance
+
+        print(f"Loading model {instance.model_path} on port {instance.port} with {instance.parallel} slots")
+        self.condition.release()
+        try:
+            instance.start()
+        except BaseException:
+            self.condition.acquire()
+            del self.instances[model_id]
+            self.condition.notify_all()
+            raise
+        self.condition.acquire()
+
+        instance.loading = False
+        self.condition.notify_all()
+        return instance
+
+    def _create_instance(self, model_id):
+        model_path, launch_config = self.configs[model_id]
+        instance_class = LLaVaInstance if 'mmprojector' in launch_config else ModelInstance
+        return instance_class(model_id, self.executable_path, self.host, None,
+                              model_path, launch_config, self.parallel)
+
+    def _fits(self, instance):
+        if not self.instances:
+            # a model exceeding the budget on its own is still loaded
+            return True
+
+        if len(self.instances) >= self.max_models:
+            return False
+
+        if self.memory_budget is None:
+            return True
+
+        used = sum(other.memory for other in self.instances.values())
+        return used + instance.memory <= self.memory_budget
+
+    def _evict(self, instance):
+        print(f"Unloading model {instance.model_path} on port {instance.port}")
+        del self.instances[instance.model_id]
+        instance.stop()
+
+    def _free_port(self):
+        used = {int(instance.port) for instance in self.instances.values()}
+        port = self.base_port
+        while port in used:
+            port += 1
+        return port
+
+    def stop_all(self):
+        with self.condition:
+            for instance in list(self.instances.values()):
+                self._evict(instance)
+
+
+class ModelNotLoadedError(Exception):
+    pass
+
+
+class LLMManager:
+    def __init__(self):
+        self.pool = ModelPool()
+
+        self.download_threads = []
+        self.downloads = {}
+
+    def setup(self, exec_path, host, port, memory_budget=None, max_models=1, parallel=1):
+        self.pool.configure(exec_path, host, port, memory_budget, max_models, parallel)
+
+    def start_model(self, model_path, launch_config):
+        return self.pool.start(model_path, launch_config)
+
+    def generate(self, data, content_type, model_id=None):
+        with self.pool.lease(model_id) as instance:
+            yield from instance.generate(data, content_type)
+
     def start_download(self, repo, file_name, size):
         repo_id = repo['id']
         download_id = (repo_id, file_name)
@@ -283,14 +511,26 @@ class StandardStreamPrinter:
 llm_manager = LLMManager()
 
 
+class LLMServiceServer(ThreadingHTTPServer):
+    """Serves every connection in its own thread.
+
+    Streaming completions do not block control calls (downloads, model
+    listing) or completions of other clients.
+    """
+    daemon_threads = True
+    request_queue_size = 64
+
+
 class HttpHandler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        self.protocol_version = 'HTTP/1.0'
+    # connections are kept alive, streamed responses use chunked transfer encoding
+    protocol_version = 'HTTP/1.1'
+    # tokens are small writes, they are sent right away instead of waiting for ACKs
+    disable_nagle_algorithm = True
 
+    def do_POST(self):
         if self.path == '/clear-context':
             # when running llama.cpp server, clearing context is unnecessary
-            self.send_response(200)
-            self.end_headers()
+            self.send_empty_response(200)
         elif self.path == '/completion':
             self.handle_completion()
         elif self.path == '/download-llm':
@@ -301,29 +541,24 @@ class HttpHandler(BaseHTTPRequestHandler):
             self.handle_start_llm()
         else:
             print("Unsupprted path", self.path)
-            self.send_response(404)
-            self.end_headers()
+            # the request body is not read, so the connection can not be reused
+            self.close_connection = True
+            self.send_empty_response(404)
 
     def do_GET(self):
-        self.protocol_version = 'HTTP/1.0'
-
         if self.path == '/downloads-in-progress':
             self.handle_downloads_inprogress()
         elif self.path == '/failed-downloads':
             self.handle_failed_downloads()
         elif self.path == '/list-models':
             self.handle_list_models()
+        elif self.path == '/running-models':
+            self.handle_running_models()
         else:
             print("Unsupprted path", self.path)
-            self.send_response(404)
-            self.end_headers()
-
-    def handle_clear_context(self):
-        print("Restarting LLM server...")
-        llm_manager.restart_llm()
-        print("LLM server restarted")
-        self.send_response(200)
-        self.end_headers()
+            # the request body is not read, so the connection can not be reused
+            self.close_connection = True
+            self.send_empty_response(404)
 
     def handle_completion(self):
         content_type = self.headers.get('Content-Type', 'application/json')
@@ -334,13 +569,33 @@ class HttpHandler(BaseHTTPRequestHandler):
         print("Got content type", content_type)
         print("Got data", json_data[:100])
 
+        # model_id routes the request to one of the loaded models and is not forwarded to llama-server
+        params = json.loads(json_data)
+        model_id = params.pop('model_id', None)
+        json_data = json.dumps(params)
+
+        try:
+            chunks = llm_manager.generate(json_data, content_type, model_id)
+            first_chunk = next(chunks, None)
+        except ModelNotLoadedError as e:
+            self.send_json_response(status_code=404, response_data={'reason': str(e)})
+            return
+
         self.send_response(200)
-        self.send_header("Content-type", "text/html")
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
         self.end_headers()
 
-        for line in llm_manager.generate(json_data, content_type):
-            print("Got line:", line)
-            self.wfile.write(bytes(line, encoding='utf-8'))
+        try:
+            if first_chunk is not None:
+                # writes block while the client is behind, so llama-server output
+                # is read no faster than the client consumes it
+                for chunk in itertools.chain([first_chunk], chunks):
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        finally:
+            # releases the slot right away when the client disconnects
+            chunks.close()
 
     def handle_download(self):
         body = self.parse_json_body()
@@ -408,6 +663,10 @@ class HttpHandler(BaseHTTPRequestHandler):
 
         self.send_json_response(status_code=200, response_data=response_data)
 
+    def handle_running_models(self):
+        response_data = llm_manager.pool.list_instances()
+        self.send_json_response(status_code=200, response_data=response_data)
+
     def handle_start_llm(self):
         data = self.parse_json_body()
         repo_id = data.get('repo_id')
@@ -420,10 +679,9 @@ class HttpHandler(BaseHTTPRequestHandler):
         print("launch config", launch_config)
 
         if os.path.exists(model_path):
-            if llm_manager.model_path != model_path or llm_manager.launch_config != launch_config:
-                llm_manager.configure_launch(model_path, launch_config)
-                llm_manager.restart_llm()
-            self.send_json_response(status_code=200, response_data={'ok': 'ok'})
+            model_id = llm_manager.start_model(model_path, launch_config or {})
+            response_data = {'ok': 'ok', 'model_id': model_id}
+            self.send_json_response(status_code=200, response_data=response_data)
         else:
             self.send_json_response(status_code=404, response_data={'reason': 'Not found'})
 
@@ -443,12 +701,19 @@ class HttpHandler(BaseHTTPRequestHandler):
         return json.loads(json_data)
 
     def send_json_response(self, status_code, response_data, encoding='utf-8'):
+        response_json = bytes(json.dumps(response_data), encoding=encoding)
+
         self.send_response(status_code)
         self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(response_json)))
         self.end_headers()
 
-        response_json = json.dumps(response_data)
-        self.wfile.write(bytes(response_json, encoding=encoding))
+        self.wfile.write(response_json)
+
+    def send_empty_response(self, status_code):
+        self.send_response(status_code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
 
 
 if __name__ == '__main__':
@@ -458,11 +723,21 @@ if __name__ == '__main__':
     parser.add_argument("--host", type=str, default="0.0.0.0")
     parser.add_argument("--port", type=int, default=9000)
     parser.add_argument("--llama-server", type=str, default="./llama.cpp/llama-server")
+    parser.add_argument("--max-models", type=int, default=1,
+                        help="number of models kept loaded at the same time")
+    parser.add_argument("--memory-budget", type=float, default=None,
+                        help="GiB of model weights kept loaded at the same time")
+    parser.add_argument("--parallel", type=int, default=1,
+                        help="default number of slots (concurrent requests) of every model")
     args = parser.parse_args()
 
+    memory_budget = args.memory_budget and int(args.memory_budget * 2 ** 30)
     llm_manager.setup(exec_path=args.llama_server,
                       host="localhost",
-                      port=9500)
+                      port=9500,
+                      memory_budget=memory_budget,
+                      max_models=args.max_models,
+                      parallel=args.parallel)
 
-    server = HTTPServer((args.host, args.port), HttpHandler)
+    server = LLMServiceServer((args.host, args.port), HttpHandler)
     server.serve_forever()
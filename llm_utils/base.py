@@ -5,7 +5,7 @@ class TokenGenerator:
     def __call__(self, text):
         raise NotImplementedError
 
-    def set_spec(self, sampling_config, stop_word):
+    def set_spec(self, sampling_config, stop_word, slot_id=None):
         pass
 
 
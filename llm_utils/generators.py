@@ -1,9 +1,15 @@
-import requests
 import json
+import logging
+import threading
+from pygentify import http_client
 from pygentify.llm_backends import GenerationSpec
-from pygentify.llm_backends import LlamaCpp
+from pygentify.llm_backends import (
+    LlamaCpp, common_prefix_length, prompt_cache_stats, iter_sse_data, fast_json
+)
 from .base import TokenGenerator
 
+logger = logging.getLogger(__name__)
+
 
 class RequestMaker:
     def __init__(self, proxies=None):
@@ -12,12 +18,12 @@ class RequestMaker:
     def get(self, *args, **kwargs):
         if self.proxies:
             kwargs["proxies"] = self.proxies
-        return requests.get(*args, **kwargs)
+        return http_client.get(*args, **kwargs)
 
     def post(self, *args, **kwargs):
         if self.proxies:
             kwargs["proxies"] = self.proxies
-        return requests.post(*args, **kwargs)
+        return http_client.post(*args, **kwargs)
 
 
 class RemoteLLM(TokenGenerator):
@@ -46,6 +52,9 @@ class RemoteLLM(TokenGenerator):
         if resp.status_code != 200:
             raise PrepareModelError("Failed to configure and start model")
 
+        # the service can keep several models loaded, completions are routed by model id
+        model_id = resp.json().get('model_id')
+
         if generation_spec.clear_context:
             url = f"http://{self.host}:{self.port}/clear-context"
             resp = self.request_maker.post(url)
@@ -56,20 +65,20 @@ class RemoteLLM(TokenGenerator):
 
         stop_word = "</api>"
         payload = {"prompt": prompt, "stream": True, "stop": [stop_word], "cache_prompt": True}
+        if model_id:
+            payload["model_id"] = model_id
         payload.update(llm_settings)
 
         resp = self.request_maker.post(url, data=json.dumps(payload), headers=headers, stream=True)
-        for line in resp.iter_lines(chunk_size=1):
-            if line:
-                line = line.decode('utf-8')
-
-                stripped_line = line[6:]
-                print("in Remote adapter!:", line, "stripped line:", stripped_line)
-                entry = json.loads(stripped_line)
+        try:
+            for data in iter_sse_data(resp):
+                entry = fast_json.loads(data)
                 if entry["stop"] and entry["stopping_word"] == stop_word:
                     yield stop_word
                     break
                 yield entry["content"]
+        finally:
+            resp.close()
 
 
 class LlamaCppServer(TokenGenerator):
@@ -77,13 +86,34 @@ class LlamaCppServer(TokenGenerator):
         self.endpoint = endpoint
         self.proxies = proxies
         self.generation_spec = None
+        # text in the KV cache of every slot: the last prompt and the tokens generated for it,
+        # to tell how much of a new prompt can come from the cache
+        self.slot_texts = {}
+        self.slot_texts_lock = threading.Lock()
 
-    def set_spec(self, sampling_config, stop_word):
-        self.generation_spec = GenerationSpec(sampling_config, stop_word)
+    def set_spec(self, sampling_config, stop_word, slot_id=None):
+        self.generation_spec = GenerationSpec(sampling_config, stop_word, slot_id)
 
     def __call__(self, text):
+        slot_id = self.generation_spec.slot_id
+        with self.slot_texts_lock:
+            prefix_chars = common_prefix_length(self.slot_texts.get(slot_id, ''), text)
+
         llm = LlamaCpp(self.endpoint, self.generation_spec, self.proxies)
-        yield from llm(text)
+        generated = []
+        try:
+            for token in llm(text):
+                generated.append(token)
+                yield token
+        finally:
+            with self.slot_texts_lock:
+                self.slot_texts[slot_id] = text + ''.join(generated)
+
+            response_data = dict(llm.response_data, prompt_prefix_chars=prefix_chars, prompt_chars=len(text))
+            stats = prompt_cache_stats(response_data)
+            logger.info("prompt_cache slot_id=%s %s", slot_id,
+                        " ".join(f"{name}={value}" for name, value in stats.items()))
+        return stats
 
 
 def clean_llm_settings(llm_settings):
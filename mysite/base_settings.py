@@ -123,6 +123,29 @@ MEDIA_ROOT = os.path.join("/", "data", "media")
 
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024
 
+# when set, media files are handed off to nginx via X-Accel-Redirect under this internal location
+MEDIA_X_ACCEL_REDIRECT_PREFIX = None
+
+# how message images are serialized by default: "inline", "thumbnail" or "url"
+MESSAGE_IMAGE_MODE = "inline"
+MESSAGE_IMAGE_THUMBNAIL_SIZE = (256, 256)
+
+# cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "media": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.path.join("/", "data", "cache", "media"),
+        "OPTIONS": {"MAX_ENTRIES": 10000}
+    }
+}
+
+MEDIA_CACHE_ALIAS = "media"
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -130,6 +153,63 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REDIS_HOST = "redis"
 
+# Streamed tokens are published in batches: a batch is sent with the token which makes
+# it older than TOKEN_COALESCE_WINDOW seconds or bigger than TOKEN_COALESCE_MAX_BYTES bytes,
+# and always at the end of a sentence. A window of 0 publishes every token.
+TOKEN_COALESCE_WINDOW = 0.05
+TOKEN_COALESCE_MAX_BYTES = 512
+
+# "pubsub" delivers events only to connected clients, "streams" keeps the last
+# EVENT_STREAM_MAXLEN events of every session in a Redis stream for EVENT_STREAM_TTL
+# seconds so that clients can resume after reconnecting. Has to match the
+# --transport option of websocket_server.py.
+EVENT_TRANSPORT = "pubsub"
+EVENT_STREAM_MAXLEN = 2000
+EVENT_STREAM_TTL = 60 * 60
+
+# Number of parallel slots of llama-server (its --parallel option). When set, every
+# chat is pinned to one slot (id_slot) so that its prompt prefix stays in that slot's KV cache.
+LLM_SERVER_SLOTS = None
+
+# Connection pools of outbound HTTP calls to LLM, TTS, STT and sandbox services,
+# see pygentify.http_client.DEFAULT_CONFIG for all options
+HTTP_CLIENT = {
+    "pool_maxsize": 10,
+    "connect_timeout": 5,
+    "read_timeout": 600,
+    "retries": 3,
+    "backoff_factor": 0.5,
+}
+
+# Number of sentences of a voice synthesized at the same time by a worker process.
+# TTS_VOICE_CONCURRENCY overrides it for given voice ids, e.g. {"slow_voice": 1}.
+TTS_CONCURRENCY = 2
+TTS_VOICE_CONCURRENCY = {}
+
+# Synthesized sentences are reused for the same voice and text (see chats.tts_cache).
+# Least recently used samples are deleted once cached ones take more than
+# TTS_CACHE_MAX_BYTES (None for no limit). Every worker process keeps a running
+# total of that size, read again from the database once it exceeds the limit or
+# after TTS_CACHE_SIZE_CHECK_INTERVAL seconds. TTS_CACHE_INDEX_SIZE samples are
+# indexed in memory by every worker process.
+TTS_CACHE_ENABLED = True
+TTS_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+TTS_CACHE_SIZE_CHECK_INTERVAL = 60
+TTS_CACHE_INDEX_SIZE = 10000
+
+# Speech samples and message audio are saved as WAV. When enabled, every file also
+# gets a compressed copy made by AUDIO_COMPRESSION_COMMAND ({input} and {output} are
+# replaced by file paths, the output has to be Ogg) on AUDIO_COMPRESSION_WORKERS
+# background threads, which is served instead of the original. WAV originals are
+# deleted AUDIO_WAV_RETENTION_DAYS after being made (None keeps them) by the
+# compress_audio management command, which also compresses files saved before.
+AUDIO_COMPRESSION_ENABLED = False
+AUDIO_COMPRESSION_COMMAND = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", "{input}",
+                             "-c:a", "libopus", "-b:a", "32k", "-f", "ogg", "{output}"]
+AUDIO_COMPRESSION_WORKERS = 2
+AUDIO_COMPRESSION_TIMEOUT = 120
+AUDIO_WAV_RETENTION_DAYS = 7
+
 # celery settings
 CELERY_RESULT_BACKEND = "rpc://"
 CELERY_TASK_TIME_LIMIT = 30 * 60
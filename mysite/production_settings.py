@@ -19,6 +19,8 @@ llm_port = os.environ.get('LLM_PORT', 9100)
 stt_port = os.environ.get('STT_PORT', llm_port + 100)
 tts_port = os.environ.get('TTS_PORT', stt_port + 100)
 
+MEDIA_X_ACCEL_REDIRECT_PREFIX = "/protected-media/"
+
 proxies = {}
 
 http_proxy = os.environ.get('HTTP_PROXY_SERVER_ADDRESS')
@@ -35,4 +35,14 @@ DATABASES = {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': '/data/test_db.sqlite3',
     }
-}
\ No newline at end of file
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "media": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "media"
+    }
+}
@@ -1,11 +1,14 @@
 from __future__ import annotations
 from urllib.parse import urlparse
+import asyncio
+import inspect
 import json
 import sys
 import os
 import uuid
 from .chat_render import ChatRendererToString, default_template
-from .llm_backends import BaseLLM, LlamaCpp, GenerationSpec
+from .llm_backends import BaseLLM, LlamaCpp, AsyncLlamaCpp, GenerationSpec
+from . import http_client
 from .tools import *
 from .completion import *
 from .completion import RunOutOfContextError, ParentOutOfContextError
@@ -116,6 +119,9 @@ class ObservableMixin:
 class Agent(ObservableMixin):
     default_done_tool = lambda *args, **kwargs: kwargs
 
+    # event loop of an AsyncAgent running the current turn
+    loop = None
+
     def __init__(self, llm, tools, done_tool=None, system_message="",
                  max_rounds=5, output_device=None, temp_output_device=None, eager_execution=True, code_stitching=True):
         self.llm = llm
@@ -173,11 +179,22 @@ class Agent(ObservableMixin):
                  include_system_message=True,
                  record_prompt=True,
                  self_prompting=True):
+        completer = self._begin_turn(TextCompleter, inputs, files, include_system_message, record_prompt)
+
+        for i in range(self.max_rounds):
+            input_text = self.chat_renderer(self.history, continue_gen=bool(i > 0))
+            response = completer(input_text)
+
+            done, result = self._finish_round(response, self_prompting)
+            if done:
+                return result
+
+        raise TooManyRoundsError('Too many rounds of generation')
+
+    def _begin_turn(self, completer_class, inputs, files, include_system_message, record_prompt):
         # todo: allow system message to be mixed modality as well
         # todo: error counter to allow at most n attempts to call tool and give up
 
-        tool_use_helper = self.tool_use_helper
-
         if include_system_message:
             self.add_system_message()
 
@@ -186,40 +203,41 @@ class Agent(ObservableMixin):
         if record_prompt:
             self.output_device(prompt.content.render())
 
-        self.completer = completer = TextCompleter(self.llm)
+        self.completer = completer = completer_class(self.llm)
 
-        completer.on_token = self._stream_to_device(tool_use_helper)
+        completer.on_token, self.end_streamed_round = self._stream_to_device(self.tool_use_helper)
 
         self.history.append(prompt)
 
-        blank_count = 0
+        self.blank_count = 0
+        return completer
 
-        for i in range(self.max_rounds):
-            input_text = self.chat_renderer(self.history, continue_gen=bool(i > 0))
-            response = completer(input_text)
+    def _finish_round(self, response, self_prompting):
+        """Processes a generated response. Returns a tuple (done, result of done tool)"""
+        self.end_streamed_round()
 
-            if self._blank_response(response):
-                blank_count += 1
+        if self._blank_response(response):
+            self.blank_count += 1
 
-                print("GOT BLANK")
+            print("GOT BLANK")
 
-                if self_prompting and blank_count >= 3:
-                    # when llm keeps generating blank strings, (on behalf of prompter) ask it to continue
-                    msg = self.chat_factory.create_user_msg("Is that problem solved? When you are ready, report the answer. Don't forget to you syntax precisely")
-                    self.history.append(msg)
-                    blank_count = 0
-                    print("Generated 3 blanks!!!")
-                    continue
+            if self_prompting and self.blank_count >= 3:
+                # when llm keeps generating blank strings, (on behalf of prompter) ask it to continue
+                msg = self.chat_factory.create_user_msg("Is that problem solved? When you are ready, report the answer. Don't forget to you syntax precisely")
+                self.history.append(msg)
+                self.blank_count = 0
+                print("Generated 3 blanks!!!")
+                return False, None
 
-            try:
-                self._process_response(response)
-            except SolutionComplete as result:
-                arg_dict = result.args[0]
-                done_tool_call = self.chat_factory.create_tool_call('done_tool', arg_dict)
-                self.output_device(done_tool_call.content.render())
-                return result.args[0]
+        try:
+            self._process_response(response)
+        except SolutionComplete as result:
+            arg_dict = result.args[0]
+            done_tool_call = self.chat_factory.create_tool_call('done_tool', arg_dict)
+            self.output_device(done_tool_call.content.render())
+            return True, result.args[0]
 
-        raise TooManyRoundsError('Too many rounds of generation')
+        return False, None
 
     def _blank_response(self, response):
         return not response.replace("\n", "").strip()
@@ -355,28 +373,24 @@ class Agent(ObservableMixin):
         self.output_device(msg.content.render())
 
     def _stream_to_device(self, tool_use_helper):
-        # todo: refactor
-        tool_use_seq = False
-        buffer = ""
-        def on_token(token):
-            nonlocal tool_use_seq, buffer
-            buffer += token
+        """Returns a token callback and a function to call when a round of generation ends"""
+        # only text outside of tool calls is streamed, tool calls are rendered once parsed
+        scanner = TagScanner(tool_use_helper.start_tag, tool_use_helper.end_tag)
 
-            #print(tool_use_helper.start_tag, buffer[-40:], bool(tool_use_helper.start_tag in buffer))
+        def emit(pieces):
+            for kind, text, _ in pieces:
+                if kind == TagScanner.OUTSIDE:
+                    self.output_device.on_token(text)
 
-            if not tool_use_seq:
-                self.output_device.on_token(token)
+        def on_token(token):
+            emit(scanner.feed(token))
 
-            if tool_use_helper.start_tag in buffer:
-                tool_use_seq = True
-                idx = buffer.index(tool_use_helper.start_tag)
-                buffer = buffer[idx + len(buffer):]
-            
-            if tool_use_helper.end_tag in buffer:
-                tool_use_seq = False
-                idx = buffer.index(tool_use_helper.end_tag)
-                buffer = buffer[idx + len(buffer):]
-        return on_token
+        def end_round():
+            nonlocal scanner
+            # text held back as a possible start of a tag did not turn out to be one
+            emit(scanner.finish())
+            scanner = TagScanner(tool_use_helper.start_tag, tool_use_helper.end_tag)
+        return on_token, end_round
 
     def backup_history(self):
         self.backup = self.history[:]
@@ -402,6 +416,41 @@ class Agent(ObservableMixin):
         return collate(messages)
 
 
+class AsyncAgent(Agent):
+    """Agent whose turns are coroutines, for use with async LLM backends (e.g. AsyncLlamaCpp).
+
+    Tokens are awaited on the event loop, while responses are processed (tool calls,
+    sandboxes, sub-agents) in a worker thread, so one event loop can drive many agents
+    and blocking tool calls of one agent do not stall generation of the others.
+    """
+    async def __call__(self, inputs, files=None,
+                       include_system_message=True,
+                       record_prompt=True,
+                       self_prompting=True):
+        self.loop = asyncio.get_running_loop()
+        completer = self._begin_turn(AsyncTextCompleter, inputs, files, include_system_message, record_prompt)
+
+        for i in range(self.max_rounds):
+            input_text = self.chat_renderer(self.history, continue_gen=bool(i > 0))
+            response = await completer(input_text)
+
+            done, result = await asyncio.to_thread(self._finish_round, response, self_prompting)
+            if done:
+                return result
+
+        raise TooManyRoundsError('Too many rounds of generation')
+
+
+def wait_for(result, loop):
+    """Returns result, or waits for it on loop if it is awaitable.
+
+    Lets code running in a worker thread of AsyncAgent call async agents and completers.
+    """
+    if inspect.isawaitable(result):
+        return asyncio.run_coroutine_threadsafe(result, loop).result()
+    return result
+
+
 class ListingAnalyzer:
     def __call__(self, code_listing):
         try:
@@ -448,7 +497,7 @@ JAVASCRIPT_PROJECT = "JAVASCRIPT_PROJECT"
 
 def post_json(url, data, error='Operation failed: "{}"'):
     headers = headers={'content-type': 'application/json'}
-    resp = requests.post(url, data=json.dumps(data), headers=headers)
+    resp = http_client.post(url, data=json.dumps(data), headers=headers)
 
     if resp.ok:
         return resp.json()
@@ -639,19 +688,21 @@ class NullAssistant:
 class AiAssistant(NullAssistant):
     def __init__(self, parent_agent):
         self.completer = parent_agent.completer
+        self.loop = parent_agent.loop
         self.history = parent_agent.history[:]
         self.output_device =  parent_agent.temp_output_device
         self.chat_factory = parent_agent.chat_factory
+        self.chat_renderer = self.chat_factory.get_chat_renderer()
 
     def ask_question(self, text):
         msg = self.chat_factory.create_user_msg(f'Message from an agent who you delegated latest task to: {text}')
         self.history.append(msg)
         self.output_device(text)
 
-        input_text = self.chat_factory.get_chat_renderer()(self.history)
+        input_text = self.chat_renderer(self.history)
 
         try:
-            response = self.completer(input_text)
+            response = wait_for(self.completer(input_text), self.loop)
         except RunOutOfContextError as e:
             raise ParentOutOfContextError(*e.args)
 
@@ -690,7 +741,7 @@ class Delegator:
             self.agent.restore_history()
 
             try:
-                return sub_agent(sub_agent_inputs)
+                return wait_for(sub_agent(sub_agent_inputs), self.agent.loop)
             except RunOutOfContextError as e:
                 # todo: needs a way to clear conversation between parent and child before retry
                 exc = e
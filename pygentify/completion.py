@@ -89,22 +89,38 @@ class SolutionResponse(BaseResponse):
 
 
 class TextCompleter:
-    def __init__(self, llm, stop_token="```"):
+    def __init__(self, llm, stop_token="```", stop_after=2):
         self.llm = llm
         self.on_token = lambda token: token
         self.stop_token = stop_token
+        self.stop_after = stop_after
 
     def __call__(self, input_text):
-        raw_response = ""
+        parts = []
+        matcher = self.create_matcher()
 
         for token in self.llm(input_text):
-            if self.should_stop(raw_response, token):
-                raw_response, last_token = finilize_response(raw_response, token)
-                self.broadcast_token(last_token)
+            if self.consume(matcher, parts, token):
                 break
-            else:
-                raw_response += token
-                self.broadcast_token(token)
+
+        return self.complete(parts)
+
+    def create_matcher(self):
+        stop_tokens = [self.stop_token] if isinstance(self.stop_token, str) else self.stop_token
+        return StopSequenceMatcher(stop_tokens)
+
+    def consume(self, matcher, parts, token):
+        """Adds token to parts and broadcasts it. Returns True when generation has to stop"""
+        stop_at = self.find_stop(matcher, token)
+        if stop_at is not None:
+            token = token[:stop_at]
+
+        parts.append(token)
+        self.broadcast_token(token)
+        return stop_at is not None
+
+    def complete(self, parts):
+        raw_response = ''.join(parts)
 
         if hasattr(self.llm, "response_data"):
             event_data = (raw_response, self.llm.response_data)
@@ -119,19 +135,94 @@ class TextCompleter:
         messenger.publish(TokenArrivedEvent(token))
         self.on_token(token)
 
-    def should_stop(self, raw_response, new_token):
-        text = raw_response + new_token
-        return text.count(self.stop_token) == 2
+    def find_stop(self, matcher, new_token):
+        """Returns the position in new_token right after the stop_after-th stop sequence, or None"""
+        for end in matcher.feed(new_token):
+            if matcher.matches == self.stop_after:
+                return end
+        return None
 
 
-def finilize_response(text, token):
-    suffix = ""
-    for ch in token:
-        if not text.endswith("```"):
-            text += ch
-            suffix += ch
+class AsyncTextCompleter(TextCompleter):
+    """TextCompleter for LLMs returning async generators of tokens (e.g. AsyncLlamaCpp)"""
+    async def __call__(self, input_text):
+        parts = []
+        matcher = self.create_matcher()
 
-    return text, suffix
+        tokens = self.llm(input_text)
+        try:
+            async for token in tokens:
+                if self.consume(matcher, parts, token):
+                    break
+        finally:
+            # closes the stream right away instead of when the generator is collected
+            await tokens.aclose()
+
+        return self.complete(parts)
+
+
+class StopSequenceMatcher:
+    """Incremental Aho-Corasick matcher for one or more stop sequences.
+
+    Text is fed piece by piece and only the automaton state is kept between
+    calls, so every character is examined once regardless of the length of the
+    response. Matches do not overlap: the search restarts after each match, the
+    same way str.count counts occurrences.
+    """
+    def __init__(self, sequences):
+        self.transitions = [{}]
+        self.fail = [0]
+        self.terminal = [False]
+
+        for sequence in sequences:
+            self._insert(sequence)
+        self._link()
+
+        self.state = 0
+        self.matches = 0
+
+    def _insert(self, sequence):
+        state = 0
+        for ch in sequence:
+            next_state = self.transitions[state].get(ch)
+            if next_state is None:
+                next_state = len(self.transitions)
+                self.transitions[state][ch] = next_state
+                self.transitions.append({})
+                self.fail.append(0)
+                self.terminal.append(False)
+            state = next_state
+        self.terminal[state] = True
+
+    def _link(self):
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            for ch, next_state in self.transitions[state].items():
+                fallback = self.fail[state]
+                while fallback and ch not in self.transitions[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.transitions[fallback].get(ch, 0)
+                self.terminal[next_state] = self.terminal[next_state] or self.terminal[self.fail[next_state]]
+                queue.append(next_state)
+
+    def feed(self, text):
+        """Yields positions in text right after every stop sequence completed by it"""
+        transitions = self.transitions
+        fail = self.fail
+        state = self.state
+
+        for i, ch in enumerate(text):
+            while state and ch not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(ch, 0)
+
+            if self.terminal[state]:
+                self.matches += 1
+                state = 0
+                self.state = state
+                yield i + 1
+
+        self.state = state
 
 
 class RunOutOfContextError(Exception):
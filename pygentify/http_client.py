@@ -0,0 +1,109 @@
+"""Shared connection pools for outbound HTTP calls (LLM, TTS, STT, sandboxes).
+
+Every thread gets its own requests.Session, so connections to a host are kept
+alive and reused across calls instead of being opened for every request.
+Sessions apply a default timeout and a retry policy with exponential backoff.
+Connection errors are retried for any method. Error statuses are retried only
+for methods listed in retry_methods, because replaying a POST to a generation
+endpoint is not safe in general.
+"""
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+DEFAULT_CONFIG = {
+    "pool_connections": 10,     # number of hosts to keep a connection pool for
+    "pool_maxsize": 10,         # connections kept alive per host
+    "connect_timeout": 5,
+    "read_timeout": 600,        # for streamed responses, the longest pause between chunks
+    "retries": 3,
+    "backoff_factor": 0.5,
+    "retry_statuses": (502, 503, 504),
+    "retry_methods": ("GET", "HEAD", "OPTIONS"),
+}
+
+config = dict(DEFAULT_CONFIG)
+
+_local = threading.local()
+_generation = 0
+
+
+def configure(**options):
+    """Updates pool settings. Sessions created before the call are replaced on next use."""
+    global _generation
+    unknown = set(options) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown http client options: {', '.join(sorted(unknown))}")
+
+    config.update(options)
+    _generation += 1
+
+
+class PooledSession(requests.Session):
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def create_session():
+    retry = Retry(total=config["retries"],
+                  connect=config["retries"],
+                  read=0,
+                  status=config["retries"],
+                  backoff_factor=config["backoff_factor"],
+                  status_forcelist=config["retry_statuses"],
+                  allowed_methods=frozenset(config["retry_methods"]),
+                  raise_on_status=False)
+
+    adapter = HTTPAdapter(pool_connections=config["pool_connections"],
+                          pool_maxsize=config["pool_maxsize"],
+                          max_retries=retry)
+
+    session = PooledSession(timeout=(config["connect_timeout"], config["read_timeout"]))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    """Returns the session of the calling thread"""
+    session = getattr(_local, "session", None)
+    if session is None or _local.generation != _generation:
+        if session is not None:
+            session.close()
+        session = create_session()
+        _local.session = session
+        _local.generation = _generation
+    return session
+
+
+def create_async_client():
+    """Returns an httpx.AsyncClient with the same keep-alive, timeout and retry settings.
+
+    httpx retries connection errors only. The number of connections is not limited,
+    so concurrent streams never wait for a free connection.
+    """
+    import httpx
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=config["pool_maxsize"])
+    transport = httpx.AsyncHTTPTransport(retries=config["retries"], limits=limits)
+    timeout = httpx.Timeout(config["read_timeout"], connect=config["connect_timeout"])
+    return httpx.AsyncClient(transport=transport, timeout=timeout)
+
+
+def request(method, url, **kwargs):
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, data=None, **kwargs):
+    return request("POST", url, data=data, **kwargs)
@@ -1,6 +1,17 @@
-import requests
 import json
+import os
+import zlib
+from contextlib import aclosing
 from dataclasses import dataclass
+from . import http_client
+
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:
+        fast_json = json
 
 
 class RequestMaker:
@@ -10,12 +21,12 @@ class RequestMaker:
     def get(self, *args, **kwargs):
         if self.proxies:
             kwargs["proxies"] = self.proxies
-        return requests.get(*args, **kwargs)
+        return http_client.get(*args, **kwargs)
 
     def post(self, *args, **kwargs):
         if self.proxies:
             kwargs["proxies"] = self.proxies
-        return requests.post(*args, **kwargs)
+        return http_client.post(*args, **kwargs)
 
 
 class BaseLLM:
@@ -55,49 +66,173 @@ class LlamaCpp(BaseLLM):
     def stream_response(self, prompt, sampling_settings):
         stop_word = self.generation_spec.stop_word
         resp = self.start_streaming(prompt, sampling_settings, stop_word)
-        line_gen = resp.iter_lines(chunk_size=1)
-
-        for line in self.skip_empty(line_gen):
-            entry = self.parse_line(line)
 
-            should_stop = entry["stop"] and entry["stopping_word"]
-            value = entry["stopping_word"] if should_stop else entry["content"]
-            self.response_data = entry
-            yield value
+        try:
+            for data in iter_sse_data(resp):
+                value, should_stop = self.parse_entry(data)
+                yield value
 
-            if should_stop:
-                break
+                if should_stop:
+                    break
+        finally:
+            resp.close()
 
     def start_streaming(self, prompt, sampling_settings, stop_word):
+        url = f"{self.base_url}/completion"
+        payload = self.make_payload(prompt, sampling_settings, stop_word)
+        return self.request_maker.post(url, data=json.dumps(payload), 
+                                       headers=self.headers, stream=True)
+
+    def make_payload(self, prompt, sampling_settings, stop_word):
         if isinstance(stop_word, str):
             stop_word = [stop_word]
 
-        url = f"{self.base_url}/completion"
-
         payload = {"prompt": prompt, "stream": True, "stop": stop_word, "cache_prompt": True}
+        if self.generation_spec.slot_id is not None:
+            payload["id_slot"] = self.generation_spec.slot_id
         payload.update(sampling_settings)
+        return payload
+
+    def parse_entry(self, data):
+        """Returns the token of a streamed entry and whether generation stopped on a stop word"""
+        entry = fast_json.loads(data)
+        should_stop = entry["stop"] and entry["stopping_word"]
+        value = entry["stopping_word"] if should_stop else entry["content"]
+        self.response_data = entry
+        return value, should_stop
+
+
+class AsyncLlamaCpp(LlamaCpp):
+    """asyncio version of LlamaCpp: calling it returns an async generator of tokens.
+
+    Needs httpx. Instances can share one httpx.AsyncClient (see
+    http_client.create_async_client), so that many generations running
+    concurrently in one event loop use a common connection pool. The client
+    is left open for its owner to close. Without one, every call opens a
+    client of its own and closes it when the generation ends.
+    """
+    def __init__(self, base_url, generation_spec, client=None):
+        super().__init__(base_url, generation_spec)
+        self.client = client
+
+    async def __call__(self, prompt):
+        sampling_config = self.generation_spec.sampling_config or {}
+        clean_llm_settings(sampling_config)
 
-        return self.request_maker.post(url, data=json.dumps(payload), 
-                                       headers=self.headers, stream=True)
+        url = f"{self.base_url}/completion"
+        payload = self.make_payload(prompt, sampling_config, self.generation_spec.stop_word)
+
+        client = self.client or http_client.create_async_client()
+        try:
+            async with client.stream("POST", url, content=json.dumps(payload), headers=self.headers) as resp:
+                async with aclosing(aiter_sse_data(resp)) as events:
+                    async for data in events:
+                        value, should_stop = self.parse_entry(data)
+                        yield value
+
+                        if should_stop:
+                            return
+        finally:
+            if client is not self.client:
+                await client.aclose()
+
+
+class SseParser:
+    """Splits chunks of a server-sent events stream into payloads of "data:" lines"""
+    def __init__(self):
+        self.buffer = b""
 
-    def skip_empty(self, line_generator):
-        return (line for line in line_generator if line)
+    def feed(self, chunk):
+        self.buffer += chunk
+        if b"\n" not in chunk:
+            return []
 
-    def parse_line(self, line):
-        line = line.decode('utf-8')
-        stripped_line = line[6:]
-        return json.loads(stripped_line)
+        *lines, self.buffer = self.buffer.split(b"\n")
+        return [payload for payload in map(data_payload, lines) if payload]
+
+    def finish(self):
+        payload = data_payload(self.buffer)
+        self.buffer = b""
+        return [payload] if payload else []
+
+
+# LLaVA events of LLM manager services (llm_services/llamacpp.py) released before
+# the "data: " framing are padded with 6 underscores instead
+LEGACY_PADDING = b"______"
+
+
+def data_payload(line):
+    if line.startswith(b"data:"):
+        return line[5:].strip()
+    if line.startswith(LEGACY_PADDING):
+        return line[len(LEGACY_PADDING):].strip() or None
+    return None
+
+
+def iter_sse_data(resp, chunk_size=65536):
+    """Yields payloads of "data:" lines of a streamed server-sent events response.
+
+    The socket is read in chunks of whatever has arrived (up to chunk_size bytes)
+    rather than byte by byte, and lines are split from a local buffer.
+    """
+    raw = resp.raw
+    if hasattr(raw, "read1"):
+        chunks = iter(lambda: raw.read1(chunk_size), b"")
+    else:
+        chunks = resp.iter_content(chunk_size=None)
+
+    parser = SseParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.finish()
+
+
+async def aiter_sse_data(resp):
+    """Async version of iter_sse_data for streamed httpx responses"""
+    parser = SseParser()
+    async for chunk in resp.aiter_raw():
+        for data in parser.feed(chunk):
+            yield data
+    for data in parser.finish():
+        yield data
 
 
 @dataclass
 class GenerationSpec:
     sampling_config: dict
     stop_word: str = None
+    slot_id: int = None
 
     def to_dict(self):
         return self.__dict__
 
 
+def pick_slot(key, num_slots):
+    """Maps a key (e.g. chat id) to the same llama-server slot every time.
+
+    Requests pinned to one slot find their previous prompt in that slot's KV cache.
+    """
+    if not num_slots:
+        return None
+    return zlib.crc32(str(key).encode('utf-8')) % num_slots
+
+
+def common_prefix_length(s1, s2):
+    return len(os.path.commonprefix([s1, s2]))
+
+
+def prompt_cache_stats(response_data):
+    """Extracts prompt cache usage reported by llama-server with the last streamed entry"""
+    timings = response_data.get("timings") or {}
+    return {
+        "tokens_cached": response_data.get("tokens_cached"),
+        "tokens_evaluated": response_data.get("tokens_evaluated"),
+        "prompt_ms": timings.get("prompt_ms"),
+        "prompt_prefix_chars": response_data.get("prompt_prefix_chars"),
+        "prompt_chars": response_data.get("prompt_chars")
+    }
+
+
 class ClearContextError(Exception):
     pass
 
@@ -171,22 +171,53 @@ class JinjaChatFactory(ChatFactory):
         return Message(role="tool", content=modality)
 
     def get_chat_renderer(self):
-        def render(messages, group_roles=True, collate_fn=None, continue_gen=False):
-            if group_roles:
-                collate_fn = collate_fn or collate
-                messages = [collate_fn(group) for group in group_messages(messages)]
-
-            if self.arch == 'llama3':
-                template = env.get_template('llama_3.jinja')
-                if continue_gen and messages[-1].role == 'assistant':
-                    res = template.render(messages=messages[:-1])
-                    last_one = messages[-1]
-                    return res + f'<|start_header_id|>{last_one.role}<|end_header_id|>\n\n{last_one.content.text}'
-                return template.render(messages=messages) + '<|start_header_id|>assistant<|end_header_id|>'
+        if self.arch == 'llama3':
+            return JinjaChatRenderer('llama_3.jinja')
+        raise Exception("Cannot find jinja template to render chat")
+
+
+class JinjaChatRenderer:
+    """Renders chat history with a jinja template that renders each message on its own.
+
+    Rendered blocks of message groups are cached and reused as long as the same
+    message objects appear at the same positions, so rendering an appended-to
+    history only renders the new (and the possibly extended last) group.
+    Messages are expected not to be modified after they were rendered.
+    """
+    def __init__(self, template_name):
+        self.template = env.get_template(template_name)
+        self.preamble = self.template.render(messages=[])
+        self.cache = []
+
+    def __call__(self, messages, group_roles=True, collate_fn=None, continue_gen=False):
+        if group_roles:
+            collate_fn = collate_fn or collate
+            groups = list(group_messages(messages))
+        else:
+            collate_fn = lambda group: group[0]
+            groups = [[msg] for msg in messages]
+
+        cache = []
+        for i, group in enumerate(groups):
+            if i < len(self.cache) and same_messages(self.cache[i][0], group):
+                cache.append(self.cache[i])
             else:
-                raise Exception("Cannot find jinja template to render chat")
+                cache.append((group, self.render_block(collate_fn(group))))
+        self.cache = cache
+
+        blocks = [block for _, block in cache]
+        if continue_gen and groups and groups[-1][0].role == 'assistant':
+            last_one = collate_fn(groups[-1])
+            res = self.preamble + ''.join(blocks[:-1])
+            return res + f'<|start_header_id|>{last_one.role}<|end_header_id|>\n\n{last_one.content.text}'
+        return self.preamble + ''.join(blocks) + '<|start_header_id|>assistant<|end_header_id|>'
+
+    def render_block(self, message):
+        return self.template.render(messages=[message])[len(self.preamble):]
+
 
-        return render
+def same_messages(group1, group2):
+    return len(group1) == len(group2) and all(m1 is m2 for m1, m2 in zip(group1, group2))
 
 
 def group_messages(messages):
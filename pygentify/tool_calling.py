@@ -129,6 +129,78 @@ class GenericToolUse(ToolUse):
         return self.syntax_error_template.format(error)
 
 
+class TagScanner:
+    """Splits streamed text into pieces outside and inside of start/end tag pairs.
+
+    Text is fed piece by piece. Only a possible beginning of the tag being
+    looked for is held back between calls, so the work per call depends on the
+    size of the fed text and the tag length, not on how much text came before.
+
+    feed() returns a list of (kind, text, offset) tuples where kind is one of
+    OUTSIDE, INSIDE, START_TAG or END_TAG and offset is the position of the
+    piece in the whole stream.
+    """
+    OUTSIDE = "outside"
+    INSIDE = "inside"
+    START_TAG = "start_tag"
+    END_TAG = "end_tag"
+
+    def __init__(self, start_tag, end_tag):
+        self.start_tag = start_tag
+        self.end_tag = end_tag
+        self.inside = False
+        self.pending = ""
+        self.offset = 0
+
+    def feed(self, text):
+        pieces = []
+        data = self.pending + text
+        offset = self.offset
+
+        while True:
+            tag = self.end_tag if self.inside else self.start_tag
+            kind = self.INSIDE if self.inside else self.OUTSIDE
+
+            idx = data.find(tag)
+            if idx < 0:
+                break
+
+            if idx:
+                pieces.append((kind, data[:idx], offset))
+            pieces.append((self.END_TAG if self.inside else self.START_TAG, tag, offset + idx))
+            self.inside = not self.inside
+
+            data = data[idx + len(tag):]
+            offset += idx + len(tag)
+
+        held = partial_suffix_length(data, tag)
+        if len(data) > held:
+            pieces.append((kind, data[:len(data) - held], offset))
+            offset += len(data) - held
+
+        self.pending = data[len(data) - held:]
+        self.offset = offset
+        return pieces
+
+    def finish(self):
+        """Returns held back text that turned out not to be a tag"""
+        pieces = []
+        if self.pending:
+            kind = self.INSIDE if self.inside else self.OUTSIDE
+            pieces.append((kind, self.pending, self.offset))
+            self.offset += len(self.pending)
+            self.pending = ""
+        return pieces
+
+
+def partial_suffix_length(text, tag):
+    """Length of the longest suffix of text which is a proper prefix of tag"""
+    for n in range(min(len(text), len(tag) - 1), 0, -1):
+        if tag.startswith(text[-n:]):
+            return n
+    return 0
+
+
 class SimpleTagBasedToolUse(GenericToolUse):
     def __init__(self, start_tag, end_tag, result_start_tag, result_end_tag,
                  error_start_tag, error_end_tag):
@@ -154,6 +226,20 @@ class SimpleTagBasedToolUse(GenericToolUse):
         test = f"{start_tag}(.*){end_tag}"
         super().__init__(test, call_template, success_template, error_template, syntax_error_template)
 
+    def find(self, s):
+        scanner = TagScanner(self.start_tag, self.end_tag)
+        start = None
+        body = []
+        for kind, text, offset in scanner.feed(s) + scanner.finish():
+            if kind == TagScanner.START_TAG:
+                start = offset
+            elif kind == TagScanner.INSIDE:
+                body.append(text)
+            elif kind == TagScanner.END_TAG:
+                return start, offset + len(text) - start, ''.join(body)
+
+        raise ToolUseNotFoundError("Tool use not found")
+
     @classmethod
     def create_default(cls):
         return cls(start_tag="<|tool_use_start|>",
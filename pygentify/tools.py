@@ -1,9 +1,9 @@
 import math
 import json
 import time
-import requests
 from urllib.parse import urlparse
 from .tool_calling import register
+from . import http_client
 
 
 @register()
@@ -95,8 +95,6 @@ def code_interpreter(code: str) -> dict:
         "return_code": "return code"
     }
     """
-    import requests
-
     print("about to execute the code in 10 seconds!:\n", code)
     time.sleep(10)
 
@@ -106,7 +104,7 @@ def code_interpreter(code: str) -> dict:
     endpoint = "http://localhost:9800/run_code/"
     headers = headers={'content-type': 'application/json'}
 
-    resp = requests.post(endpoint, data=json.dumps(data), headers=headers)
+    resp = http_client.post(endpoint, data=json.dumps(data), headers=headers)
 
     
     if resp.ok:
@@ -135,7 +133,7 @@ def react_app_maker(component_code: str, css_code: str):
     # todo: endpoint should be configurable
     endpoint = "http://172.17.0.1:9900/make_react_app/"
     headers = headers={'content-type': 'application/json'}
-    resp = requests.post(endpoint, data=json.dumps(data), headers=headers)
+    resp = http_client.post(endpoint, data=json.dumps(data), headers=headers)
 
     if resp.ok:
         return resp.json()
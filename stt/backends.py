@@ -1,5 +1,5 @@
-import requests
 import subprocess
+from pygentify import http_client
 
 
 class BaseSpeechToTextBackend:
@@ -42,7 +42,7 @@ class RemoteSpeechToTextBackend(BaseSpeechToTextBackend):
 
         headers = {'Accept': 'application/json'}
         files = {'file': open(wav_path, 'rb')}
-        resp = requests.post(url, files=files, headers=headers, proxies=self.proxies)
+        resp = http_client.post(url, files=files, headers=headers, proxies=self.proxies)
 
         files['file'].close()
 
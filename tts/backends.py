@@ -1,5 +1,6 @@
 import json
 import requests
+from pygentify import http_client
 
 
 class BaseTtsBackend:
@@ -51,7 +52,7 @@ class RemoteTtsBackend(BaseTtsBackend):
             "text": text,
             "voice_id": voice_id
         }
-        resp = self.make_request(self.endpoint, requests.post, data=json.dumps(body))
+        resp = self.make_request(self.endpoint, http_client.post, data=json.dumps(body))
 
         audio = None
         if resp.status_code == 200:
@@ -77,10 +78,10 @@ class RemoteTtsBackend(BaseTtsBackend):
         return []
 
     def make_request(self, endpoint, method=None, data=None):
-        method = method or requests.get
+        method = method or http_client.get
         url = self.make_url(endpoint)
         headers = {'Content-Type': 'application/json'}
-        return method(url, data, headers=headers, proxies=self.proxies)
+        return method(url, data=data, headers=headers, proxies=self.proxies)
 
     def make_url(self, path):
         protocol = "http"
@@ -1,70 +1,313 @@
 import asyncio
-import json
 import argparse
+import json
+import logging
+import multiprocessing
+import signal
+import time
 import websockets
 import redis.asyncio as redis
 import os
+import re
 
-STOPWORD = "[|END_OF_STREAM|]"
 TOKEN_STREAM = "token_stream"
 SPEECH_STREAM = "speech_stream"
-STOP_SPEECH = "[|END_OF_SPEECH|]"
 
 BUILD_EVENTS = "build_events"
 
-async def handler(websocket):
-    async with r.pubsub() as pubsub:
-        socket_session_id = await websocket.recv()
-        print(f"<<< Got web socket session id: {socket_session_id}")
+EVENT_STREAM = "session_events"
+
+ENTRY_ID_RE = re.compile(r'\d+-\d+', re.ASCII)
+
+logger = logging.getLogger("websocket_server")
+
+hub = None
+
+
+class SessionHub:
+    """Single Redis pattern subscription shared by every connection of the process.
+
+    Messages published to "<stream>:<session id>" channels are routed to the
+    queues of the sockets registered under that session id, so the number of
+    Redis connections does not depend on the number of connected clients.
 
-        token_channel = f'{TOKEN_STREAM}:{socket_session_id}'
-        speech_channel = f'{SPEECH_STREAM}:{socket_session_id}'
-        builds_channel = f'{BUILD_EVENTS}:{socket_session_id}'
+    Producers publish payloads in the final wire format ({"event": ..., "data": ...}),
+    so they are forwarded as raw bytes without decoding or re-encoding.
 
-        await pubsub.subscribe(token_channel, speech_channel, builds_channel)
-        
+    Every socket queues at most queue_size messages. A socket which falls that
+    far behind is disconnected, so that a slow client cannot exhaust the memory
+    of the process.
+    """
+    streams = (TOKEN_STREAM, SPEECH_STREAM, BUILD_EVENTS)
+    queue_size = 1000
+
+    def __init__(self, redis_url, reconnect_delay=1):
+        self.redis_url = redis_url
+        self.reconnect_delay = reconnect_delay
+        self.sessions = {}
+
+    async def register(self, session_id, last_id=None):
+        """Returns a queue of live messages for the session and a list of missed messages"""
+        queue = asyncio.Queue(self.queue_size)
+        self.sessions.setdefault(session_id.encode(), set()).add(queue)
+        return queue, []
+
+    def unregister(self, session_id, queue):
+        key = session_id.encode()
+        queues = self.sessions.get(key, set())
+        queues.discard(queue)
+        if not queues:
+            self.sessions.pop(key, None)
+
+    async def run(self):
         while True:
-            message = await pubsub.get_message(ignore_subscribe_messages=True)
-            if message is not None:
-                text = message["data"].decode()
-                channel = message["channel"].decode()
-
-                if channel == token_channel:
-                    if text == STOPWORD:
-                        message = json.dumps({'event': 'end_of_stream', 'data': text})
-                    else:
-                        message = text
-                elif channel == speech_channel:
-                    if text == STOP_SPEECH:
-                        message = json.dumps({'event': 'end_of_speech', 'data': text})
-                    else:
-                        d = json.loads(text)
-                        message = json.dumps({
-                            'event': 'speech_sample_arrived',
-                            'data': d
-                        })
-                elif channel == builds_channel:
-                    event_data = json.loads(text)
-                    print('build channel data', event_data)
-                    build_event = event_data['build_event']
-                    message = json.dumps({
-                        'event': build_event,
-                        'data': event_data
-                    })
-                else:
-                    print("Unknown channel:", channel)
-
-                print("about to send message", message)
-                try:
-                    await websocket.send(message)
-                except (websockets.ConnectionClosed, websockets.ConnectionClosedOK):
-                    print("Connection closed by the client. Quitting")
-                    break
-
-
-async def main(host, port):
-    async with websockets.serve(handler, host, port):
-        await asyncio.Future()  # run forever
+            try:
+                await self.listen()
+            except redis.ConnectionError as e:
+                logger.error("redis_connection_lost error=%r", e)
+                await asyncio.sleep(self.reconnect_delay)
+            except Exception:
+                # the hub serves every client of the process, so it must outlive any error
+                logger.exception("hub_failed")
+                await asyncio.sleep(self.reconnect_delay)
+
+    async def listen(self):
+        async with redis.from_url(self.redis_url) as connection, connection.pubsub() as pubsub:
+            await pubsub.psubscribe(*[f'{stream}:*' for stream in self.streams])
+            logger.info("subscribed patterns=%s", ",".join(self.streams))
+
+            async for message in pubsub.listen():
+                if message["type"] == "pmessage":
+                    self.dispatch(message["channel"], message["data"])
+
+    def dispatch(self, channel, payload):
+        _, _, session_id = channel.partition(b':')
+        for queue in self.sessions.get(session_id, ()):
+            self.deliver(session_id, queue, payload)
+
+    def deliver(self, session_key, queue, frame):
+        try:
+            queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            logger.warning("slow_consumer_disconnected session_id=%s", session_key.decode())
+            # queued messages are dropped, None tells forward() to close the socket
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+
+class StreamHub(SessionHub):
+    """Reads events of connected sessions from per-session Redis streams.
+
+    Producers append events to "session_events:<session id>" streams. A single
+    reader issues XREAD over the streams of all local sessions, starting from the
+    last entry id the client reported, so a client that reconnects receives the
+    events it missed. Every message carries the id of its stream entry.
+    """
+
+    def __init__(self, redis_url, reconnect_delay=1, block_ms=100, batch_size=100):
+        super().__init__(redis_url, reconnect_delay)
+        self.block_ms = block_ms
+        self.batch_size = batch_size
+        self.offsets = {}
+        self.connection = None
+        self.has_sessions = asyncio.Event()
+
+    async def register(self, session_id, last_id=None):
+        queue = asyncio.Queue(self.queue_size)
+        key = session_id.encode()
+        last_id = last_id.encode() if last_id else b'0-0'
+
+        if key not in self.offsets:
+            # the reader picks up the new stream on its next XREAD
+            self.offsets[key] = last_id
+            self.sessions[key] = {queue}
+            self.has_sessions.set()
+            return queue, []
+
+        # the session is already read by other sockets; entries after the current
+        # offset will arrive through the queue, older ones have to be fetched here
+        until = self.offsets[key]
+        self.sessions[key].add(queue)
+        if parse_entry_id(last_id) >= parse_entry_id(until):
+            return queue, []
+
+        entries = await self.connection.xrange(stream_key(key), min=b'(' + last_id, max=until)
+        return queue, [make_frame(entry_id, fields) for entry_id, fields in entries]
+
+    def unregister(self, session_id, queue):
+        super().unregister(session_id, queue)
+        key = session_id.encode()
+        if key not in self.sessions:
+            self.offsets.pop(key, None)
+
+    async def listen(self):
+        async with redis.from_url(self.redis_url) as self.connection:
+            logger.info("reading streams block_ms=%s", self.block_ms)
+            await self.read_streams()
+
+    async def read_streams(self):
+        while True:
+            if not self.offsets:
+                self.has_sessions.clear()
+                await self.has_sessions.wait()
+                continue
+
+            streams = {stream_key(key): offset for key, offset in self.offsets.items()}
+            response = await self.connection.xread(streams, count=self.batch_size, block=self.block_ms)
+            for stream, entries in response or []:
+                _, _, key = stream.partition(b':')
+                for entry_id, fields in entries:
+                    self.dispatch_entry(key, entry_id, fields)
+
+    def dispatch_entry(self, key, entry_id, fields):
+        if key not in self.offsets:
+            return
+
+        self.offsets[key] = entry_id
+        frame = make_frame(entry_id, fields)
+        for queue in self.sessions.get(key, ()):
+            self.deliver(key, queue, frame)
+
+
+def stream_key(session_key):
+    return EVENT_STREAM.encode() + b':' + session_key
+
+
+def parse_entry_id(entry_id):
+    ms, _, seq = entry_id.partition(b'-')
+    return int(ms), int(seq or 0)
+
+
+def make_frame(entry_id, fields):
+    # payloads are json objects, so the entry id is spliced in without re-encoding them
+    return b'{"id":"' + entry_id + b'",' + fields[b'payload'][1:]
+
+
+def parse_hello(text):
+    """Returns session id and last seen entry id from the first message sent by a client.
+
+    Clients either send a bare session id or {"session_id": ..., "last_id": ...}
+    when they reconnect. A last id which is not a stream entry id is ignored.
+    """
+    if text.startswith('{'):
+        hello = json.loads(text)
+        last_id = hello.get('last_id')
+        if not isinstance(last_id, str) or not ENTRY_ID_RE.fullmatch(last_id):
+            last_id = None
+        return str(hello['session_id']), last_id
+    return text, None
+
+
+async def forward(queue, websocket, backlog=()):
+    for frame in backlog:
+        await websocket.send(frame, text=True)
+
+    while True:
+        frame = await queue.get()
+        if frame is None:
+            # the client could not keep up, with the streams transport it catches up on reconnect
+            await websocket.close(1013, "too slow")
+            return
+        # payloads are utf-8 encoded json, so they go out as text frames as they are
+        await websocket.send(frame, text=True)
+
+
+async def wait_for_disconnect(websocket):
+    # clients do not send anything after the session id, so just drain until the socket closes
+    async for _ in websocket:
+        pass
+
+
+async def handler(websocket):
+    try:
+        socket_session_id, last_id = parse_hello(await websocket.recv())
+    except websockets.ConnectionClosed:
+        return
+    except (ValueError, KeyError) as e:
+        logger.warning("malformed_hello error=%r", e)
+        return
+
+    logger.info("session_connected session_id=%s last_id=%s", socket_session_id, last_id)
+
+    queue, backlog = await hub.register(socket_session_id, last_id)
+    try:
+        forward_task = asyncio.create_task(forward(queue, websocket, backlog))
+        disconnect_task = asyncio.create_task(wait_for_disconnect(websocket))
+
+        done, pending = await asyncio.wait([forward_task, disconnect_task],
+                                           return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        for task in done:
+            exc = task.exception()
+            if exc and not isinstance(exc, websockets.ConnectionClosed):
+                logger.error("relay_failed session_id=%s error=%r", socket_session_id, exc)
+    finally:
+        hub.unregister(socket_session_id, queue)
+
+    logger.info("session_disconnected session_id=%s", socket_session_id)
+
+
+async def main(host, port, redis_url, reuse_port=False, transport="pubsub"):
+    global hub
+    hub_class = StreamHub if transport == "streams" else SessionHub
+    hub = hub_class(redis_url)
+    hub_task = asyncio.create_task(hub.run())
+
+    try:
+        async with websockets.serve(handler, host, port, reuse_port=reuse_port):
+            # the hub recovers from errors itself; should it stop anyway, the worker exits
+            # rather than keep accepting clients which would get no events
+            await hub_task
+    finally:
+        hub_task.cancel()
+
+
+def run_worker(host, port, redis_url, reuse_port, log_level, transport):
+    configure_logging(log_level)
+    # the supervisor takes care of stopping workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(main(host, port, redis_url, reuse_port=reuse_port, transport=transport))
+
+
+def supervise(num_workers, host, port, redis_url, log_level, transport="pubsub", restart_delay=1):
+    """Runs independent worker processes sharing one port through SO_REUSEPORT.
+
+    Every worker has its own Redis subscription, so any worker can serve any session.
+    Workers that exit are restarted.
+    """
+    def start_worker():
+        args = (host, port, redis_url, True, log_level, transport)
+        worker = multiprocessing.Process(target=run_worker, args=args, daemon=True)
+        worker.start()
+        logger.info("worker_started pid=%s", worker.pid)
+        return worker
+
+    workers = [start_worker() for _ in range(num_workers)]
+
+    def stop(signum, frame):
+        for worker in workers:
+            worker.terminate()
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while True:
+        for i, worker in enumerate(workers):
+            if not worker.is_alive():
+                logger.error("worker_exited pid=%s exitcode=%s", worker.pid, worker.exitcode)
+                time.sleep(restart_delay)
+                workers[i] = start_worker()
+        time.sleep(restart_delay)
+
+
+def configure_logging(log_level):
+    logging.basicConfig(level=log_level,
+                        format="%(asctime)s %(levelname)s %(name)s pid=%(process)d %(message)s")
 
 
 if __name__ == "__main__":
@@ -72,13 +315,20 @@ if __name__ == "__main__":
     parser.add_argument("--host", type=str, default="0.0.0.0")
     parser.add_argument("--port", type=int, default=9000)
     parser.add_argument("--redis-host", type=str, default="localhost")
+    parser.add_argument("--log-level", type=str, default="INFO")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes listening on the same port (SO_REUSEPORT)")
+    parser.add_argument("--transport", choices=["pubsub", "streams"], default="pubsub",
+                        help="has to match EVENT_TRANSPORT of the django settings")
     args = parser.parse_args()
 
-    redis_host = args.redis_host
-    print("REDIS_HOST", redis_host)
-
-    redis_host = "redis"
+    configure_logging(args.log_level)
 
-    r = redis.from_url(f"redis://{redis_host}")
+    logger.info("starting host=%s port=%s redis_host=%s workers=%s transport=%s",
+                args.host, args.port, args.redis_host, args.workers, args.transport)
 
-    asyncio.run(main(args.host, args.port))
+    redis_url = f"redis://{args.redis_host}"
+    if args.workers > 1:
+        supervise(args.workers, args.host, args.port, redis_url, args.log_level, args.transport)
+    else:
+        asyncio.run(main(args.host, args.port, redis_url, transport=args.transport))